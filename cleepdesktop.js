@@ -10,6 +10,15 @@ const DEFAULT_PROXYPORT = 8080;
 const DEFAULT_CRASHREPORT = true;
 const DEFAULT_FIRSTRUN = true;
 const DEFAULT_DEVICES = {};
+const DEFAULT_CACHEMAXSIZE = 10240;
+const DEFAULT_CACHEMAXAGE = 0;
+const DEFAULT_CACHEEVICTION = 'lru';
+const DEFAULT_CACHESPARSE = true;
+const DEFAULT_DOWNLOADRATELIMIT = 0;
+const DEFAULT_MIRRORS = [];
+const DEFAULT_LANSHARING = false;
+const DEFAULT_LANSHARINGPORT = 5611;
+const DEFAULT_NATIVEFLASH = false;
 
 //logger
 const logger = require('electron-log')
@@ -185,6 +194,43 @@ function checkConfig() {
         delay = 2;
     }
 
+    if( !settings.has('cleep.cachemaxsize') ) {
+        settings.set('cleep.cachemaxsize', DEFAULT_CACHEMAXSIZE);
+        delay = 2;
+    }
+    if( !settings.has('cleep.cachemaxage') ) {
+        settings.set('cleep.cachemaxage', DEFAULT_CACHEMAXAGE);
+        delay = 2;
+    }
+    if( !settings.has('cleep.cacheeviction') ) {
+        settings.set('cleep.cacheeviction', DEFAULT_CACHEEVICTION);
+        delay = 2;
+    }
+    if( !settings.has('cleep.cachesparse') ) {
+        settings.set('cleep.cachesparse', DEFAULT_CACHESPARSE);
+        delay = 2;
+    }
+    if( !settings.has('cleep.downloadratelimit') ) {
+        settings.set('cleep.downloadratelimit', DEFAULT_DOWNLOADRATELIMIT);
+        delay = 2;
+    }
+    if( !settings.has('cleep.mirrors') ) {
+        settings.set('cleep.mirrors', DEFAULT_MIRRORS);
+        delay = 2;
+    }
+    if( !settings.has('cleep.lansharing') ) {
+        settings.set('cleep.lansharing', DEFAULT_LANSHARING);
+        delay = 2;
+    }
+    if( !settings.has('cleep.lansharingport') ) {
+        settings.set('cleep.lansharingport', DEFAULT_LANSHARINGPORT);
+        delay = 2;
+    }
+    if( !settings.has('cleep.nativeflash') ) {
+        settings.set('cleep.nativeflash', DEFAULT_NATIVEFLASH);
+        delay = 2;
+    }
+
     //etcher
     if( !settings.has('etcher.version') ) {
         settings.set('etcher.version', 'v0.0.0');
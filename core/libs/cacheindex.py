@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import json
+import time
+import shutil
+import base64
+from threading import Lock, Timer
+from core.libs.sparsefile import SparseFile
+from core.libs.checksum import Checksum
+
+class CacheIndex():
+    """
+    Content addressed cache index.
+    Cached files are stored once per content (cleep_cached_<sha256>) and indexed in a json file
+    stored in cache directory. Each entry keeps urls it was downloaded from, size, last access and hits.
+    Cache size can be bounded: entries are evicted according to configured policy (LRU or age).
+
+    Index is kept in memory and persisted incrementally, so cache directory is never scanned
+    (except once to migrate a cache directory without index). Resumable partial downloads
+    stored in cache directory are also referenced in index.
+
+    Cache lookups only update access time and statistics: they are kept in memory and written
+    at end of flush window, so lookups never write index to disk.
+
+    Checksums of files extracted locally from an archive are remembered (even after entry is evicted),
+    so an extracted file shared by another instance can be verified without trusting that instance.
+    """
+
+    INDEX_FILENAME = 'cleep_cache_index.json'
+    CACHED_FILE_PREFIX = 'cleep_cached'
+
+    POLICY_LRU = 'lru'
+    POLICY_AGE = 'age'
+    POLICIES = (POLICY_LRU, POLICY_AGE)
+
+    FLUSH_DELAY = 5.0
+
+    def __init__(self, cache_dir, max_size=0, max_age=0, policy=POLICY_LRU, flush_delay=FLUSH_DELAY):
+        """
+        Constructor
+
+        Args:
+            cache_dir (string): cache directory
+            max_size (int): maximum cache size in bytes (0 for unlimited)
+            max_age (int): maximum age of cached entry in seconds (0 for unlimited)
+            policy (string): eviction policy (see POLICIES)
+            flush_delay (float): delay in seconds between cache lookup and write of access times to disk
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        self.entries = {}
+        self.partials = []
+        self.extractions = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+        self.max_size = 0
+        self.max_age = 0
+        self.policy = self.POLICY_LRU
+        self.flush_delay = flush_delay
+        self.dirty = False
+        self.__timer = None
+        self.__lock = Lock()
+
+        self.configure(max_size, max_age, policy)
+        self.__load()
+
+    def configure(self, max_size=0, max_age=0, policy=POLICY_LRU):
+        """
+        Configure cache limits
+
+        Args:
+            max_size (int): maximum cache size in bytes (0 for unlimited)
+            max_age (int): maximum age of cached entry in seconds (0 for unlimited)
+            policy (string): eviction policy (see POLICIES)
+        """
+        if policy not in self.POLICIES:
+            raise Exception('Invalid cache eviction policy "%s"' % policy)
+
+        self.max_size = max(0, int(max_size or 0))
+        self.max_age = max(0, int(max_age or 0))
+        self.policy = policy
+
+    def __load(self):
+        """
+        Load index from disk
+        """
+        with self.__lock:
+            if not os.path.exists(self.index_path):
+                self.__migrate()
+                return
+
+            try:
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+                self.entries = index['entries']
+                self.partials = index.get('partials', [])
+                self.extractions = index.get('extractions', {})
+                self.stats.update(index['stats'])
+            except:
+                self.logger.exception('Invalid cache index "%s", it is reset' % self.index_path)
+                self.entries = {}
+                self.partials = []
+                self.extractions = {}
+
+            #drop entries whose file was deleted
+            for sha256 in list(self.entries.keys()):
+                if not os.path.exists(self.entries[sha256]['filepath']):
+                    self.logger.debug('Cached file of entry %s does not exist anymore' % sha256)
+                    del self.entries[sha256]
+            self.partials = [partial for partial in self.partials if os.path.exists(partial)]
+
+            self.__save()
+
+    def __migrate(self):
+        """
+        Cache directory has no index yet: index cached files of previous cache format
+        (cleep_cached_<base16 filename>). They are hashed and renamed to their content addressed
+        filepath. Urls they were downloaded from are unknown, so they are only found by checksum
+        until they are downloaded again. Lock must be acquired
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        prefix = '%s_' % self.CACHED_FILE_PREFIX
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            if not filename.startswith(prefix) or filename.endswith(SparseFile.BLOCKMAP_SUFFIX) or not os.path.isfile(filepath):
+                continue
+
+            try:
+                self.logger.info('Index cached file "%s" of previous cache format' % filepath)
+                checksum = Checksum([Checksum.ALGORITHM_SHA256])
+                checksum.update_from_file(filepath)
+                sha256 = checksum.hexdigest(Checksum.ALGORITHM_SHA256)
+                if sha256 in self.entries:
+                    #same content cached twice
+                    os.remove(filepath)
+                    continue
+
+                try:
+                    original_filename = base64.b16decode(filename[len(prefix):]).decode('utf-8')
+                except:
+                    original_filename = filename[len(prefix):]
+                cached_filepath = self.get_filepath(sha256)
+                os.replace(filepath, cached_filepath)
+                stat = os.stat(cached_filepath)
+                self.entries[sha256] = {
+                    'sha256': sha256,
+                    'filename': original_filename,
+                    'filepath': cached_filepath,
+                    'size': stat.st_size,
+                    'urls': [],
+                    'timestamp': int(stat.st_mtime),
+                    'lastaccess': int(stat.st_mtime),
+                    'hits': 0,
+                }
+            except:
+                #file is kept, it will be indexed at next migration
+                self.logger.exception('Unable to index cached file "%s":' % filepath)
+
+        self.__save()
+
+    def __save(self):
+        """
+        Save index to disk. Lock must be acquired
+        """
+        self.dirty = False
+        try:
+            index_tmp = '%s.tmp' % self.index_path
+            with open(index_tmp, 'w') as f:
+                json.dump({
+                    'entries': self.entries,
+                    'partials': self.partials,
+                    'extractions': self.extractions,
+                    'stats': self.stats,
+                }, f)
+            os.replace(index_tmp, self.index_path)
+        except:
+            self.logger.exception('Unable to save cache index "%s":' % self.index_path)
+
+    def __mark_dirty(self):
+        """
+        Mark index as changed. It is written at end of flush window. Lock must be acquired
+        """
+        self.dirty = True
+        if self.__timer is None:
+            self.__timer = Timer(self.flush_delay, self.flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def flush(self):
+        """
+        Write index to disk now if it changed since last write
+        """
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            if self.dirty:
+                self.__save()
+
+    def get_filepath(self, sha256):
+        """
+        Return cached filepath for specified content checksum
+
+        Args:
+            sha256 (string): content checksum
+
+        Returns:
+            string: cached filepath
+        """
+        return os.path.join(self.cache_dir, '%s_%s' % (self.CACHED_FILE_PREFIX, sha256))
+
+    def get_size(self):
+        """
+        Return current cache size
+
+        Returns:
+            int: cache size in bytes
+        """
+        return sum([entry['size'] for entry in self.entries.values()])
+
+    def get_entries(self):
+        """
+        Return all cache entries
+
+        Returns:
+            list: list of entries::
+                [
+                    {
+                        sha256 (string): content checksum
+                        filename (string): filename of first downloaded url
+                        filepath (string): cached filepath
+                        size (int): file size
+                        urls (list): urls this content was downloaded from
+                        timestamp (int): time entry was added
+                        lastaccess (int): time of last access
+                        hits (int): number of cache hits
+                        sourcesha256 (string): checksum of archive content was extracted from (None if not extracted)
+                        blockmap (string): block map filepath of sparse file (None if file is not sparse)
+                    },
+                    ...
+                ]
+        """
+        with self.__lock:
+            return [dict(entry) for entry in self.entries.values()]
+
+    def get_stats(self):
+        """
+        Return cache statistics
+
+        Returns:
+            dict: cache statistics::
+                {
+                    hits (int): number of cache hits
+                    misses (int): number of cache misses
+                    evictions (int): number of evicted entries
+                    entries (int): number of entries
+                    size (int): cache size in bytes
+                    maxsize (int): maximum cache size in bytes (0 for unlimited)
+                    maxage (int): maximum entry age in seconds (0 for unlimited)
+                    policy (string): eviction policy
+                }
+        """
+        with self.__lock:
+            stats = dict(self.stats)
+            stats.update({
+                'entries': len(self.entries),
+                'size': self.get_size(),
+                'maxsize': self.max_size,
+                'maxage': self.max_age,
+                'policy': self.policy,
+            })
+            return stats
+
+    def find_by_url(self, url):
+        """
+        Search cached entry for specified url. Cache hit or miss is accounted
+
+        Args:
+            url (string): file url
+
+        Returns:
+            dict: cache entry or None if url is not cached
+        """
+        with self.__lock:
+            for entry in self.entries.values():
+                if url in entry['urls'] and os.path.exists(entry['filepath']):
+                    entry['hits'] += 1
+                    entry['lastaccess'] = int(time.time())
+                    self.stats['hits'] += 1
+                    self.__mark_dirty()
+                    return dict(entry)
+
+            self.stats['misses'] += 1
+            self.__mark_dirty()
+            return None
+
+    def find_by_sha256(self, sha256):
+        """
+        Search cached entry for specified content checksum
+
+        Args:
+            sha256 (string): content checksum
+
+        Returns:
+            dict: cache entry or None if content is not cached
+        """
+        with self.__lock:
+            entry = self.entries.get(sha256)
+            return dict(entry) if entry else None
+
+    def find_by_source_sha256(self, sourcesha256):
+        """
+        Search cached entry extracted from archive with specified checksum
+
+        Args:
+            sourcesha256 (string): archive checksum
+
+        Returns:
+            dict: cache entry or None if no file extracted from this archive is cached
+        """
+        with self.__lock:
+            entry = next((entry for entry in self.entries.values() if entry.get('sourcesha256')==sourcesha256), None)
+            return dict(entry) if entry else None
+
+    def get_extracted_sha256(self, sourcesha256):
+        """
+        Return checksum of file extracted locally from archive with specified checksum. Checksum is
+        known even if extracted file is not cached anymore
+
+        Args:
+            sourcesha256 (string): archive checksum
+
+        Returns:
+            string: extracted file checksum or None if archive was never extracted locally
+        """
+        with self.__lock:
+            return self.extractions.get(sourcesha256)
+
+    def add_alias(self, sha256, url, sourcesha256=None):
+        """
+        Add url (and archive checksum) to existing entry, so it can be found by this url
+
+        Args:
+            sha256 (string): content checksum
+            url (string): url
+            sourcesha256 (string): checksum of archive content was extracted from. It must be trusted
+                                   (archive extracted locally), it is not recorded as local extraction
+
+        Returns:
+            bool: True if entry updated
+        """
+        with self.__lock:
+            entry = self.entries.get(sha256)
+            if entry is None:
+                return False
+
+            if url not in entry['urls']:
+                entry['urls'].append(url)
+            if sourcesha256:
+                entry['sourcesha256'] = sourcesha256
+            self.__save()
+            return True
+
+    def add(self, url, filename, filepath, sha256, sourcesha256=None, blockmap=None):
+        """
+        Add specified file to cache. File is moved to cache directory. If the same content is already
+        cached (downloaded from another url), file is dropped and url is added to existing entry.
+
+        Args:
+            url (string): url file was downloaded from (None if unknown)
+            filename (string): file name
+            filepath (string): path of file to cache
+            sha256 (string): file content checksum
+            sourcesha256 (string): checksum of archive file was extracted from locally (None if not extracted)
+            blockmap (dict): block map of sparse file (see SparseFile.get_blockmap)
+
+        Returns:
+            dict: cache entry
+        """
+        with self.__lock:
+            now = int(time.time())
+            entry = self.entries.get(sha256)
+            if entry and os.path.exists(entry['filepath']):
+                #same content already cached, deduplicate it
+                self.logger.debug('Content of "%s" is already cached (%s)' % (url, sha256))
+                if filepath!=entry['filepath']:
+                    os.remove(filepath)
+            else:
+                #new content
+                cached_filepath = self.get_filepath(sha256)
+                shutil.move(filepath, cached_filepath)
+                entry = {
+                    'sha256': sha256,
+                    'filename': filename,
+                    'filepath': cached_filepath,
+                    'size': os.path.getsize(cached_filepath),
+                    'urls': [],
+                    'timestamp': now,
+                    'lastaccess': now,
+                    'hits': 0,
+                }
+                self.entries[sha256] = entry
+
+            if url and url not in entry['urls']:
+                entry['urls'].append(url)
+            if sourcesha256:
+                entry['sourcesha256'] = sourcesha256
+                self.extractions[sourcesha256] = sha256
+            if blockmap and not entry.get('blockmap'):
+                entry['blockmap'] = '%s%s' % (entry['filepath'], SparseFile.BLOCKMAP_SUFFIX)
+                SparseFile.save_blockmap(blockmap, entry['blockmap'])
+            entry['lastaccess'] = now
+            self.__evict(keep=sha256)
+            self.__save()
+
+            return dict(entry)
+
+    def remove(self, sha256):
+        """
+        Remove specified entry from cache
+
+        Args:
+            sha256 (string): content checksum
+
+        Returns:
+            bool: True if entry removed
+        """
+        with self.__lock:
+            removed = self.__remove(sha256)
+            self.__save()
+            return removed
+
+    def remove_by_filename(self, filename):
+        """
+        Remove entries with specified filename from cache
+
+        Args:
+            filename (string): file name
+
+        Returns:
+            bool: True if at least one entry removed
+        """
+        with self.__lock:
+            sha256s = [sha256 for sha256, entry in self.entries.items() if entry['filename']==filename]
+            for sha256 in sha256s:
+                self.__remove(sha256)
+            self.__save()
+            return len(sha256s)>0
+
+    def clear(self):
+        """
+        Remove all entries from cache
+        """
+        with self.__lock:
+            for sha256 in list(self.entries.keys()):
+                self.__remove(sha256)
+            self.__save()
+
+    def add_partial(self, filepath):
+        """
+        Reference partial download file
+
+        Args:
+            filepath (string): partial download filepath
+        """
+        with self.__lock:
+            if filepath not in self.partials:
+                self.partials.append(filepath)
+                self.__save()
+
+    def remove_partial(self, filepath):
+        """
+        Unreference partial download file (file is not deleted)
+
+        Args:
+            filepath (string): partial download filepath
+        """
+        with self.__lock:
+            if filepath in self.partials:
+                self.partials.remove(filepath)
+                self.__save()
+
+    def clear_partials(self):
+        """
+        Delete all referenced partial download files and their journals
+        """
+        with self.__lock:
+            for partial in self.partials:
+                for path in (partial, '%s.journal' % partial, '%s.journal.tmp' % partial):
+                    try:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    except:
+                        self.logger.exception('Unable to remove partial download file "%s":' % path)
+            self.partials = []
+            self.__save()
+
+    def evict(self):
+        """
+        Evict entries according to configured limits
+        """
+        with self.__lock:
+            self.__evict()
+            self.__save()
+
+    def __remove(self, sha256):
+        """
+        Remove entry and its file. Lock must be acquired
+
+        Args:
+            sha256 (string): content checksum
+
+        Returns:
+            bool: True if entry removed
+        """
+        entry = self.entries.pop(sha256, None)
+        if entry is None:
+            return False
+
+        self.logger.debug('Remove cached file "%s"' % entry['filepath'])
+        for path in (entry['filepath'], entry.get('blockmap')):
+            try:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            except:
+                self.logger.exception('Unable to remove cached file "%s":' % path)
+
+        return True
+
+    def __evict(self, keep=None):
+        """
+        Evict entries exceeding configured age, then entries exceeding configured size according
+        to eviction policy. Lock must be acquired
+
+        Args:
+            keep (string): checksum of entry that must not be evicted (just added one)
+        """
+        now = int(time.time())
+
+        #evict expired entries
+        if self.max_age:
+            for sha256, entry in list(self.entries.items()):
+                if sha256!=keep and now-entry['timestamp']>self.max_age:
+                    self.logger.info('Evict cached file "%s" (expired)' % entry['filename'])
+                    self.__remove(sha256)
+                    self.stats['evictions'] += 1
+
+        #evict entries until cache size fits max size
+        if self.max_size:
+            sort_key = 'lastaccess' if self.policy==self.POLICY_LRU else 'timestamp'
+            candidates = sorted([entry for entry in self.entries.values() if entry['sha256']!=keep], key=lambda entry: entry[sort_key])
+            size = self.get_size()
+            for entry in candidates:
+                if size<=self.max_size:
+                    break
+                self.logger.info('Evict cached file "%s" (cache size exceeded)' % entry['filename'])
+                size -= entry['size']
+                self.__remove(entry['sha256'])
+                self.stats['evictions'] += 1
+
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import hashlib
+
+class Checksum():
+    """
+    Checksum helper. It computes several hash algorithms in a single pass.
+    Data can be fed incrementally (from network buffers for example) or read from a file
+    using a large reusable buffer.
+    """
+
+    ALGORITHM_MD5 = 'md5'
+    ALGORITHM_SHA1 = 'sha1'
+    ALGORITHM_SHA256 = 'sha256'
+    ALGORITHMS = (ALGORITHM_MD5, ALGORITHM_SHA1, ALGORITHM_SHA256)
+
+    BUFFER_SIZE = 1048576
+
+    def __init__(self, algorithms):
+        """
+        Constructor
+
+        Args:
+            algorithms (list): list of algorithms to compute (see ALGORITHMS)
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.__hashers = {}
+        for algorithm in algorithms:
+            if algorithm not in self.ALGORITHMS:
+                raise Exception('Unsupported checksum algorithm "%s"' % algorithm)
+            self.__hashers[algorithm] = hashlib.new(algorithm)
+        self.size = 0
+
+    def update(self, buf):
+        """
+        Feed all hashers with specified data
+
+        Args:
+            buf (bytes): data
+        """
+        for hasher in self.__hashers.values():
+            hasher.update(buf)
+        self.size += len(buf)
+
+    def update_from_file(self, file_path, start=0, end=None, callback=None):
+        """
+        Feed all hashers with content of specified file
+
+        Args:
+            file_path (string): file path
+            start (int): offset to start reading from
+            end (int): offset to stop reading at (excluded). If None file is read until its end
+            callback (function): function called with each read buffer, to process data read only once
+
+        Returns:
+            int: number of bytes read
+        """
+        buf = bytearray(self.BUFFER_SIZE)
+        view = memoryview(buf)
+        read = 0
+        with open(file_path, 'rb', buffering=0) as f:
+            f.seek(start)
+            while end is None or start+read<end:
+                size = f.readinto(buf if end is None or end-start-read>=self.BUFFER_SIZE else view[:end-start-read])
+                if not size:
+                    break
+                self.update(view[:size])
+                if callback:
+                    callback(view[:size])
+                read += size
+
+        return read
+
+    def hexdigest(self, algorithm):
+        """
+        Return checksum for specified algorithm
+
+        Args:
+            algorithm (string): algorithm
+
+        Returns:
+            string: checksum or None if algorithm was not computed
+        """
+        if algorithm not in self.__hashers:
+            return None
+
+        return self.__hashers[algorithm].hexdigest()
+
+    def hexdigests(self):
+        """
+        Return all computed checksums
+
+        Returns:
+            dict: checksums by algorithm::
+                {
+                    algorithm (string): checksum (string),
+                    ...
+                }
+        """
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self.__hashers.items()}
+
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import time
+import uuid
+import gevent
+from gevent.threadpool import ThreadPool
+from core.utils import MessageResponse
+from core.exceptions import CommandError
+
+class CommandExecutor():
+    """
+    Asynchronous command executor. Long commands (isos list refresh, wifi networks scan...) are executed
+    in background instead of blocking http request: a job id is returned immediately and command result
+    is delivered later through result callback (websocket).
+
+    Commands are executed in a pool of real OS threads (gevent threadpool), so a command that blocks on
+    a call not patched by gevent does not freeze the whole application. A bounded number of commands run
+    at the same time, others wait for a free thread.
+
+    Cancellation is cooperative, a thread is never killed because it would leave module state half
+    updated:
+     - a pending command (waiting for a free thread) that is canceled or times out is never executed
+     - a running command cannot be interrupted: it runs until its end and its result is dropped. Job
+       result is delivered immediately with canceled (or timeout) status
+
+    Only commands listed in ASYNC_COMMANDS can be executed asynchronously. Pool threads are not
+    greenlets, so those commands must not touch state bound to application (hub) thread (gevent
+    timers, events waited by greenlets...): listed commands only read state or hand their updates to
+    hub thread (module wakeup), so dropping their result is harmless. Command result is delivered from
+    hub thread.
+    """
+
+    #commands allowed to run in pool threads (module name => command names)
+    ASYNC_COMMANDS = {
+        'install': ('get_isos', 'get_wifi_networks'),
+        'updates': ('check_updates',),
+    }
+
+    MAX_RUNNING_JOBS = 4
+    MAX_JOBS = 32
+    DEFAULT_TIMEOUT = 60.0
+
+    JOB_PENDING = 'pending'
+    JOB_RUNNING = 'running'
+    JOB_DONE = 'done'
+    JOB_ERROR = 'error'
+    JOB_TIMEOUT = 'timeout'
+    JOB_CANCELED = 'canceled'
+
+    def __init__(self, modules, result_callback, max_running_jobs=MAX_RUNNING_JOBS, max_jobs=MAX_JOBS, async_commands=None):
+        """
+        Constructor
+
+        Args:
+            modules (dict): application modules (module name => CleepDesktopModule instance)
+            result_callback (function): function called with job result (see get_job) when job is terminated
+            max_running_jobs (int): maximum number of commands running at the same time (number of threads)
+            max_jobs (int): maximum number of pending and running jobs
+            async_commands (dict): commands allowed to run asynchronously (ASYNC_COMMANDS if not specified)
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.modules = modules
+        self.result_callback = result_callback
+        self.max_jobs = max_jobs
+        self.async_commands = async_commands if async_commands is not None else self.ASYNC_COMMANDS
+        self.jobs = {}
+        self.__pool = ThreadPool(max_running_jobs)
+
+    def submit(self, to, command, params=None, timeout=None):
+        """
+        Submit command execution
+
+        Args:
+            to (string): module name
+            command (string): command name
+            params (dict): command parameters
+            timeout (float): command timeout in seconds since submission (None for default timeout)
+
+        Returns:
+            string: job id
+        """
+        if to not in self.modules:
+            raise CommandError('Module "%s" does not exist' % to)
+        if command not in self.async_commands.get(to, ()):
+            raise CommandError('Command "%s" of module "%s" cannot be executed asynchronously' % (command, to))
+        if len(self.jobs)>=self.max_jobs:
+            raise CommandError('Too many commands are running, please retry later')
+
+        job_id = str(uuid.uuid4())
+        self.jobs[job_id] = {
+            'jobid': job_id,
+            'to': to,
+            'command': command,
+            'params': params or {},
+            'timeout': float(timeout) if timeout else self.DEFAULT_TIMEOUT,
+            'status': self.JOB_PENDING,
+            'timestamp': time.time(),
+            'canceled': False,
+            'greenlet': None,
+        }
+        greenlet = gevent.spawn(self.__run, self.jobs[job_id])
+        greenlet.link(lambda _greenlet: self.__end_job(job_id))
+        self.jobs[job_id]['greenlet'] = greenlet
+        self.logger.debug('Command "%s" of module "%s" submitted (job %s)' % (command, to, job_id))
+
+        return job_id
+
+    def cancel(self, job_id):
+        """
+        Cancel job. Job result is delivered with canceled status. See class description for what
+        cancellation means for a running command
+
+        Args:
+            job_id (string): job id
+
+        Returns:
+            bool: True if job was canceled, False if job does not exist (or is already terminated)
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+
+        self.logger.debug('Cancel job %s' % job_id)
+        job['canceled'] = True
+        #only greenlet waiting for command result is killed, command thread is never interrupted
+        job['greenlet'].kill(block=False)
+
+        return True
+
+    def get_jobs(self):
+        """
+        Return pending and running jobs
+
+        Returns:
+            list: list of jobs::
+                [
+                    {
+                        jobid (string): job id
+                        to (string): module name
+                        command (string): command name
+                        status (string): job status (see JOB_XXX)
+                        timestamp (float): submission time
+                    },
+                    ...
+                ]
+        """
+        return [{
+            'jobid': job['jobid'],
+            'to': job['to'],
+            'command': job['command'],
+            'status': job['status'],
+            'timestamp': job['timestamp'],
+        } for job in list(self.jobs.values())]
+
+    def stop(self):
+        """
+        Cancel all jobs. Running commands are not interrupted, pool threads end with them
+        """
+        for job in list(self.jobs.values()):
+            job['canceled'] = True
+            job['greenlet'].kill(block=False)
+        self.__pool.kill()
+
+    def __execute(self, job):
+        """
+        Execute command. This function is executed in a pool thread
+
+        Args:
+            job (dict): job
+
+        Returns:
+            MessageResponse: command response
+        """
+        resp = MessageResponse()
+        if job['canceled']:
+            #job canceled or timed out while waiting for a free thread, its result is already delivered
+            return resp
+
+        job['status'] = self.JOB_RUNNING
+        try:
+            resp.data = self.modules[job['to']].execute_command(job['command'], job['params'])
+        except Exception as e:
+            self.logger.exception('Error occured during command "%s" execution:' % job['command'])
+            resp.error = True
+            resp.message = str(e)
+
+        return resp
+
+    def __run(self, job):
+        """
+        Job greenlet: execute command in pool thread and wait for its result
+
+        Args:
+            job (dict): job
+        """
+        resp = MessageResponse()
+        status = self.JOB_ERROR
+        try:
+            resp = self.__pool.spawn(self.__execute, job).get(timeout=job['timeout'])
+            status = self.JOB_ERROR if resp.error else self.JOB_DONE
+
+        except gevent.Timeout:
+            self.logger.warning('Command "%s" of module "%s" timed out after %.1f seconds' % (job['command'], job['to'], job['timeout']))
+            job['canceled'] = True
+            resp.error = True
+            resp.message = 'Command timed out'
+            status = self.JOB_TIMEOUT
+
+        except gevent.GreenletExit:
+            resp.error = True
+            resp.message = 'Command canceled'
+            status = self.JOB_CANCELED
+
+        except Exception as e:
+            self.logger.exception('Error occured during command "%s" execution:' % job['command'])
+            resp.error = True
+            resp.message = str(e)
+
+        finally:
+            self.__deliver(job, status, resp)
+
+    def __end_job(self, job_id):
+        """
+        Job greenlet terminated. If job was killed before it started, its result was not delivered yet
+
+        Args:
+            job_id (string): job id
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            resp = MessageResponse()
+            resp.error = True
+            resp.message = 'Command canceled'
+            self.__deliver(job, self.JOB_CANCELED, resp)
+
+    def __deliver(self, job, status, resp):
+        """
+        Remove job and deliver its result
+
+        Args:
+            job (dict): job
+            status (string): job final status
+            resp (MessageResponse): command response
+        """
+        self.jobs.pop(job['jobid'], None)
+        self.logger.debug('Job %s terminated with status %s' % (job['jobid'], status))
+
+        result = resp.to_dict()
+        result.update({
+            'jobid': job['jobid'],
+            'to': job['to'],
+            'command': job['command'],
+            'status': status,
+        })
+        try:
+            self.result_callback(result)
+        except:
+            self.logger.exception('Error delivering result of job %s:' % job['jobid'])
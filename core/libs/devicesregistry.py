@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import bisect
+import ipaddress
+from threading import Lock
+from core.exceptions import InvalidParameter
+
+class DevicesRegistry():
+    """
+    In-memory devices registry. Devices are stored by uuid and indexed by bus peer id, MAC address,
+    IP and hostname, so any lookup is done in constant time. Online and unconfigured devices counters
+    are maintained on each change instead of being computed by scanning all devices.
+
+    Several devices can share the same IP or hostname (offline devices keep their last IP, unconfigured
+    devices share the default hostname), so these lookups return a list of devices.
+
+    Devices can be queried by page with filters and sort (see query): filters use indexes (online,
+    configured, version, hostname prefix, IP) and devices sorted by hostname are read from a sorted
+    index, so a page is built without sorting whole registry.
+    """
+
+    SORT_KEYS = ('hostname', 'ip', 'version', 'connectedat', 'uuid')
+
+    def __init__(self, devices=None):
+        """
+        Constructor
+
+        Args:
+            devices (dict): initial devices (device uuid => device infos)
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.devices = {}
+        self.__online = set()
+        self.__unconfigured = set()
+        self.__peers = {}
+        self.__devices_peers = {}
+        self.__macs = {}
+        self.__ips = {}
+        self.__hostnames = {}
+        self.__versions = {}
+        self.__sorted_hostnames = []
+        self.__lock = Lock()
+
+        self.load(devices or {})
+
+    def load(self, devices):
+        """
+        Replace registry content
+
+        Args:
+            devices (dict): devices (device uuid => device infos)
+        """
+        with self.__lock:
+            self.devices = {}
+            self.__online = set()
+            self.__unconfigured = set()
+            self.__peers = {}
+            self.__devices_peers = {}
+            self.__macs = {}
+            self.__ips = {}
+            self.__hostnames = {}
+            self.__versions = {}
+            self.__sorted_hostnames = []
+            for device in devices.values():
+                self.__add(device)
+
+    @property
+    def online(self):
+        """
+        Number of online devices
+        """
+        return len(self.__online)
+
+    @property
+    def unconfigured(self):
+        """
+        Number of unconfigured devices
+        """
+        return len(self.__unconfigured)
+
+    def __get_macs(self, device):
+        """
+        Return normalized MAC addresses of device
+
+        Args:
+            device (dict): device infos
+
+        Returns:
+            list: list of MAC addresses
+        """
+        return [mac.lower() for mac in (device.get('macs') or []) if mac]
+
+    def __get_hostname(self, device):
+        """
+        Return normalized hostname of device
+
+        Args:
+            device (dict): device infos
+
+        Returns:
+            string: hostname
+        """
+        return (device.get('hostname') or '').strip().lower()
+
+    def __add(self, device):
+        """
+        Add device and index it. Lock must be acquired
+
+        Args:
+            device (dict): device infos
+        """
+        device_uuid = device['uuid']
+        self.devices[device_uuid] = device
+        for mac in self.__get_macs(device):
+            self.__macs[mac] = device_uuid
+        if device.get('ip'):
+            self.__ips.setdefault(device['ip'], set()).add(device_uuid)
+        self.__hostnames.setdefault(self.__get_hostname(device), set()).add(device_uuid)
+        self.__versions.setdefault(device.get('version'), set()).add(device_uuid)
+        bisect.insort(self.__sorted_hostnames, (self.__get_hostname(device), device_uuid))
+        if device.get('online'):
+            self.__online.add(device_uuid)
+        if not device.get('configured'):
+            self.__unconfigured.add(device_uuid)
+
+    def __remove(self, device_uuid):
+        """
+        Remove device and its index entries. Lock must be acquired
+
+        Args:
+            device_uuid (string): device uuid
+
+        Returns:
+            dict: removed device or None if device does not exist
+        """
+        device = self.devices.pop(device_uuid, None)
+        if device is None:
+            return None
+
+        for mac in self.__get_macs(device):
+            if self.__macs.get(mac)==device_uuid:
+                del self.__macs[mac]
+        for (index, key) in ((self.__ips, device.get('ip')), (self.__hostnames, self.__get_hostname(device)), (self.__versions, device.get('version'))):
+            uuids = index.get(key)
+            if uuids is not None:
+                uuids.discard(device_uuid)
+                if len(uuids)==0:
+                    del index[key]
+        position = bisect.bisect_left(self.__sorted_hostnames, (self.__get_hostname(device), device_uuid))
+        if position<len(self.__sorted_hostnames) and self.__sorted_hostnames[position][1]==device_uuid:
+            del self.__sorted_hostnames[position]
+        self.__online.discard(device_uuid)
+        self.__unconfigured.discard(device_uuid)
+
+        return device
+
+    def set_device(self, device):
+        """
+        Add or update device
+
+        Args:
+            device (dict): device infos (must contain uuid)
+
+        Returns:
+            bool: True if device was added, False if it was updated
+        """
+        #registry keeps its own copy, so indexes are not desynchronized by changes of caller
+        device = dict(device)
+        with self.__lock:
+            added = self.__remove(device['uuid']) is None
+            self.__add(device)
+
+            return added
+
+    def remove_device(self, device_uuid):
+        """
+        Remove device and its peer
+
+        Args:
+            device_uuid (string): device uuid
+
+        Returns:
+            dict: removed device or None if device does not exist
+        """
+        with self.__lock:
+            peer = self.__devices_peers.pop(device_uuid, None)
+            if peer is not None:
+                self.__peers.pop(peer, None)
+
+            return self.__remove(device_uuid)
+
+    def set_online(self, device_uuid, online):
+        """
+        Update device online status
+
+        Args:
+            device_uuid (string): device uuid
+            online (bool): True if device is online
+
+        Returns:
+            bool: True if device exists
+        """
+        with self.__lock:
+            device = self.devices.get(device_uuid)
+            if device is None:
+                return False
+
+            device['online'] = online
+            if online:
+                self.__online.add(device_uuid)
+            else:
+                self.__online.discard(device_uuid)
+
+            return True
+
+    def set_peer(self, peer, device_uuid):
+        """
+        Associate bus peer to device. After a device restart, bus assigns it a new peer id: previous
+        peer of device is dropped
+
+        Args:
+            peer (string): peer id
+            device_uuid (string): device uuid
+        """
+        with self.__lock:
+            obsolete_peer = self.__devices_peers.get(device_uuid)
+            if obsolete_peer is not None:
+                self.__peers.pop(obsolete_peer, None)
+            self.__peers[peer] = device_uuid
+            self.__devices_peers[device_uuid] = peer
+
+    def remove_peer(self, peer):
+        """
+        Remove bus peer
+
+        Args:
+            peer (string): peer id
+
+        Returns:
+            string: uuid of peer device or None if peer is unknown
+        """
+        with self.__lock:
+            device_uuid = self.__peers.pop(peer, None)
+            if device_uuid is not None and self.__devices_peers.get(device_uuid)==peer:
+                del self.__devices_peers[device_uuid]
+
+            return device_uuid
+
+    def get_device(self, device_uuid):
+        """
+        Return device
+
+        Args:
+            device_uuid (string): device uuid
+
+        Returns:
+            dict: device infos or None if device does not exist
+        """
+        return self.devices.get(device_uuid)
+
+    def get_device_by_peer(self, peer):
+        """
+        Return device of bus peer
+
+        Args:
+            peer (string): peer id
+
+        Returns:
+            dict: device infos or None if peer is unknown
+        """
+        with self.__lock:
+            return self.devices.get(self.__peers.get(peer))
+
+    def get_device_by_mac(self, mac):
+        """
+        Return device with specified MAC address
+
+        Args:
+            mac (string): MAC address
+
+        Returns:
+            dict: device infos or None if not found
+        """
+        with self.__lock:
+            return self.devices.get(self.__macs.get((mac or '').lower()))
+
+    def get_devices_by_ip(self, ip):
+        """
+        Return devices with specified IP
+
+        Args:
+            ip (string): IP address
+
+        Returns:
+            list: list of devices infos
+        """
+        with self.__lock:
+            return [self.devices[device_uuid] for device_uuid in self.__ips.get(ip, ())]
+
+    def get_devices_by_hostname(self, hostname):
+        """
+        Return devices with specified hostname (case insensitive)
+
+        Args:
+            hostname (string): hostname
+
+        Returns:
+            list: list of devices infos
+        """
+        with self.__lock:
+            return [self.devices[device_uuid] for device_uuid in self.__hostnames.get((hostname or '').strip().lower(), ())]
+
+    def get_devices(self):
+        """
+        Return all devices
+
+        Returns:
+            list: list of devices infos
+        """
+        with self.__lock:
+            return list(self.devices.values())
+
+    def get_counters(self):
+        """
+        Return devices counters
+
+        Returns:
+            dict: counters::
+                {
+                    total (int): number of devices
+                    online (int): number of online devices
+                    unconfigured (int): number of unconfigured devices
+                }
+        """
+        return {
+            'total': len(self.devices),
+            'online': self.online,
+            'unconfigured': self.unconfigured,
+        }
+
+    def __filter(self, online=None, configured=None, version=None, hostname=None, subnet=None):
+        """
+        Return uuids of devices matching filters. Lock must be acquired
+
+        Args:
+            see query
+
+        Returns:
+            set: matching devices uuids or None if no filter is specified (all devices match)
+        """
+        subsets = []
+        if online is not None:
+            subsets.append(self.__online if online else set(self.devices.keys()) - self.__online)
+        if configured is not None:
+            subsets.append(set(self.devices.keys()) - self.__unconfigured if configured else self.__unconfigured)
+        if version is not None:
+            subsets.append(self.__versions.get(version, set()))
+        if hostname:
+            prefix = hostname.strip().lower()
+            start = bisect.bisect_left(self.__sorted_hostnames, (prefix, ''))
+            uuids = set()
+            for (device_hostname, device_uuid) in self.__sorted_hostnames[start:]:
+                if not device_hostname.startswith(prefix):
+                    break
+                uuids.add(device_uuid)
+            subsets.append(uuids)
+        if subnet:
+            try:
+                network = ipaddress.ip_network(subnet, strict=False)
+            except ValueError:
+                raise InvalidParameter('Parameter "subnet" is not a valid subnet')
+            uuids = set()
+            for (ip, ip_uuids) in self.__ips.items():
+                try:
+                    if ipaddress.ip_address(ip) in network:
+                        uuids |= ip_uuids
+                except ValueError:
+                    pass
+            subsets.append(uuids)
+
+        if len(subsets)==0:
+            return None
+        subsets.sort(key=len)
+        return set.intersection(*subsets)
+
+    def __get_sort_value(self, device, sort):
+        """
+        Return device value to sort on. Devices without value are sorted last
+
+        Args:
+            device (dict): device infos
+            sort (string): sort key (see SORT_KEYS)
+
+        Returns:
+            tuple: sort value
+        """
+        value = device.get(sort)
+        if value is None or value=='':
+            return (1, 0)
+        if sort=='ip':
+            try:
+                return (0, int(ipaddress.ip_address(value)))
+            except ValueError:
+                return (1, 0)
+        if sort=='version':
+            return (0, tuple(int(part) if part.isdigit() else 0 for part in str(value).split('.')))
+
+        return (0, value)
+
+    def query(self, offset=0, limit=None, online=None, configured=None, version=None, hostname=None, subnet=None, sort='hostname', reverse=False):
+        """
+        Return page of devices matching filters
+
+        Args:
+            offset (int): index of first device to return
+            limit (int): maximum number of devices to return (None for all devices)
+            online (bool): only online (True) or offline (False) devices
+            configured (bool): only configured (True) or unconfigured (False) devices
+            version (string): only devices with this version
+            hostname (string): only devices whose hostname starts with this prefix (case insensitive)
+            subnet (string): only devices whose IP is in this subnet (192.168.1.0/24)
+            sort (string): sort key (see SORT_KEYS)
+            reverse (bool): reverse sort order
+
+        Returns:
+            dict: query result::
+                {
+                    total (int): number of devices matching filters
+                    devices (list): page of devices
+                }
+        """
+        if sort not in self.SORT_KEYS:
+            raise InvalidParameter('Parameter "sort" must be one of %s' % list(self.SORT_KEYS))
+        offset = max(0, int(offset or 0))
+        if limit is not None and int(limit)<0:
+            raise InvalidParameter('Parameter "limit" must be positive')
+
+        with self.__lock:
+            uuids = self.__filter(online, configured, version, hostname, subnet)
+            total = len(self.devices) if uuids is None else len(uuids)
+            end = total if limit is None else min(total, offset + int(limit))
+
+            if sort=='hostname':
+                #walk sorted index until page is complete
+                devices = []
+                index = 0
+                for (_, device_uuid) in (reversed(self.__sorted_hostnames) if reverse else self.__sorted_hostnames):
+                    if index>=end:
+                        break
+                    if uuids is not None and device_uuid not in uuids:
+                        continue
+                    if index>=offset:
+                        devices.append(self.devices[device_uuid])
+                    index += 1
+            else:
+                candidates = self.devices.values() if uuids is None else [self.devices[device_uuid] for device_uuid in uuids]
+                devices = sorted(candidates, key=lambda device: (self.__get_sort_value(device, sort), self.__get_hostname(device)), reverse=reverse)[offset:end]
+
+            return {
+                'total': total,
+                'devices': devices,
+            }
+
+    def to_dict(self):
+        """
+        Return devices to persist
+
+        Returns:
+            dict: devices (device uuid => device infos)
+        """
+        with self.__lock:
+            return dict(self.devices)
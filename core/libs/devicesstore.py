@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import json
+from threading import Lock, Timer
+
+class DevicesStore():
+    """
+    Devices registry persistence. Devices are stored in their own json file of config directory,
+    separately from application config file.
+
+    Devices changes are frequent (each peer connection and disconnection) and come in bursts (all
+    devices reconnect after a network outage), so writes are batched: a change only marks store
+    dirty and registry is written once at end of flush window. File is written atomically (temp
+    file renamed), so a crash during write never corrupts it.
+    """
+
+    DEVICES_FILENAME = 'devices.json'
+    FLUSH_DELAY = 2.0
+
+    def __init__(self, config_dir, get_devices_callback, flush_delay=FLUSH_DELAY):
+        """
+        Constructor
+
+        Args:
+            config_dir (string): directory to store devices file in
+            get_devices_callback (function): function returning devices to save (dict)
+            flush_delay (float): delay in seconds between first change and write to disk
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.devices_path = os.path.join(config_dir, self.DEVICES_FILENAME)
+        self.get_devices_callback = get_devices_callback
+        self.flush_delay = flush_delay
+        self.dirty = False
+        self.writes = 0
+        self.__timer = None
+        self.__lock = Lock()
+
+    def load(self, legacy_devices=None):
+        """
+        Load devices from disk. At first load, devices previously stored in application config are migrated
+
+        Args:
+            legacy_devices (dict): devices stored in application config
+
+        Returns:
+            dict: devices (device uuid => device infos)
+        """
+        with self.__lock:
+            if not os.path.exists(self.devices_path):
+                self.logger.info('Migrate %d devices to "%s"' % (len(legacy_devices or {}), self.devices_path))
+                self.__write(legacy_devices or {})
+                return dict(legacy_devices or {})
+
+            try:
+                with open(self.devices_path, 'r') as f:
+                    return json.load(f)['devices']
+            except:
+                self.logger.exception('Invalid devices file "%s", it is reset' % self.devices_path)
+                return {}
+
+    def __write(self, devices):
+        """
+        Write devices file atomically. Lock must be acquired
+
+        Args:
+            devices (dict): devices to save
+        """
+        devices_tmp = '%s.tmp' % self.devices_path
+        with open(devices_tmp, 'w') as f:
+            json.dump({
+                'devices': devices,
+            }, f)
+        os.replace(devices_tmp, self.devices_path)
+        self.writes += 1
+
+    def mark_dirty(self):
+        """
+        Mark devices as changed. They are written at end of flush window
+        """
+        with self.__lock:
+            self.dirty = True
+            if self.__timer is None:
+                self.__timer = Timer(self.flush_delay, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def flush(self):
+        """
+        Write devices to disk now if they changed
+        """
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            if not self.dirty:
+                return
+
+            try:
+                self.__write(self.get_devices_callback())
+                self.dirty = False
+                self.logger.debug('Devices saved to "%s"' % self.devices_path)
+            except:
+                self.logger.exception('Unable to save devices to "%s":' % self.devices_path)
+
+    def stop(self):
+        """
+        Flush pending changes. Called before stopping application
+        """
+        self.flush()
@@ -9,8 +9,17 @@ import os
 import hashlib
 import platform
 import tempfile
-import base64
 import shutil
+import json
+import gevent
+from threading import Thread, Lock
+from collections import deque
+from core.libs.checksum import Checksum
+from core.libs.cacheindex import CacheIndex
+from core.libs.progress import Progress
+from core.libs.sourceselector import SourceSelector
+from core.libs.zipstream import ZipStream
+from core.libs.sparsefile import SparseFile
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -19,9 +28,13 @@ class Download():
     Download file helper
     """
 
+    TEMP_DIR_NAME = 'cleepdesktop'
     TMP_FILE_PREFIX = 'cleep_tmp'
     DOWNLOAD_FILE_PREFIX = 'cleep_download'
-    CACHED_FILE_PREFIX = 'cleep_cached'
+    CACHED_FILE_PREFIX = CacheIndex.CACHED_FILE_PREFIX
+    PARTIAL_FILE_PREFIX = 'cleep_partial'
+    JOURNAL_FILE_SUFFIX = '.journal'
+    RAW_FILE_SUFFIX = '.raw'
 
     STATUS_IDLE = 0
     STATUS_DOWNLOADING = 1
@@ -33,31 +46,73 @@ class Download():
     STATUS_CANCELED = 7
     STATUS_DONE = 8
 
-    def __init__(self, cache_dir=None, status_callback=None):
+    BUFFER_SIZE = 65536
+    MAX_SEGMENTS = 8
+    SEGMENTED_MIN_SIZE = 8388608
+    CHUNK_SIZE = 16777216
+    MAX_CHUNKS = 1024
+    FLUSH_SIZE = 4194304
+    HASH_CHUNK_SIZE = 67108864
+    HASH_SLICE_SIZE = 1048576
+    JOURNAL_INTERVAL = 2.0
+    STALL_TIMEOUT = 15.0
+    MIN_SOURCE_RATE = 65536
+    SLOW_SOURCE_DURATION = 10.0
+
+    #partial download files in use, shared by all instances (partial filepath => lock)
+    __partial_locks = {}
+    __partial_locks_lock = Lock()
+
+    def __init__(self, cache_dir=None, status_callback=None, cache_index=None, rate_limiter=None):
         """
         Constructor
 
         Args:
             cache_dir (string): directory to save cached files. If not specified default platform temp dir is setted (it means after a reboot, cache will surely be deleted)
             status_callback (function): status callback. Params: status, filesize, percent
+            cache_index (CacheIndex): shared cache index of cache_dir. If not specified, cache index is loaded when needed
+            rate_limiter (RateLimiter): rate limiter shared by all download streams. If not specified download is not throttled
         """
         #logger
         self.logger = logging.getLogger(self.__class__.__name__)
         #self.logger.setLevel(logging.DEBUG)
 
         #members
-        self.temp_dir = tempfile.gettempdir()
+        self.temp_dir = os.path.join(tempfile.gettempdir(), self.TEMP_DIR_NAME)
+        os.makedirs(self.temp_dir, exist_ok=True)
         self.cache_dir = cache_dir
         if not self.cache_dir:
             self.cache_dir = self.temp_dir
         self.download = None
+        self.journal = None
+        self.raw = None
+        self.checksum = None
+        self.extractor = None
+        self.blockmap = None
+        self.__raw_file = None
+        self.__hashed_size = 0
         self.__cancel = False
         self.status_callback = status_callback
-        self.http = urllib3.PoolManager(num_pools=1)
+        self.http = urllib3.PoolManager(num_pools=1, maxsize=self.MAX_SEGMENTS)
+        self.sources = SourceSelector(self.http)
         self.percent = 0
+        self.progress = Progress()
+        self.status = self.STATUS_IDLE
+        self.__cache_index = cache_index
+        self.rate_limiter = rate_limiter
 
-        #purge previously downloaded files
-        self.purge_files()
+    @property
+    def cache_index(self):
+        """
+        Return cache index, loading it if necessary
+
+        Returns:
+            CacheIndex: cache index instance
+        """
+        if self.__cache_index is None:
+            self.__cache_index = CacheIndex(self.cache_dir)
+
+        return self.__cache_index
 
     def cancel(self):
         """
@@ -65,6 +120,15 @@ class Download():
         """
         self.__cancel = True
 
+    def __is_canceled(self):
+        """
+        Return True if download is canceled
+
+        Returns:
+            bool: True if download is canceled
+        """
+        return self.__cancel
+
     def delete_cached_file(self, filename):
         """
         Delete specified cached file
@@ -72,52 +136,31 @@ class Download():
         Args:
             filename: filename to delete
         """
-        cached_filename = self.__encode_cached_filename_by_filename(filename)
-        self.logger.debug('Trying to delete cached filename %s (with real name %s)' % (cached_filename, filename))
-        for root, dirs, dls in os.walk(self.cache_dir):
-            for dl in dls:
-                #delete cached file
-                if os.path.basename(dl).startswith(self.CACHED_FILE_PREFIX) and os.path.basename(dl).endswith(cached_filename):
-                    self.logger.debug('Delete existing cached file: %s' % dl)
-                    try:
-                        os.remove(os.path.join(self.cache_dir, dl))
-                    except:
-                        pass
+        self.logger.debug('Trying to delete cached filename %s' % filename)
+        self.cache_index.remove_by_filename(filename)
 
     def purge_files(self, force_all=False):
         """
         Delete all files that stay from previous processes
 
         Args:
-            force_all (bool): force deletion of all files (cached ones too)
+            force_all (bool): force deletion of all files (cached ones and resumable partial downloads too)
         """
-        for root, dirs, dls in os.walk(self.temp_dir):
-            for dl in dls:
-                #delete temp files
-                if os.path.basename(dl).startswith(self.DOWNLOAD_FILE_PREFIX):
-                    self.logger.debug('Purge existing downloaded temp file: %s' % dl)
-                    try:
-                        os.remove(os.path.join(self.temp_dir, dl))
-                    except:
-                        pass
+        #delete temp files (temp dir is dedicated to downloads, no need to walk whole system temp dir)
+        for dl in os.listdir(self.temp_dir):
+            if dl.startswith(self.DOWNLOAD_FILE_PREFIX) or dl.startswith(self.TMP_FILE_PREFIX):
+                self.logger.debug('Purge existing downloaded temp file: %s' % dl)
+                try:
+                    os.remove(os.path.join(self.temp_dir, dl))
+                except:
+                    pass
 
-                #delete cached files (on temp dir)
-                elif force_all and os.path.basename(dl).startswith(self.CACHED_FILE_PREFIX):
-                    self.logger.debug('Purge existing downloaded cached file: %s' % dl)
-                    try:
-                        os.remove(os.path.join(self.temp_dir, dl))
-                    except:
-                        pass
+        if not force_all:
+            return
 
-        #delete cached files (on cache dir)
-        for root, dirs, dls in os.walk(self.cache_dir):
-            for dl in dls:
-                if force_all and os.path.basename(dl).startswith(self.CACHED_FILE_PREFIX):
-                    self.logger.debug('Purge existing downloaded cached file: %s' % dl)
-                    try:
-                        os.remove(os.path.join(self.cache_dir, dl))
-                    except:
-                        pass
+        #delete cached files and partial downloads
+        self.cache_index.clear()
+        self.cache_index.clear_partials()
 
     def get_cached_files(self):
         """
@@ -126,37 +169,49 @@ class Download():
         Return:
             list: cached filepaths::
                 [
-                    {filename, filepath, filesize, timestamp}
-                    {filename, filepath, filesize, timestamp}
+                    {filename, filepath, filesize, timestamp, sha256, urls, lastaccess, hits, sourcesha256}
+                    {filename, filepath, filesize, timestamp, sha256, urls, lastaccess, hits, sourcesha256}
                     ...
                 ]
         """
-        cached = []
-
         self.logger.debug('Get cached files from "%s"' % self.cache_dir)
-        for root, dirs, dls in os.walk(self.cache_dir):
-            for dl in dls:
-                self.logger.debug('Found cached file "%s"' % dl)
-                if os.path.basename(dl).startswith(self.CACHED_FILE_PREFIX):
-                    filepath = os.path.join(self.cache_dir, dl)
-                    try:
-                        filename = os.path.basename(dl).replace('%s_' % self.CACHED_FILE_PREFIX, '')
-                        filename = self.__decode_cached_filename(filename)
-                        cached.append({
-                            'filename': filename,
-                            'filepath': filepath,
-                            'filesize': os.path.getsize(filepath),
-                            'timestamp': int(os.path.getmtime(filepath))
-                        })
 
-                    except:
-                        #unable to get cached filename, filename format changed surely
-                        #remove it from list and filesystem
-                        self.logger.exception('Invalid cached file:')
-                        os.remove(filepath)
-                        self.logger.warning('Remove cached file "%s" because name format surely changed and is not compatible anymore' % filepath)
+        return [{
+            'filename': entry['filename'],
+            'filepath': entry['filepath'],
+            'filesize': entry['size'],
+            'timestamp': entry['timestamp'],
+            'sha256': entry['sha256'],
+            'urls': entry['urls'],
+            'lastaccess': entry['lastaccess'],
+            'hits': entry['hits'],
+            'sourcesha256': entry.get('sourcesha256'),
+        } for entry in self.cache_index.get_entries()]
+
+    def get_cache_stats(self):
+        """
+        Return cache statistics
+
+        Returns:
+            dict: cache statistics as returned by CacheIndex.get_stats
+        """
+        return self.cache_index.get_stats()
+
+    def generate_checksums(self, file_path, algorithms):
+        """
+        Generate checksums for specified file. All algorithms are computed in a single read pass
+
+        Args:
+            file_path (string): file path
+            algorithms (list): list of algorithms (see Checksum.ALGORITHMS)
+
+        Returns:
+            dict: checksums by algorithm
+        """
+        checksum = Checksum(algorithms)
+        checksum.update_from_file(file_path)
 
-        return cached
+        return checksum.hexdigests()
 
     def generate_sha1(self, file_path):
         """
@@ -165,15 +220,7 @@ class Download():
         Args:
             file_path (string): file path
         """
-        sha1 = hashlib.sha1()
-        with open(file_path, 'rb') as f:
-            while True:
-                buf = f.read(1024)
-                if not buf:
-                    break
-                sha1.update(buf)
-
-        return sha1.hexdigest()
+        return self.generate_checksums(file_path, [Checksum.ALGORITHM_SHA1])[Checksum.ALGORITHM_SHA1]
 
     def generate_sha256(self, file_path):
         """
@@ -182,15 +229,7 @@ class Download():
         Args:
             file_path (string): file path
         """
-        sha256 = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            while True:
-                buf = f.read(1024)
-                if not buf:
-                    break
-                sha256.update(buf)
-
-        return sha256.hexdigest()
+        return self.generate_checksums(file_path, [Checksum.ALGORITHM_SHA256])[Checksum.ALGORITHM_SHA256]
 
     def generate_md5(self, file_path):
         """
@@ -199,15 +238,7 @@ class Download():
         Args:
             file_path (string): file path
         """
-        md5 = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            while True:
-                buf = f.read(1024)
-                if not buf:
-                    break
-                md5.update(buf)
-
-        return md5.hexdigest()
+        return self.generate_checksums(file_path, [Checksum.ALGORITHM_MD5])[Checksum.ALGORITHM_MD5]
 
     def __status_callback(self, status, size, percent):
         """
@@ -221,39 +252,198 @@ class Download():
         if self.status_callback:
             self.status_callback(status, size, percent)
 
-    def download_from_url(self, url, check_sha1=None, check_sha256=None, check_md5=None, cache=False):
+    def __probe_url(self, url):
         """
-        Download specified url. Specify key to check if necessary.
-        This function is blocking
+        Probe specified url to get file infos and to know if server supports range requests
+
+        Args:
+            url (string): url to probe
+
+        Returns:
+            dict: url infos::
+                {
+                    ranges (bool): True if server supports range requests
+                    size (int): file size (0 if unknown)
+                    etag (string): ETag header value (None if not provided)
+                    lastmodified (string): Last-Modified header value (None if not provided)
+                }
+        """
+        infos = {
+            'ranges': False,
+            'size': 0,
+            'etag': None,
+            'lastmodified': None,
+        }
+        try:
+            resp = self.http.request('HEAD', url)
+            accept_ranges = resp.getheader('Accept-Ranges')
+            infos['ranges'] = resp.status==200 and accept_ranges is not None and accept_ranges.lower()=='bytes'
+            infos['size'] = int(resp.getheader('Content-Length') or 0)
+            infos['etag'] = resp.getheader('ETag')
+            infos['lastmodified'] = resp.getheader('Last-Modified')
+            self.logger.debug('Probe url "%s": %s' % (url, infos))
+
+        except:
+            self.logger.exception('Unable to probe url "%s":' % url)
+
+        return infos
+
+    def __load_journal(self, url, infos):
+        """
+        Load download journal of previous interrupted download of specified url
 
         Args:
             url (string): url to download
-            check_sha1 (string): sha1 key to check
-            check_sha256 (string): sha256 key to check
-            check_md5 (string): md5 key to check
-            cache (bool): if True and file exists return cached file with no download, if True and no file download it. If False do not cache file
+            infos (dict): url infos as returned by __probe_url
 
         Returns:
-            string: downloaded filepath (temp filename, it will be deleted during next download) or None if error occured
+            list: list of segments to resume or None if no download can be resumed
         """
-        #prepare filename
-        download_uuid = str(uuid.uuid4())
-        self.download = os.path.join(self.temp_dir, '%s_%s' % (self.TMP_FILE_PREFIX, download_uuid))
-        self.logger.debug('File will be saved to "%s"' % self.download)
+        if not os.path.exists(self.journal) or not os.path.exists(self.download):
+            return None
 
-        #check if file is cached
-        cached_filename = self.__encode_cached_filename_by_url(url)
-        cached_download = os.path.join(self.cache_dir, '%s_%s' % (self.CACHED_FILE_PREFIX, cached_filename))
-        if cache and os.path.exists(cached_download):
-            #file cached, return it
-            self.logger.debug('Return cached file (%s)' % cached_download)
-            filesize = os.path.getsize(cached_download)
-            self.download = cached_download
-            self.__status_callback(self.STATUS_DONE, filesize, 100)
-            return self.download
-        
+        try:
+            with open(self.journal, 'r') as f:
+                journal = json.load(f)
+
+            #make sure remote file has not changed since last download
+            if journal['url']!=url or journal['size']!=infos['size']:
+                self.logger.debug('Journal does not match url or size, drop partial download')
+                return None
+            if journal['etag']!=infos['etag'] or journal['lastmodified']!=infos['lastmodified']:
+                self.logger.debug('Remote file changed since last download, drop partial download')
+                return None
+            if os.path.getsize(self.download)!=infos['size']:
+                self.logger.debug('Partial file size is invalid, drop partial download')
+                return None
+
+            #only flushed bytes are reliable
+            return [{
+                'start': segment['start'],
+                'end': segment['end'],
+                'downloaded': segment['downloaded'],
+                'flushed': segment['downloaded'],
+                'error': False,
+            } for segment in journal['segments']]
+
+        except:
+            self.logger.exception('Invalid download journal "%s":' % self.journal)
+            return None
+
+    def __save_journal(self, url, infos, segments):
+        """
+        Save download journal to allow resuming interrupted download
+
+        Args:
+            url (string): url to download
+            infos (dict): url infos as returned by __probe_url
+            segments (list): list of segments
+        """
+        journal = {
+            'url': url,
+            'size': infos['size'],
+            'etag': infos['etag'],
+            'lastmodified': infos['lastmodified'],
+            'segments': [{
+                'start': segment['start'],
+                'end': segment['end'],
+                'downloaded': segment['flushed'],
+            } for segment in segments],
+        }
+        try:
+            #journal must never claim bytes that are not on disk: flushed bytes are synced before journal
+            #is written (atomically) to disk
+            with open(self.download, 'r+b') as download:
+                os.fsync(download.fileno())
+            journal_tmp = '%s.tmp' % self.journal
+            with open(journal_tmp, 'w') as f:
+                json.dump(journal, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(journal_tmp, self.journal)
+        except:
+            self.logger.exception('Unable to save download journal "%s":' % self.journal)
+
+    def __delete_partial(self):
+        """
+        Delete partial download file and its journal
+        """
+        for path in (self.download, self.journal):
+            try:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            except:
+                self.logger.exception('Unable to delete partial download file "%s":' % path)
+        self.cache_index.remove_partial(self.download)
+        self.__close_extractor(delete=True)
+
+    def __open_extractor(self, sparse):
+        """
+        Prepare on the fly extraction of downloaded archive to raw partial file
+
+        Args:
+            sparse (bool): write raw file as sparse file (zeroed blocks are not written)
+        """
+        self.raw = '%s%s' % (self.download, self.RAW_FILE_SUFFIX)
+        self.__raw_file = SparseFile(self.raw) if sparse else open(self.raw, 'wb')
+        self.extractor = ZipStream(self.__raw_file.write)
+        self.cache_index.add_partial(self.raw)
+
+    def __close_extractor(self, delete=False):
+        """
+        Close raw partial file
+
+        Args:
+            delete (bool): delete raw partial file and stop extraction
+        """
+        if self.__raw_file:
+            self.__raw_file.close()
+            if isinstance(self.__raw_file, SparseFile):
+                self.blockmap = self.__raw_file.get_blockmap()
+            self.__raw_file = None
+
+        if delete and self.raw:
+            try:
+                if os.path.exists(self.raw):
+                    os.remove(self.raw)
+            except:
+                self.logger.exception('Unable to delete partial download file "%s":' % self.raw)
+            self.cache_index.remove_partial(self.raw)
+            self.extractor = None
+
+    def __feed_extractor(self, buf):
+        """
+        Feed archive extractor with downloaded data (data must be fed in file order)
+
+        Args:
+            buf (bytes): downloaded data
+        """
+        if not self.extractor:
+            return
+
+        try:
+            self.extractor.feed(buf)
+        except:
+            self.logger.exception('Error extracting archive "%s":' % self.download)
+            self.__close_extractor(delete=True)
+            return
+
+        if not self.extractor.is_valid():
+            #not a supported archive, it will be kept as is
+            self.__close_extractor(delete=True)
+
+    def __download_single(self, url):
+        """
+        Download specified url using a single stream. Used when server does not support range requests,
+        so download cannot be resumed.
+
+        Args:
+            url (string): url to download
+
+        Returns:
+            tuple: (downloaded size (int), file size (int)) or None if error occured
+        """
         #prepare download
-        download = None
         try:
             download = open(self.download, u'wb')
         except:
@@ -264,8 +454,10 @@ class Download():
 
         #initialize download
         try:
-            resp = self.http.request('GET', url, preload_content=False)
+            timeout = urllib3.Timeout(connect=self.STALL_TIMEOUT, read=self.STALL_TIMEOUT)
+            resp = self.http.request('GET', url, preload_content=False, timeout=timeout)
         except:
+            download.close()
             self.logger.exception('Error initializing http request:')
             self.status = self.STATUS_ERROR
             self.__status_callback(self.status, 0, 0)
@@ -278,8 +470,10 @@ class Download():
             self.status = self.STATUS_DOWNLOADING
         except:
             self.logger.exception('Error getting content-length value from header:')
+            self.status = self.STATUS_DOWNLOADING_NOSIZE
         self.__status_callback(self.status, 0, 0)
         self.logger.debug('Size to download: %d bytes' % file_size)
+        self.progress.reset(file_size)
 
         #download file
         downloaded_size = 0
@@ -287,7 +481,7 @@ class Download():
         while True:
             #read data
             try:
-                buf = resp.read(1024)
+                buf = resp.read(self.BUFFER_SIZE)
             except:
                 download.close()
                 self.logger.exception('Network exception:')
@@ -298,11 +492,15 @@ class Download():
             if not buf:
                 #download ended or failed, stop statement
                 break
+            if self.rate_limiter:
+                self.rate_limiter.consume(len(buf), self.__is_canceled)
 
-            #save date to output file
+            #save date to output file and compute checksum on the fly
             downloaded_size += len(buf)
             try:
                 download.write(buf)
+                self.checksum.update(buf)
+                self.__feed_extractor(buf)
             except:
                 download.close()
                 self.logger.exception('Unable to write to download file "%s":' % self.download)
@@ -310,9 +508,9 @@ class Download():
                 self.__status_callback(self.status, downloaded_size, self.percent)
                 return None
             
-            #compute percentage
-            if file_size!=0:
-                self.percent = int(float(downloaded_size) / float(file_size) * 100.0)
+            #compute percentage and report progress at bounded rate
+            if self.progress.update(downloaded_size):
+                self.percent = self.progress.get_percent()
                 self.__status_callback(self.status, downloaded_size, self.percent)
                 if not self.percent%5 and last_percent!=self.percent:
                     last_percent = self.percent
@@ -322,18 +520,475 @@ class Download():
             if self.__cancel:
                 download.close()
                 self.logger.debug('Flash process canceled during download')
-                self.satus = self.STATUS_CANCELED
+                self.status = self.STATUS_CANCELED
                 self.__status_callback(self.status, file_size, 100)
                 return None
 
-        #download terminated
         download.close()
 
+        return downloaded_size, file_size
+
+    def __download_fallback(self, url, algorithms, extract, sparse):
+        """
+        Download specified url using a single stream after range download from alternative sources failed.
+        Data already downloaded, hashed and extracted is dropped because origin may not serve the same bytes
+
+        Args:
+            url (string): url to download
+            algorithms (list): checksum algorithms
+            extract (bool): extract archive on the fly
+            sparse (bool): write extracted file as sparse file
+
+        Returns:
+            tuple: (downloaded size (int), file size (int)) or None if error occured
+        """
+        try:
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+        except:
+            self.logger.exception('Unable to delete download journal "%s":' % self.journal)
+        self.checksum = Checksum(algorithms)
+        self.__hashed_size = 0
+        self.__close_extractor(delete=True)
+        if extract:
+            try:
+                self.__open_extractor(sparse)
+            except:
+                self.logger.exception('Unable to create file:')
+                self.__close_extractor(delete=True)
+
+        return self.__download_single(url)
+
+    def __download_segment(self, segment):
+        """
+        Download specified segment of file. This function is executed in its own thread and
+        writes data directly at segment offset of preallocated download file.
+        Download starts from already downloaded bytes of segment (resume). If current source fails,
+        stalls or stays slower than MIN_SOURCE_RATE during SLOW_SOURCE_DURATION seconds, segment download
+        continues from next available source
+
+        Args:
+            segment (dict): segment infos (start, end, downloaded, flushed, error)
+        """
+        length = segment['end'] - segment['start'] + 1
+        if segment['downloaded']>=length:
+            return
+
+        try:
+            with open(self.download, 'r+b') as download:
+                url = self.sources.get_url()
+                timeout = urllib3.Timeout(connect=self.STALL_TIMEOUT, read=self.STALL_TIMEOUT)
+                rate = Progress()
+                while segment['downloaded']<length and not self.__cancel:
+                    if url is None:
+                        raise Exception('No download source available anymore')
+
+                    try:
+                        offset = segment['start'] + segment['downloaded']
+                        download.seek(offset)
+                        headers = {'Range': 'bytes=%d-%d' % (offset, segment['end'])}
+                        resp = self.http.request('GET', url, headers=headers, preload_content=False, timeout=timeout)
+                        if resp.status!=206:
+                            #response body (whole file) is not read: close connection and give it back to pool
+                            resp.close()
+                            resp.release_conn()
+                            raise Exception('Server does not honor range request (status %s)' % resp.status)
+
+                        rate.reset(length, segment['downloaded'])
+                        slow_since = None
+                        while segment['downloaded']<length and not self.__cancel:
+                            buf = resp.read(min(self.BUFFER_SIZE, length - segment['downloaded']))
+                            if not buf:
+                                break
+                            if self.rate_limiter:
+                                self.rate_limiter.consume(len(buf), self.__is_canceled)
+                            download.write(buf)
+                            segment['downloaded'] += len(buf)
+
+                            #flush data regularly to keep journal consistent with file content
+                            if segment['downloaded']-segment['flushed']>=self.FLUSH_SIZE:
+                                download.flush()
+                                segment['flushed'] = segment['downloaded']
+
+                            #switch source if it stays too slow
+                            rate.update(segment['downloaded'])
+                            slow_since = self.__check_source_rate(url, rate, slow_since)
+                        resp.release_conn()
+
+                        if segment['downloaded']<length and not self.__cancel:
+                            raise Exception('Connection closed before end of segment')
+
+                    except:
+                        #source failed or stalled, switch to next one
+                        self.logger.exception('Error downloading segment %d-%d from "%s":' % (segment['start'], segment['end'], url))
+                        url = self.sources.failover(url)
+
+                download.flush()
+                segment['flushed'] = segment['downloaded']
+
+        except:
+            self.logger.exception('Error downloading segment %d-%d:' % (segment['start'], segment['end']))
+            segment['error'] = True
+
+    def __check_source_rate(self, url, rate, slow_since):
+        """
+        Source rate watchdog: raise an exception if source stays slower than MIN_SOURCE_RATE for
+        SLOW_SOURCE_DURATION seconds while another source is available. Throttled downloads are slow
+        on purpose, so they are not watched
+
+        Args:
+            url (string): current source url
+            rate (Progress): progress of current range request
+            slow_since (float): timestamp source became slow (None if source is not slow)
+
+        Returns:
+            float: timestamp source became slow (None if source is not slow)
+        """
+        if self.rate_limiter and self.rate_limiter.get_rate():
+            return None
+        if not rate.instant_rate or rate.instant_rate>=self.MIN_SOURCE_RATE:
+            return None
+
+        now = time.time()
+        if slow_since is None:
+            return now
+        if now-slow_since>=self.SLOW_SOURCE_DURATION and self.sources.has_alternative(url):
+            raise Exception('Source rate is below %d bytes/s for %d seconds (%d bytes/s)' % (self.MIN_SOURCE_RATE, self.SLOW_SOURCE_DURATION, rate.instant_rate))
+
+        return slow_since
+
+    def __download_worker(self, pending):
+        """
+        Download pending chunks in file order until none is left. This function is executed in its own thread,
+        several workers share the same pending chunks
+
+        Args:
+            pending (deque): chunks to download (see __download_segment)
+        """
+        while not self.__cancel:
+            try:
+                chunk = pending.popleft()
+            except IndexError:
+                return
+
+            self.__download_segment(chunk)
+            if chunk['error']:
+                #no source available anymore
+                return
+
+    def __hash_downloaded(self, segments, max_size=None):
+        """
+        Feed checksum (and archive extractor) with downloaded data that is contiguous from beginning of
+        file and not hashed yet. Data is read back just after it was written, so it is usually served by
+        system page cache. Data is hashed in small slices, other greenlets run between them.
+
+        Args:
+            segments (list): list of segments
+            max_size (int): maximum number of bytes to hash during this call (None for no limit)
+        """
+        if not self.checksum.hexdigests() and not self.extractor:
+            #no checksum to compute and nothing to extract
+            return
+
+        #compute end of contiguous downloaded data
+        end = 0
+        for segment in sorted(segments, key=lambda segment: segment['start']):
+            end = segment['start'] + segment['flushed']
+            if segment['flushed']<segment['end']-segment['start']+1:
+                break
+        if max_size is not None:
+            end = min(end, self.__hashed_size + max_size)
+
+        while end>self.__hashed_size:
+            slice_end = min(end, self.__hashed_size + self.HASH_SLICE_SIZE)
+            read = self.checksum.update_from_file(self.download, self.__hashed_size, slice_end, self.__feed_extractor)
+            if not read:
+                break
+            self.__hashed_size += read
+            gevent.sleep(0)
+
+    def __download_ranges(self, url, infos, segments):
+        """
+        Download specified url using range requests. If previous download was interrupted, it is resumed
+        from partial download journal. Output file is preallocated and split in chunks that are downloaded
+        concurrently and written at their own offset, so file is reassembled once all chunks are done.
+
+        Chunks are handed out to download streams in file order, so downloaded data is contiguous from
+        beginning of file (except chunks in progress) and checksum is computed during download: only
+        the last chunks are hashed once download is completed.
+
+        Args:
+            url (string): url to download
+            infos (dict): url infos as returned by __probe_url
+            segments (int): number of concurrent download streams
+
+        Returns:
+            tuple: (downloaded size (int), file size (int)) or None if error occured
+        """
+        file_size = infos['size']
+
+        parts = self.__load_journal(url, infos)
+        if parts is not None:
+            self.logger.info('Resume download of "%s" (%d/%d bytes already downloaded)' % (url, sum([part['downloaded'] for part in parts]), file_size))
+
+        else:
+            #preallocate file
+            try:
+                with open(self.download, 'wb') as download:
+                    if hasattr(os, 'posix_fallocate'):
+                        os.posix_fallocate(download.fileno(), 0, file_size)
+                    else:
+                        download.truncate(file_size)
+            except:
+                self.logger.exception('Unable to preallocate file "%s":' % self.download)
+                self.status = self.STATUS_ERROR
+                self.__status_callback(self.status, 0, 0)
+                return None
+
+            #split file in chunks
+            chunk_size = max(self.CHUNK_SIZE, -(-file_size // self.MAX_CHUNKS))
+            parts = []
+            for start in range(0, file_size, chunk_size):
+                end = min(start + chunk_size, file_size) - 1
+                parts.append({'start': start, 'end': end, 'downloaded': 0, 'flushed': 0, 'error': False})
+            self.__save_journal(url, infos, parts)
+
+        #launch chunks download
+        if file_size<self.SEGMENTED_MIN_SIZE:
+            segments = 1
+        pending = deque([part for part in parts if part['downloaded']<part['end']-part['start']+1])
+        segments = max(1, min(segments, self.MAX_SEGMENTS, len(pending)))
+        self.logger.debug('Download %d bytes in %d chunks using %d streams' % (file_size, len(parts), segments))
+        self.status = self.STATUS_DOWNLOADING
+        self.__status_callback(self.status, 0, 0)
+        self.progress.reset(file_size, sum([part['downloaded'] for part in parts]))
+        threads = []
+        for _ in range(segments):
+            thread = Thread(target=self.__download_worker, args=(pending,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        #monitor download progress
+        last_percent = -1
+        last_journal = time.time()
+        while any([thread.is_alive() for thread in threads]):
+            time.sleep(0.25)
+            downloaded_size = sum([part['downloaded'] for part in parts])
+            if self.progress.update(downloaded_size):
+                self.percent = self.progress.get_percent()
+                self.__status_callback(self.status, downloaded_size, self.percent)
+                if not self.percent%5 and last_percent!=self.percent:
+                    last_percent = self.percent
+                    self.logger.debug('Downloading %s %d%%' % (self.download, self.percent))
+            if time.time()-last_journal>=self.JOURNAL_INTERVAL:
+                self.__save_journal(url, infos, parts)
+                last_journal = time.time()
+            self.__hash_downloaded(parts, self.HASH_CHUNK_SIZE)
+        downloaded_size = sum([part['downloaded'] for part in parts])
+        self.__save_journal(url, infos, parts)
+
+        #cancel download
+        if self.__cancel:
+            self.logger.debug('Flash process canceled during download')
+            self.status = self.STATUS_CANCELED
+            self.__status_callback(self.status, file_size, 100)
+            return None
+
+        #check segments
+        for part in parts:
+            if part['error'] or part['downloaded']!=part['end']-part['start']+1:
+                self.logger.error('Segment %d-%d failed (%d bytes downloaded). Download can be resumed' % (part['start'], part['end'], part['downloaded']))
+                self.status = self.STATUS_ERROR_NETWORK
+                self.__status_callback(self.status, downloaded_size, self.percent)
+                return None
+
+        #hash remaining data
+        self.logger.debug('%d bytes hashed during download, %d bytes remaining' % (self.__hashed_size, file_size - self.__hashed_size))
+        self.__hash_downloaded(parts)
+
+        return downloaded_size, file_size
+
+    def download_from_url(self, url, check_sha1=None, check_sha256=None, check_md5=None, cache=False, segments=1, sources=None, extract=False, sparse=False):
+        """
+        Download specified url. Specify key to check if necessary.
+        This function is blocking.
+
+        If server supports range requests, download is journalized in cache directory and an interrupted
+        download (network error) is resumed at next call with the same url. Concurrent downloads of the same
+        url are serialized: second download waits for first one to end.
+
+        Alternative sources (mirrors, LAN cache) serving the same file can be specified. They are probed
+        with small range requests and the fastest one is used. If it fails or stalls during download,
+        download continues from next source. Specify a checksum to guarantee integrity of downloaded file.
+
+        If extract is enabled and downloaded file is a zip archive, its first member is inflated while
+        archive is downloaded, and extracted file is returned (and cached) instead of archive. Checksums
+        are verified on archive, extracted file integrity is verified with archive crc. Extracted file can be
+        written as sparse file, its block map is then available in blockmap member (and cached).
+
+        Args:
+            url (string): url to download
+            check_sha1 (string): sha1 key to check
+            check_sha256 (string): sha256 key to check
+            check_md5 (string): md5 key to check
+            cache (bool): if True and file exists return cached file with no download, if True and no file download it. If False do not cache file
+            segments (int): number of concurrent range requests used to download file. Single stream is used
+                            if server does not support range requests or if file is small
+            sources (list): ordered list of alternative urls serving the same file. Url is always used as last source
+            extract (bool): extract zip archive on the fly
+            sparse (bool): write extracted file as sparse file
+
+        Returns:
+            string: downloaded filepath (temp filename, it will be deleted during next download) or None if error occured
+        """
+        #prepare filename
+        partial_filename = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        partial = os.path.join(self.cache_dir, '%s_%s' % (self.PARTIAL_FILE_PREFIX, partial_filename))
+
+        #partial file and journal are shared by all downloads of the same url
+        if not self.__acquire_partial(partial):
+            self.logger.debug('Download of "%s" canceled while waiting for concurrent download' % url)
+            self.status = self.STATUS_CANCELED
+            self.__status_callback(self.status, 0, 0)
+            return None
+        try:
+            self.download = partial
+            self.journal = '%s%s' % (self.download, self.JOURNAL_FILE_SUFFIX)
+            self.logger.debug('File will be saved to "%s"' % self.download)
+            return self.__download_from_url(url, check_sha1, check_sha256, check_md5, cache, segments, sources, extract, sparse)
+        finally:
+            self.__release_partial(partial)
+
+    def __acquire_partial(self, partial):
+        """
+        Acquire exclusive use of partial download file. Concurrent downloads of the same url would write
+        the same partial file and journal, so a download waits for the running one to end (file is then
+        usually found in cache)
+
+        Args:
+            partial (string): partial download filepath
+
+        Returns:
+            bool: True if partial file acquired, False if download was canceled while waiting
+        """
+        with Download.__partial_locks_lock:
+            lock = Download.__partial_locks.setdefault(partial, Lock())
+
+        if not lock.acquire(blocking=False):
+            self.logger.info('Url is already being downloaded, wait for end of download')
+            while not lock.acquire(timeout=0.5):
+                if self.__cancel:
+                    return False
+
+        return True
+
+    def __release_partial(self, partial):
+        """
+        Release partial download file acquired with __acquire_partial
+
+        Args:
+            partial (string): partial download filepath
+        """
+        with Download.__partial_locks_lock:
+            Download.__partial_locks[partial].release()
+
+    def __download_from_url(self, url, check_sha1, check_sha256, check_md5, cache, segments, sources, extract, sparse):
+        """
+        Download specified url once partial download file is acquired. See download_from_url for arguments
+
+        Returns:
+            string: downloaded filepath or None if error occured
+        """
+        download_uuid = str(uuid.uuid4())
+
+        #prepare checksum computed during download
+        algorithms = []
+        if check_sha1:
+            algorithms.append(Checksum.ALGORITHM_SHA1)
+        if check_sha256:
+            algorithms.append(Checksum.ALGORITHM_SHA256)
+        if check_md5:
+            algorithms.append(Checksum.ALGORITHM_MD5)
+        if cache and Checksum.ALGORITHM_SHA256 not in algorithms:
+            #cache is content addressed
+            algorithms.append(Checksum.ALGORITHM_SHA256)
+        self.checksum = Checksum(algorithms)
+        self.__hashed_size = 0
+
+        #check if file is cached
+        cached = self.cache_index.find_by_url(url) if cache else None
+        if cached:
+            #file cached, return it
+            self.logger.debug('Return cached file (%s)' % cached['filepath'])
+            self.download = cached['filepath']
+            self.__status_callback(self.STATUS_DONE, cached['size'], 100)
+            return self.download
+
+        #download file (using range requests if server supports it)
+        self.cache_index.add_partial(self.download)
+        self.extractor = None
+        self.blockmap = None
+        self.raw = None
+        if extract:
+            try:
+                self.__open_extractor(sparse)
+            except:
+                self.logger.exception('Unable to create file:')
+                self.__close_extractor(delete=True)
+        infos = self.__probe_url(url)
+
+        #select fastest source
+        self.sources = SourceSelector(self.http)
+        ranked = self.sources.probe(list(sources) + [url], infos['size'] or None) if sources else []
+        fallback_url = None
+        if len(ranked)>0:
+            self.logger.info('Download "%s" from "%s"' % (url, ranked[0]['url']))
+            if infos['ranges']:
+                #origin is always kept as last resort, even if its probe failed
+                self.sources.add_url(url)
+            else:
+                #origin cannot serve range requests, it is kept as last resort for a single stream download
+                fallback_url = url
+            if not infos['ranges'] or not infos['size']:
+                #origin does not support range requests (or is unreachable) but alternative sources do
+                infos = {
+                    'ranges': True,
+                    'size': ranked[0]['size'],
+                    'etag': None,
+                    'lastmodified': None,
+                }
+        else:
+            self.sources.set_urls([url])
+
+        if infos['ranges'] and infos['size']>0:
+            sizes = self.__download_ranges(url, infos, segments)
+            if sizes is None and fallback_url and self.status==self.STATUS_ERROR_NETWORK and not self.__cancel:
+                self.logger.warning('All alternative sources failed, download "%s" using single stream' % fallback_url)
+                #single stream download cannot be resumed
+                infos['ranges'] = False
+                sizes = self.__download_fallback(fallback_url, algorithms, extract, sparse)
+        else:
+            self.logger.debug('Download file using single stream')
+            sizes = self.__download_single(self.sources.get_url())
+
+        self.__close_extractor()
+        if sizes is None:
+            #error occured, status already sent. Keep partial download only if it can be resumed
+            #(archive is extracted again from beginning when download is resumed)
+            if self.status!=self.STATUS_ERROR_NETWORK or not infos['ranges']:
+                self.__delete_partial()
+            else:
+                self.__close_extractor(delete=True)
+            return None
+        (downloaded_size, file_size) = sizes
+
         #file size
         if downloaded_size==file_size:
             self.logger.debug('File size is valid')
         else:
             self.logger.error('Invalid downloaded size %d instead of %d' % (downloaded_size, file_size))
+            self.__delete_partial()
             self.status = self.STATUS_ERROR_INVALIDSIZE
             self.__status_callback(self.status, downloaded_size, self.percent)
             return None
@@ -342,15 +997,15 @@ class Download():
         checksum_computed = None
         checksum_provided = None
         if check_sha1:
-            checksum_computed = self.generate_sha1(self.download)
+            checksum_computed = self.checksum.hexdigest(Checksum.ALGORITHM_SHA1)
             checksum_provided = check_sha1
             self.logger.debug('SHA1 for %s: %s' % (self.download, checksum_computed))
         elif check_sha256:
-            checksum_computed = self.generate_sha256(self.download)
+            checksum_computed = self.checksum.hexdigest(Checksum.ALGORITHM_SHA256)
             checksum_provided = check_sha256
             self.logger.debug('SHA256 for %s: %s' % (self.download, checksum_computed))
         elif check_md5:
-            checksum_computed = self.generate_md5(self.download)
+            checksum_computed = self.checksum.hexdigest(Checksum.ALGORITHM_MD5)
             checksum_provided = check_md5
             self.logger.debug('MD5 for %s: %s' % (self.download, checksum_computed))
         if checksum_provided is not None:
@@ -358,23 +1013,42 @@ class Download():
                 self.logger.debug('Checksum is valid')
             else:
                 self.logger.error('Checksum from downloaded file is invalid (computed=%s provided=%s)' % (checksum_computed, checksum_provided))
+                self.__delete_partial()
                 self.status = self.STATUS_ERROR_BADCHECKSUM
                 self.__status_callback(self.status, file_size, self.percent)
                 return None
         else:
             self.logger.debug('No checksum to verify :(')
 
+        #keep extracted file instead of archive
+        filepath = self.download
+        sha256 = self.checksum.hexdigest(Checksum.ALGORITHM_SHA256)
+        source_sha256 = None
+        blockmap = None
+        if self.extractor:
+            if self.extractor.is_done():
+                self.logger.debug('Archive member "%s" extracted to "%s"' % (self.extractor.filename, self.raw))
+                filepath = self.raw
+                source_sha256 = sha256
+                sha256 = self.extractor.checksum.hexdigest(Checksum.ALGORITHM_SHA256)
+                blockmap = self.blockmap
+            else:
+                self.logger.warning('Archive "%s" was not fully extracted, archive is kept' % self.download)
+                self.__close_extractor(delete=True)
+
         #rename file
-        if not cache:
-            #no cache, rename file with download prefix
-            download = os.path.join(self.temp_dir, '%s_%s' % (self.DOWNLOAD_FILE_PREFIX, download_uuid))
-            self.logger.debug('Cache disabled, rename download to "%s"', download)
-        else:
-            #cache file, rename file with cache prefix
-            download = os.path.join(self.cache_dir, '%s_%s' % (self.CACHED_FILE_PREFIX, cached_filename))
-            self.logger.debug('Cache enabled, rename download to "%s"', download)
         try:
-            shutil.move(self.download, download)
+            if not cache:
+                #no cache, rename file with download prefix
+                download = os.path.join(self.temp_dir, '%s_%s' % (self.DOWNLOAD_FILE_PREFIX, download_uuid))
+                self.logger.debug('Cache disabled, rename download to "%s"', download)
+                shutil.move(filepath, download)
+            else:
+                #cache file, move it to content addressed cache
+                entry = self.cache_index.add(url, self.__get_filename_from_url(url), filepath, sha256, source_sha256, blockmap)
+                download = entry['filepath']
+                self.logger.debug('Cache enabled, download cached to "%s"', download)
+            self.__delete_partial()
             self.download = download
         except:
             self.logger.exception(u'Unable to rename downloaded file:')
@@ -388,54 +1062,22 @@ class Download():
 
         return self.download
 
-    def __encode_cached_filename_by_url(self, url):
+    def __get_filename_from_url(self, url):
         """
-        Return cached filename based on url
+        Return filename based on url
 
         Args:
             url (string): file url to download
 
         Return:
-            string: cached filename
+            string: filename
         """
         if not url or len(url)==0:
             raise Exception('Invalid url "%s" specified' % url)
 
         #consider last part of url as filename
         url_parsed = urllib3.util.parse_url(url)
-        filename = url_parsed.path.split(u'/')[-1]
-
-        #encode filename for safety
-        safe_filename = base64.b16encode(filename.encode('utf-8')).decode('utf-8')
-
-        return safe_filename
-
-    def __encode_cached_filename_by_filename(self, filename):
-        """
-        Return cached filename based on real filename
-
-        Args:
-            filename (string): filename to encode
-
-        Return:
-            string: cached filename
-        """
-        #encode filename for safety
-        safe_filename = base64.b16encode(filename.encode('utf-8')).decode('utf-8')
-
-        return safe_filename
-
-    def __decode_cached_filename(self, filename):
-        """
-        Return decoded cached filename
-
-        Args:
-            filename (string): filename to decode
-
-        Returns:
-            string: decoded filename
-        """
-        return base64.b16decode(filename).decode('utf-8')
+        return url_parsed.path.split(u'/')[-1]
 
 
 #last_percent = 0
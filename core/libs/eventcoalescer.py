@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import time
+import gevent
+from gevent import monkey
+
+class EventCoalescer():
+    """
+    UI events coalescer. Some events are sent at high frequency (install status on each percent change...)
+    while only latest one is useful to ui: such events are published at most once per window, latest
+    event data wins.
+
+    First event of a window is published immediately, next ones are delayed to end of window so last
+    event (end of install for example) is always published.
+
+    Events can be pushed from any thread (async commands and flash I/O run in pool threads): an event
+    pushed from another thread is handed to application (hub) thread, where windows are scheduled with
+    gevent timers and events are published. Coalescer state is only accessed from hub thread.
+    """
+
+    def __init__(self, publish_callback, windows=None):
+        """
+        Constructor. Must be called from application (hub) thread
+
+        Args:
+            publish_callback (function): function called to publish event. Params: event, data
+            windows (dict): coalescing window in seconds of each coalesced event (event name => window)
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.publish_callback = publish_callback
+        self.windows = windows or {}
+        self.__pending = {}
+        self.__last_publish = {}
+        self.__hub = gevent.get_hub()
+        #native thread id, greenlet id is returned by threading.get_ident when monkey patching is enabled
+        self.__get_ident = monkey.get_original('threading', 'get_ident')
+        self.__thread_id = self.__get_ident()
+
+    def push(self, event, data):
+        """
+        Push event. Event is published now or at end of its coalescing window. This function can be
+        called from any thread
+
+        Args:
+            event (string): event name
+            data (any): event data
+        """
+        if self.__get_ident()!=self.__thread_id:
+            #hub callbacks must not block, event is pushed from a new greenlet
+            self.__hub.loop.run_callback_threadsafe(gevent.spawn, self.__push, event, data)
+            return
+
+        self.__push(event, data)
+
+    def __push(self, event, data):
+        """
+        Push event from hub thread
+
+        Args:
+            event (string): event name
+            data (any): event data
+        """
+        window = self.windows.get(event)
+        if not window:
+            self.publish_callback(event, data)
+            return
+
+        if event in self.__pending:
+            #flush already scheduled, latest data wins
+            self.__pending[event]['data'] = data
+            return
+
+        elapsed = time.time() - self.__last_publish.get(event, 0)
+        if elapsed<window:
+            self.__pending[event] = {
+                'data': data,
+                'timer': gevent.spawn_later(window - elapsed, self.__flush, event),
+            }
+            return
+
+        self.__last_publish[event] = time.time()
+        self.publish_callback(event, data)
+
+    def __flush(self, event):
+        """
+        Publish pending event at end of its window
+
+        Args:
+            event (string): event name
+        """
+        pending = self.__pending.pop(event, None)
+        if pending is None:
+            return
+        self.__last_publish[event] = time.time()
+
+        try:
+            self.publish_callback(event, pending['data'])
+        except:
+            self.logger.exception('Error publishing event "%s":' % event)
+
+    def stop(self):
+        """
+        Cancel pending events
+        """
+        for pending in list(self.__pending.values()):
+            pending['timer'].kill(block=False)
+        self.__pending.clear()
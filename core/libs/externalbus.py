@@ -3,7 +3,8 @@ import zmq.green as zmq
 import json
 import logging
 import time
-from threading import Thread
+from threading import Thread, Event, Lock
+from queue import Queue, Empty, Full
 import uuid
 import binascii
 import os
@@ -240,6 +241,12 @@ class PyreBus(ExternalBus):
     Pyre is python implementation of ZeroMQ ZRE concept (https://rfc.zeromq.org/spec:36/ZRE/)
 
     This code is based on chat example (https://github.com/zeromq/pyre/blob/master/examples/chat.py)
+
+    Once started (see start), bus runs in its own I/O thread that drains all ready messages at each poll
+    wakeup: both sockets are read without blocking until they are empty, each one with a budget of
+    messages per iteration so a burst on a socket does not starve the other one. Received events are handed to bus owner through a bounded queue and callbacks are called by
+    dispatch function, in owner thread. When queue is full, received messages are dropped (bus keeps
+    polling) while peer connections and disconnections wait for room in queue.
     """
 
     BUS_NAME = 'CLEEP'
@@ -247,8 +254,10 @@ class PyreBus(ExternalBus):
     BUS_STOP = '$$STOP$$'
 
     POLL_TIMEOUT = 1000
+    EVENTS_QUEUE_SIZE = 1000
+    DRAIN_BUDGET = 100
 
-    def __init__(self, on_message_received, on_peer_connected, on_peer_disconnected, decode_bus_headers, debug_enabled, crash_report):
+    def __init__(self, on_message_received, on_peer_connected, on_peer_disconnected, decode_bus_headers, debug_enabled, crash_report, drain_budget=DRAIN_BUDGET):
         """
         Constructor
 
@@ -258,6 +267,7 @@ class PyreBus(ExternalBus):
             on_peer_disconnected (callback): function called when peer is disconnected
             debug_enabled (bool): True if debug is enabled
             crash_report (CrashReport): crash report instance
+            drain_budget (int): maximum number of messages read from a socket per iteration
         """
         ExternalBus.__init__(self, on_message_received, on_peer_connected, on_peer_disconnected, debug_enabled, crash_report)
         
@@ -276,6 +286,23 @@ class PyreBus(ExternalBus):
         self.pipe_in = None
         self.pipe_out = None
         self.__running = True
+        self.__stopped = Event()
+        self.__thread = None
+        self.__events = Queue(maxsize=self.EVENTS_QUEUE_SIZE)
+        self.dropped_messages = 0
+        self.__backlog = False
+        self.drain_budget = drain_budget
+        #metrics are updated by I/O thread and read by other threads
+        self.__metrics_lock = Lock()
+        self.__metrics = {
+            'iterations': 0,
+            'received': 0,
+            'sent': 0,
+            'lastbatch': 0,
+            'maxbatch': 0,
+            'budgetexhausted': 0,
+            'maxqueuedepth': 0,
+        }
 
     def get_mac_addresses(self):
         """
@@ -346,12 +373,99 @@ class PyreBus(ExternalBus):
         Stop bus
         """
         self.__running = False
+        self.__stopped.set()
 
         #send stop message to unblock pyre task
         if self.pipe_in is not None:
             self.logger.debug('Send STOP on pipe')
             self.pipe_in.send_string(json.dumps(self.BUS_STOP.encode('utf-8').decode('utf-8')))
 
+        #unblock dispatch waiting for an event. If queue is full, dispatch is not waiting and it checks
+        #stop event before processing events
+        try:
+            self.__events.put_nowait(None)
+        except Full:
+            pass
+
+    def start(self):
+        """
+        Start bus I/O thread. Bus must be configured. Received events must then be processed calling dispatch
+        """
+        if not self.__externalbus_configured:
+            raise Exception('Bus not configured. Please call configure function first')
+
+        self.__thread = Thread(target=self.run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __trigger(self, callback, *args, droppable=False):
+        """
+        Trigger callback. If I/O thread is running, callback is queued to be called by dispatch
+
+        Args:
+            callback (function): callback to trigger
+            args (list): callback arguments
+            droppable (bool): True if callback can be dropped when queue is full
+        """
+        if self.__thread is None:
+            callback(*args)
+            return
+
+        if droppable:
+            try:
+                self.__events.put_nowait((callback, args))
+            except Full:
+                self.dropped_messages += 1
+                self.logger.debug('Bus events queue is full, message dropped')
+            return
+
+        while self.__running:
+            try:
+                self.__events.put((callback, args), timeout=1.0)
+                return
+            except Full:
+                continue
+
+    def dispatch(self, timeout=None):
+        """
+        Call callbacks of events received by bus I/O thread, waiting for one to be received
+
+        Args:
+            timeout (float): maximum time to wait in seconds (None to wait until an event is received or bus is stopped)
+
+        Returns:
+            int: number of dispatched events
+        """
+        if self.__stopped.is_set():
+            return 0
+
+        try:
+            events = [self.__events.get(timeout=timeout)]
+        except Empty:
+            return 0
+        #process all queued events at once
+        while True:
+            try:
+                events.append(self.__events.get_nowait())
+            except Empty:
+                break
+
+        count = 0
+        for event in events:
+            if event is None or self.__stopped.is_set():
+                #bus stopped
+                break
+            (callback, args) = event
+            try:
+                callback(*args)
+                count += 1
+            except:
+                self.logger.exception('Exception occured in bus callback:')
+                if self.crash_report:
+                    self.crash_report.report_exception()
+
+        return count
+
     def configure(self, headers):
         """
         Configure bus
@@ -403,6 +517,26 @@ class PyreBus(ExternalBus):
         if not self.__running:
             self.node.stop()
 
+    def is_running(self):
+        """
+        Return True if bus is configured and not stopped, so events can be sent
+
+        Returns:
+            bool: True if bus is running
+        """
+        return self.__externalbus_configured and self.__running
+
+    def set_header(self, key, value):
+        """
+        Update node header. New value is only sent to peers that connect afterwards
+
+        Args:
+            key (string): header key
+            value (string): header value
+        """
+        if self.__externalbus_configured:
+            self.node.set_header(key, value)
+
     def run_once(self):
         """
         Run pyre bus once
@@ -417,7 +551,8 @@ class PyreBus(ExternalBus):
 
         try:
             #self.logger.debug(u'Polling...')
-            items = dict(self.poller.poll(self.POLL_TIMEOUT))
+            #messages left by previous iteration are processed without waiting
+            items = dict(self.poller.poll(0 if self.__backlog else self.POLL_TIMEOUT))
         except KeyboardInterrupt:
             #stop requested by user
             self.logger.debug(u'Stop Pyre bus')
@@ -425,101 +560,186 @@ class PyreBus(ExternalBus):
             return False
         except:
             self.logger.exception('Exception occured durring externalbus polling:')
+            items = {}
 
+        self.__backlog = False
+        sent = 0
+        received = 0
         if self.pipe_out in items and items[self.pipe_out]==zmq.POLLIN:
-            #message to send
-            data = self.pipe_out.recv()
-            self.logger.debug(u'Raw data received on pipe: %s' % data)
-            message = json.loads(data.decode(u'utf-8'))
-
-            #stop node
-            if message==self.BUS_STOP or not self.__running:
-                self.logger.debug(u'Stop Pyre bus')
-                self.node.stop()
-                #return false to allow 'run' function to end infinite loop
-                return False
-
-            #send message
-            message = ExternalBusMessage(None, message)
-            self.logger.debug('Send message: %s' % message.to_reduced_dict())
-            if message.to is not None:
-                #whisper message
-                self.node.whisper(uuid.UUID(message.to), json.dumps(message.to_reduced_dict()).encode('utf-8'))
-            else:
-                #shout message
-                self.node.shout(self.BUS_GROUP, json.dumps(message.to_reduced_dict()).encode('utf-8'))
-
-        elif self.node_socket in items and items[self.node_socket]==zmq.POLLIN:
-            #message received
-            data = self.node.recv()
-            data_type = data.pop(0).decode('utf-8')
-            data_peer = uuid.UUID(bytes=data.pop(0))
-            data_name = data.pop(0).decode('utf-8')
-            self.logger.debug('type=%s peer=%s name=%s' % (data_type, data_peer, data_name))
-
-            if data_type=='SHOUT' or data_type=='WHISPER':
-                #message received, decode it and trigger callback
-                data_group = data.pop(0).decode('utf-8')
-
-                #check message group
-                if data_group!=self.BUS_GROUP:
-                    #invalid group?!?
-                    self.logger.error('Invalid message group received (%s instaead of %s)' % (data_group, self.BUS_GROUP))
-
-                #trigger message received callback
-                try:
-                    data_content = data.pop(0)
-                    self.logger.debug('Raw data received on bus: %s' % data_content)
-                    message = json.loads(data_content.decode(u'utf-8'))
-                    peer_infos = self.get_peer_infos(data_peer)
-                    self.on_message_received(ExternalBusMessage(peer_infos, message))
-                except:
-                    self.logger.exception('Unable to parse message:')
-
-            elif data_type=='ENTER':
-                #new peer connected
-                self.logger.debug('New peer connected: peer=%s name=%s' % (data_peer, data_name))
-                if data_name==self.BUS_NAME:
-                    #get headers
-                    headers = json.loads(data.pop(0).decode('utf-8'))
-                    self.logger.debug('header=%s' % headers)
-
-                    #get peer ip
-                    self.logger.debug('Peer endpoint: %s' % self.node.peer_address(data_peer))
-                    peer_endpoint = urlparse(self.node.peer_address(data_peer))
-
-                    #add new peer
-                    try:
-                        #decode headers
-                        infos = self.decode_bus_headers(headers)
-
-                        #fill with some extra infos
-                        infos[u'id'] = str(data_peer)
-                        infos[u'ip'] = peer_endpoint.hostname
-
-                        #save peer and trigger callback
-                        self._add_peer(data_peer, infos)
-                        self.on_peer_connected(str(data_peer), infos)
-                    except:
-                        self.logger.exception('Unable to add new peer:')
-
-                else:
-                    #invalid peer
-                    self.logger.debug('Invalid peer connected: peer=%s name=%s' % (data_peer, data_name))
-
-            elif data_type=='EXIT':
-                #peer disconnected
-                self.logger.debug('Peer disconnected: peer=%s' % data_peer)
-                self._remove_peer(data_peer)
-                if self.on_peer_disconnected:
-                    self.on_peer_disconnected(str(data_peer))
+            #messages to send
+            for data in self.__drain(self.pipe_out.recv):
+                sent += 1
+                if not self.__process_pipe_message(data):
+                    #return false to allow 'run' function to end infinite loop
+                    return False
+
+        if self.node_socket in items and items[self.node_socket]==zmq.POLLIN:
+            #messages received
+            for data in self.__drain(self.node_socket.recv_multipart):
+                received += 1
+                self.__process_node_message(data)
+
+        batch = sent + received
+        with self.__metrics_lock:
+            self.__metrics['iterations'] += 1
+            self.__metrics['sent'] += sent
+            self.__metrics['received'] += received
+            self.__metrics['lastbatch'] = batch
+            self.__metrics['maxbatch'] = max(batch, self.__metrics['maxbatch'])
+            self.__metrics['maxqueuedepth'] = max(self.__events.qsize(), self.__metrics['maxqueuedepth'])
+
+        return True
+
+    def __drain(self, recv):
+        """
+        Read socket without blocking until it is empty or drain budget is exhausted
+
+        Args:
+            recv (function): socket receive function
+
+        Returns:
+            generator: received messages
+        """
+        for _ in range(self.drain_budget):
+            try:
+                yield recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+        #socket may still have messages
+        self.__backlog = True
+        with self.__metrics_lock:
+            self.__metrics['budgetexhausted'] += 1
+
+    def get_metrics(self):
+        """
+        Return bus I/O metrics
+
+        Returns:
+            dict: metrics::
+                {
+                    iterations (int): number of poll iterations
+                    received (int): number of messages received from node
+                    sent (int): number of messages sent to node
+                    lastbatch (int): number of messages processed during last iteration
+                    maxbatch (int): maximum number of messages processed during an iteration
+                    budgetexhausted (int): number of times a socket still had messages at end of its budget
+                    backlog (bool): True if messages were left in sockets by last iteration
+                    queuedepth (int): number of events waiting to be dispatched
+                    maxqueuedepth (int): maximum number of events waiting to be dispatched
+                    dropped (int): number of messages dropped because events queue was full
+                }
+        """
+        with self.__metrics_lock:
+            metrics = dict(self.__metrics)
+        metrics.update({
+            'backlog': self.__backlog,
+            'queuedepth': self.__events.qsize(),
+            'dropped': self.dropped_messages,
+        })
+
+        return metrics
+
+    def __process_pipe_message(self, data):
+        """
+        Process message to send received on pipe
+
+        Args:
+            data (bytes): message
+
+        Returns:
+            bool: False if bus must be stopped
+        """
+        self.logger.debug(u'Raw data received on pipe: %s' % data)
+        message = json.loads(data.decode(u'utf-8'))
+
+        #stop node
+        if message==self.BUS_STOP or not self.__running:
+            self.logger.debug(u'Stop Pyre bus')
+            self.node.stop()
+            return False
+
+        #send message
+        message = ExternalBusMessage(None, message)
+        self.logger.debug('Send message: %s' % message.to_reduced_dict())
+        if message.to is not None:
+            #whisper message
+            self.node.whisper(uuid.UUID(message.to), json.dumps(message.to_reduced_dict()).encode('utf-8'))
         else:
-            #timeout occured
-            #self.logger.debug(' polling timeout')
-            pass
+            #shout message
+            self.node.shout(self.BUS_GROUP, json.dumps(message.to_reduced_dict()).encode('utf-8'))
 
         return True
 
+    def __process_node_message(self, data):
+        """
+        Process message received on node socket
+
+        Args:
+            data (list): message frames
+        """
+        data_type = data.pop(0).decode('utf-8')
+        data_peer = uuid.UUID(bytes=data.pop(0))
+        data_name = data.pop(0).decode('utf-8')
+        self.logger.debug('type=%s peer=%s name=%s' % (data_type, data_peer, data_name))
+
+        if data_type=='SHOUT' or data_type=='WHISPER':
+            #message received, decode it and trigger callback
+            data_group = data.pop(0).decode('utf-8')
+
+            #check message group
+            if data_group!=self.BUS_GROUP:
+                #invalid group?!?
+                self.logger.error('Invalid message group received (%s instaead of %s)' % (data_group, self.BUS_GROUP))
+
+            #trigger message received callback
+            try:
+                data_content = data.pop(0)
+                self.logger.debug('Raw data received on bus: %s' % data_content)
+                message = json.loads(data_content.decode(u'utf-8'))
+                peer_infos = self.get_peer_infos(data_peer)
+                self.__trigger(self.on_message_received, ExternalBusMessage(peer_infos, message), droppable=True)
+            except:
+                self.logger.exception('Unable to parse message:')
+
+        elif data_type=='ENTER':
+            #new peer connected
+            self.logger.debug('New peer connected: peer=%s name=%s' % (data_peer, data_name))
+            if data_name==self.BUS_NAME:
+                #get headers
+                headers = json.loads(data.pop(0).decode('utf-8'))
+                self.logger.debug('header=%s' % headers)
+
+                #get peer ip
+                self.logger.debug('Peer endpoint: %s' % self.node.peer_address(data_peer))
+                peer_endpoint = urlparse(self.node.peer_address(data_peer))
+
+                #add new peer
+                try:
+                    #decode headers
+                    infos = self.decode_bus_headers(headers)
+
+                    #fill with some extra infos
+                    infos[u'id'] = str(data_peer)
+                    infos[u'ip'] = peer_endpoint.hostname
+
+                    #save peer and trigger callback
+                    self._add_peer(data_peer, infos)
+                    self.__trigger(self.on_peer_connected, str(data_peer), infos)
+                except:
+                    self.logger.exception('Unable to add new peer:')
+
+            else:
+                #invalid peer
+                self.logger.debug('Invalid peer connected: peer=%s name=%s' % (data_peer, data_name))
+
+        elif data_type=='EXIT':
+            #peer disconnected
+            self.logger.debug('Peer disconnected: peer=%s' % data_peer)
+            self._remove_peer(data_peer)
+            if self.on_peer_disconnected:
+                self.__trigger(self.on_peer_disconnected, str(data_peer))
+
     def run(self):
         """
         Run pyre bus in infinite loop (blocking)
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import mmap
+import errno
+import stat
+import hashlib
+import fcntl
+import struct
+from collections import deque
+from gevent.threadpool import ThreadPool
+from core.libs.progress import Progress
+
+class Flasher():
+    """
+    Native image flasher (Linux only). Image is written to target (block device or plain file) with
+    large aligned buffers opened with O_DIRECT, so page cache is bypassed and written data is not
+    kept in memory. Reads and writes are double-buffered: next chunk is read (and hashed) while
+    previous one is written. Reads and writes are blocking system calls, they are executed in a
+    pool of real OS threads (gevent threadpool), so they overlap and do not freeze the application
+    while flash is driven from a greenlet. A hash of each written chunk is recorded while flashing,
+    so drive content can be validated afterwards (see Validator).
+
+    If a block map is specified (see SparseFile.get_blockmap) only populated blocks are read from image.
+    On a plain file target, file is truncated to image size so zeroed blocks are holes and are not
+    written. On a block device zeroed blocks must overwrite previous content: they are zeroed with
+    BLKZEROOUT (kernel guarantees zeroes, offloaded to drive when supported) or written from a zeroed
+    buffer if device does not support it. They are hashed and validated as well.
+    """
+
+    BUFFER_SIZE = 4194304
+    BUFFERS = 2
+    ALIGNMENT = 4096
+    HASH_ALGORITHM = 'sha256'
+    BLKZEROOUT = 0x127f
+
+    STATUS_IDLE = 0
+    STATUS_FLASHING = 1
+    STATUS_DONE = 2
+    STATUS_ERROR = 3
+    STATUS_CANCELED = 4
+
+    def __init__(self, status_callback=None):
+        """
+        Constructor
+
+        Args:
+            status_callback (function): status callback. Params: status, written, percent
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.status_callback = status_callback
+        self.status = self.STATUS_IDLE
+        self.progress = Progress()
+        self.written = 0
+        self.error = None
+        self.hashes = []
+        self.__cancel = False
+        self.__zeros = None
+        self.__zeroout = True
+        self.__zero_hashes = {}
+
+    @staticmethod
+    def is_supported():
+        """
+        Return True if native flasher can be used on current system
+
+        Returns:
+            bool: True if supported
+        """
+        return hasattr(os, 'O_DIRECT') and hasattr(os, 'preadv')
+
+    def cancel(self):
+        """
+        Cancel flash
+        """
+        self.__cancel = True
+
+    def __status_callback(self):
+        """
+        Call status callback if configured
+        """
+        if self.status_callback:
+            self.status_callback(self.status, self.written, self.progress.get_percent())
+
+    def get_chunks(self, size, blockmap=None, holes=False):
+        """
+        Return list of image chunks to write
+
+        Args:
+            size (int): image size
+            blockmap (dict): block map of image (None to write whole image)
+            holes (bool): also return chunks of zeroed blocks (they must be zeroed on target)
+
+        Returns:
+            list: list of (offset, length, populated) tuples ordered by offset. Length is at most BUFFER_SIZE.
+                  Chunks that are not populated are zeroed blocks that are not read from image
+        """
+        if blockmap:
+            block_size = blockmap['blocksize']
+            ranges = [(first * block_size, min(size, (last + 1) * block_size)) for first, last in blockmap['ranges']]
+        else:
+            ranges = [(0, size)]
+
+        #populated ranges and zeroed ranges between them
+        spans = []
+        position = 0
+        for start, end in ranges:
+            if holes and start>position:
+                spans.append((position, start, False))
+            spans.append((start, end, True))
+            position = end
+        if holes and position<size:
+            spans.append((position, size, False))
+
+        chunks = []
+        for start, end, populated in spans:
+            for offset in range(start, end, self.BUFFER_SIZE):
+                chunks.append((offset, min(self.BUFFER_SIZE, end - offset), populated))
+
+        return chunks
+
+    def get_hashmap(self):
+        """
+        Return hashes of chunks written during last flash
+
+        Returns:
+            dict: hash map::
+                {
+                    algorithm (string): hash algorithm
+                    chunks (list): list of written chunks [offset, length, hash] ordered by offset
+                }
+        """
+        return {
+            'algorithm': self.HASH_ALGORITHM,
+            'chunks': [list(chunk) for chunk in self.hashes],
+        }
+
+    def __is_device(self, target):
+        """
+        Return True if target is a block device
+
+        Args:
+            target (string): block device or file path
+
+        Returns:
+            bool: True if target is a block device
+        """
+        return os.path.exists(target) and stat.S_ISBLK(os.stat(target).st_mode)
+
+    def __open_target(self, target, size):
+        """
+        Open target for writing
+
+        Args:
+            target (string): block device or file path
+            size (int): image size
+
+        Returns:
+            tuple: (direct fd or None if O_DIRECT is not supported, buffered fd, True if target is a block device)
+        """
+        is_device = self.__is_device(target)
+        flags = os.O_WRONLY
+        if not is_device:
+            flags |= os.O_CREAT
+
+        fd = os.open(target, flags, 0o644)
+        if not is_device:
+            #skipped blocks must be holes in a plain file
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+        elif os.lseek(fd, 0, os.SEEK_END)<size:
+            os.close(fd)
+            raise Exception('Target "%s" is too small for image' % target)
+
+        try:
+            direct_fd = os.open(target, os.O_WRONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno!=errno.EINVAL:
+                os.close(fd)
+                raise
+            #filesystem does not support O_DIRECT (tmpfs for example)
+            self.logger.info('O_DIRECT not supported by target "%s", use buffered writes' % target)
+            direct_fd = None
+
+        return direct_fd, fd, is_device
+
+    def __read_chunk(self, fd, offset, length, buf):
+        """
+        Read and hash image chunk. This function is executed in a pool thread
+
+        Args:
+            fd (int): image file descriptor
+            offset (int): chunk offset
+            length (int): chunk length
+            buf (mmap): buffer to read chunk into (None for zeroed chunk that is not read)
+
+        Returns:
+            tuple: (offset, length, buffer)
+        """
+        if buf is None:
+            #zeroed blocks are not read
+            self.hashes.append([offset, length, self.__get_zero_hash(length)])
+            return offset, length, None
+
+        view = memoryview(buf)[:length]
+        read = 0
+        while read<length:
+            size = os.preadv(fd, [view[read:]], offset + read)
+            if size==0:
+                raise Exception('Unexpected end of image at offset %d' % (offset + read))
+            read += size
+        #hashlib releases GIL on large buffers, so hashing runs while previous chunk is written
+        self.hashes.append([offset, length, hashlib.new(self.HASH_ALGORITHM, view).hexdigest()])
+
+        return offset, length, buf
+
+    def __read_next_chunk(self, pool, fd, chunks, free_buffers):
+        """
+        Start reading next chunk in a pool thread
+
+        Args:
+            pool (ThreadPool): thread pool
+            fd (int): image file descriptor
+            chunks (deque): chunks left to read (see get_chunks)
+            free_buffers (list): free buffers
+
+        Returns:
+            AsyncResult: read result (see __read_chunk) or None if there is no chunk left
+        """
+        if len(chunks)==0:
+            return None
+
+        (offset, length, populated) = chunks.popleft()
+        return pool.spawn(self.__read_chunk, fd, offset, length, free_buffers.pop() if populated else None)
+
+    def __get_zero_hash(self, length):
+        """
+        Return hash of zeroed chunk
+
+        Args:
+            length (int): chunk length
+
+        Returns:
+            string: chunk hash
+        """
+        if length not in self.__zero_hashes:
+            self.__zero_hashes[length] = hashlib.new(self.HASH_ALGORITHM, bytes(length)).hexdigest()
+
+        return self.__zero_hashes[length]
+
+    def __zero_chunk(self, direct_fd, fd, offset, length):
+        """
+        Zero chunk of block device target. BLKZEROOUT is used if device supports it, zeroes are written otherwise
+
+        Args:
+            direct_fd (int): target file descriptor opened with O_DIRECT (None if not supported)
+            fd (int): buffered target file descriptor
+            offset (int): target offset
+            length (int): chunk length
+
+        Returns:
+            int: fd to use for next writes (see __write_chunk)
+        """
+        if self.__zeroout:
+            try:
+                fcntl.ioctl(fd, self.BLKZEROOUT, struct.pack('QQ', offset, length))
+                return direct_fd
+            except OSError as e:
+                self.logger.info('BLKZEROOUT not supported by target (%s), zeroes are written' % str(e))
+                self.__zeroout = False
+
+        return self.__write_chunk(direct_fd, fd, offset, memoryview(self.__zeros)[:length])
+
+    def __write_item(self, direct_fd, fd, item):
+        """
+        Write chunk read by __read_chunk to target. This function is executed in a pool thread
+
+        Args:
+            direct_fd (int): target file descriptor opened with O_DIRECT (None if not supported)
+            fd (int): buffered target file descriptor
+            item (tuple): chunk (offset, length, buffer). Chunk is zeroed if buffer is None
+
+        Returns:
+            int: fd to use for next writes (see __write_chunk)
+        """
+        (offset, length, buf) = item
+        if buf is None:
+            return self.__zero_chunk(direct_fd, fd, offset, length)
+
+        return self.__write_chunk(direct_fd, fd, offset, memoryview(buf)[:length])
+
+    def __end_write(self, writing, free_buffers):
+        """
+        Wait for end of chunk write and update progress
+
+        Args:
+            writing (tuple): (write result (AsyncResult), chunk (offset, length, buffer))
+            free_buffers (list): free buffers, chunk buffer is released in it
+
+        Returns:
+            int: fd to use for next writes (see __write_chunk)
+        """
+        (result, (_, length, buf)) = writing
+        direct_fd = result.get()
+        if buf is not None:
+            free_buffers.append(buf)
+
+        self.written += length
+        if self.progress.update(self.written):
+            self.__status_callback()
+
+        return direct_fd
+
+    def __write_chunk(self, direct_fd, fd, offset, view):
+        """
+        Write chunk to target. Unaligned tail (end of image) is written without O_DIRECT
+
+        Args:
+            direct_fd (int): target file descriptor opened with O_DIRECT (None if not supported)
+            fd (int): buffered target file descriptor
+            offset (int): target offset
+            view (memoryview): chunk data
+
+        Returns:
+            int: fd to use for next writes (O_DIRECT is disabled if target rejects it)
+        """
+        length = len(view)
+        aligned = length - length % self.ALIGNMENT if direct_fd is not None else 0
+        written = 0
+        while written<length:
+            if written<aligned:
+                try:
+                    written += os.pwrite(direct_fd, view[written:aligned], offset + written)
+                except OSError as e:
+                    if e.errno!=errno.EINVAL:
+                        raise
+                    #logical block size of target is bigger than alignment
+                    self.logger.info('O_DIRECT write rejected by target, use buffered writes')
+                    aligned = 0
+                    direct_fd = None
+            else:
+                written += os.pwrite(fd, view[written:], offset + written)
+
+        return direct_fd
+
+    def flash(self, image, target, blockmap=None):
+        """
+        Write image to target. This function is blocking
+
+        Args:
+            image (string): image filepath (raw image, not an archive)
+            target (string): block device or file path
+            blockmap (dict): block map of image to avoid reading (and writing on plain file) zeroed blocks
+                             (None to write whole image)
+
+        Returns:
+            bool: True if image was written successfully
+        """
+        self.__cancel = False
+        self.error = None
+        self.written = 0
+        self.hashes = []
+        size = os.path.getsize(image)
+        if blockmap and blockmap['size']!=size:
+            self.logger.warning('Block map does not match image "%s", whole image is written' % image)
+            blockmap = None
+        #zeroed blocks of a block device must overwrite its previous content
+        chunks = self.get_chunks(size, blockmap, holes=self.__is_device(target))
+        self.progress.reset(sum([length for _, length, _ in chunks]))
+        self.logger.info('Flash "%s" to "%s": %d/%d bytes to write' % (image, target, self.progress.total, size))
+
+        self.status = self.STATUS_FLASHING
+        self.__status_callback()
+
+        direct_fd = fd = image_fd = None
+        reading = writing = None
+        pool = ThreadPool(2)
+        try:
+            (direct_fd, fd, is_device) = pool.spawn(self.__open_target, target, size).get()
+            image_fd = os.open(image, os.O_RDONLY)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(image_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            #anonymous mmaps are page aligned, as required by O_DIRECT
+            free_buffers = [mmap.mmap(-1, self.BUFFER_SIZE) for _ in range(self.BUFFERS)]
+            self.__zeros = mmap.mmap(-1, self.BUFFER_SIZE)
+            self.__zeroout = True
+            pending = deque(chunks)
+            reading = self.__read_next_chunk(pool, image_fd, pending, free_buffers)
+            while reading is not None:
+                #wait for chunk read, then for end of previous chunk write to release its buffer
+                item = reading.get()
+                reading = None
+                if writing is not None:
+                    direct_fd = self.__end_write(writing, free_buffers)
+                    writing = None
+                if self.__cancel:
+                    break
+
+                #write chunk while next one is read
+                writing = (pool.spawn(self.__write_item, direct_fd, fd, item), item)
+                reading = self.__read_next_chunk(pool, image_fd, pending, free_buffers)
+            if writing is not None:
+                direct_fd = self.__end_write(writing, free_buffers)
+                writing = None
+
+            if not self.__cancel:
+                #flush device write cache
+                pool.spawn(os.fsync, direct_fd if direct_fd is not None else fd).get()
+                if is_device:
+                    pool.spawn(os.fsync, fd).get()
+
+        except Exception as e:
+            self.logger.exception('Error flashing "%s" to "%s":' % (image, target))
+            self.error = str(e)
+
+        finally:
+            #pool threads cannot be interrupted, wait for them before closing files
+            for result in (reading, writing[0] if writing else None):
+                if result is not None:
+                    result.wait()
+            for descriptor in (direct_fd, fd, image_fd):
+                if descriptor is not None:
+                    os.close(descriptor)
+            pool.kill()
+
+        if self.__cancel:
+            self.status = self.STATUS_CANCELED
+        elif self.error is not None:
+            self.status = self.STATUS_ERROR
+        else:
+            self.status = self.STATUS_DONE
+            self.progress.update(self.written)
+        self.__status_callback()
+        self.logger.info('Flash of "%s" terminated with status %d (%d bytes written)' % (image, self.status, self.written))
+
+        return self.status==self.STATUS_DONE
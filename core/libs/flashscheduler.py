@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import re
+from threading import Lock
+import gevent
+from gevent.event import Event
+from core.libs.flasher import Flasher
+from core.libs.validator import Validator
+
+class FlashScheduler():
+    """
+    Flash job scheduler. The same image is flashed (then validated) on several drives in parallel,
+    each drive having its own job with its own progress, cancel and error state.
+
+    Drives plugged on the same USB hub share its bandwidth, running too many jobs on the same hub makes
+    overall throughput collapse, so number of concurrent jobs is capped globally and per hub. Other jobs
+    are queued until a slot is released.
+
+    Each job runs in its own greenlet, while reads, writes and hashes of Flasher and Validator are
+    executed in OS threads: drives are really flashed in parallel and application keeps running.
+    Status callback is called from job greenlets, in application (hub) thread.
+    """
+
+    MAX_JOBS = 8
+    MAX_JOBS_PER_HUB = 2
+
+    JOB_QUEUED = 'queued'
+    JOB_FLASHING = 'flashing'
+    JOB_VALIDATING = 'validating'
+    JOB_DONE = 'done'
+    JOB_CANCELED = 'canceled'
+    JOB_ERROR = 'error'
+    JOB_MISMATCH = 'mismatch'
+    JOB_ENDED = (JOB_DONE, JOB_CANCELED, JOB_ERROR, JOB_MISMATCH)
+
+    SYS_BLOCK_PATH = '/sys/block'
+
+    def __init__(self, status_callback=None, max_jobs=MAX_JOBS, max_jobs_per_hub=MAX_JOBS_PER_HUB):
+        """
+        Constructor
+
+        Args:
+            status_callback (function): function called when a job status changes. Params: jobs (see get_jobs)
+            max_jobs (int): maximum number of concurrent jobs
+            max_jobs_per_hub (int): maximum number of concurrent jobs on the same USB hub
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.status_callback = status_callback
+        self.max_jobs = max_jobs
+        self.max_jobs_per_hub = max_jobs_per_hub
+        self.jobs = []
+        self.__workers = {}
+        self.__lock = Lock()
+        #set each time a job terminates or is canceled
+        self.__changed = Event()
+
+    @staticmethod
+    def get_drive_hub(drive):
+        """
+        Return USB hub drive is plugged on (Linux only)
+
+        Args:
+            drive (string): drive path (/dev/sdX)
+
+        Returns:
+            string: hub sysfs path or None if drive is not an USB drive
+        """
+        try:
+            #/sys/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1.4/2-1.4:1.0/host6/.../block/sdb
+            path = os.path.realpath(os.path.join(FlashScheduler.SYS_BLOCK_PATH, os.path.basename(drive)))
+            parts = path.split(os.sep)
+            devices = [index for index, part in enumerate(parts) if re.match(r'^\d+-\d+(\.\d+)*$', part)]
+            if len(devices)==0:
+                return None
+
+            #hub is parent of usb device (can be root hub)
+            return os.sep.join(parts[:devices[-1]])
+
+        except:
+            return None
+
+    def add_job(self, drive, image, blockmap=None, validate=True):
+        """
+        Add flash job
+
+        Args:
+            drive (string): drive path
+            image (string): image filepath
+            blockmap (dict): image block map (see Flasher.flash)
+            validate (bool): validate drive after flash
+
+        Returns:
+            dict: job (see get_jobs)
+        """
+        with self.__lock:
+            if drive in [job['drive'] for job in self.jobs]:
+                raise Exception('Drive "%s" is already scheduled' % drive)
+
+            job = {
+                'drive': drive,
+                'hub': self.get_drive_hub(drive),
+                'image': image,
+                'blockmap': blockmap,
+                'validate': validate,
+                'status': self.JOB_QUEUED,
+                'percent': 0,
+                'eta': None,
+                'throughput': 0,
+                'error': None,
+                'mismatchoffset': None,
+            }
+            self.jobs.append(job)
+            self.__workers[drive] = {
+                'cancel': False,
+                'flasher': None,
+                'validator': None,
+            }
+            self.logger.debug('Job added for drive "%s" (hub %s)' % (drive, job['hub']))
+
+            return self.__get_job(job)
+
+    def __get_job(self, job):
+        """
+        Return public copy of job
+
+        Args:
+            job (dict): internal job
+
+        Returns:
+            dict: job (see get_jobs)
+        """
+        return {
+            'drive': job['drive'],
+            'hub': job['hub'],
+            'status': job['status'],
+            'percent': job['percent'],
+            'eta': job['eta'],
+            'throughput': job['throughput'],
+            'error': job['error'],
+            'mismatchoffset': job['mismatchoffset'],
+        }
+
+    def get_jobs(self):
+        """
+        Return jobs
+
+        Returns:
+            list: list of jobs::
+                [
+                    {
+                        drive (string): drive path
+                        hub (string): USB hub of drive (None if not USB)
+                        status (string): job status (see JOB_XXX)
+                        percent (int): percent of current step (flash or validation)
+                        eta (int): remaining seconds of current step (None if unknown)
+                        throughput (int): current throughput in bytes/second
+                        error (string): error message (None if no error)
+                        mismatchoffset (int): offset of first invalid chunk if validation failed
+                    },
+                    ...
+                ]
+        """
+        with self.__lock:
+            return [self.__get_job(job) for job in self.jobs]
+
+    def cancel(self, drive=None):
+        """
+        Cancel job
+
+        Args:
+            drive (string): drive of job to cancel (None to cancel all jobs)
+        """
+        with self.__lock:
+            for job in self.jobs:
+                if drive is not None and job['drive']!=drive:
+                    continue
+                worker = self.__workers[job['drive']]
+                worker['cancel'] = True
+                for engine in (worker['flasher'], worker['validator']):
+                    if engine:
+                        engine.cancel()
+                if job['status']==self.JOB_QUEUED:
+                    job['status'] = self.JOB_CANCELED
+            self.__changed.set()
+
+        self.__status_callback()
+
+    def __status_callback(self):
+        """
+        Call status callback if configured
+        """
+        if self.status_callback:
+            self.status_callback(self.get_jobs())
+
+    def __update_job(self, job, status, engine, percent):
+        """
+        Update job progress from flasher or validator
+
+        Args:
+            job (dict): job
+            status (string): job status
+            engine (Flasher|Validator): running engine
+            percent (int): engine percent
+        """
+        infos = engine.progress.get_infos()
+        with self.__lock:
+            job['status'] = status
+            job['percent'] = percent
+            job['eta'] = infos['eta']
+            job['throughput'] = infos['instantrate']
+
+        self.__status_callback()
+
+    def __run_job(self, job):
+        """
+        Job greenlet: flash then validate drive
+
+        Args:
+            job (dict): job
+        """
+        worker = self.__workers[job['drive']]
+        status = self.JOB_ERROR
+        try:
+            flasher = Flasher(lambda _status, _written, percent: self.__update_job(job, self.JOB_FLASHING, flasher, percent))
+            with self.__lock:
+                worker['flasher'] = flasher
+            if worker['cancel']:
+                flasher.cancel()
+            if not flasher.flash(job['image'], job['drive'], job['blockmap']):
+                status = self.JOB_CANCELED if worker['cancel'] else self.JOB_ERROR
+                job['error'] = flasher.error
+                return
+
+            if job['validate']:
+                validator = Validator(lambda _status, _checked, percent: self.__update_job(job, self.JOB_VALIDATING, validator, percent))
+                with self.__lock:
+                    worker['validator'] = validator
+                if worker['cancel']:
+                    validator.cancel()
+                if not validator.validate(job['drive'], flasher.get_hashmap()):
+                    result = validator.get_result()
+                    job['mismatchoffset'] = result['mismatchoffset']
+                    job['error'] = result['error']
+                    if result['mismatchoffset'] is not None:
+                        status = self.JOB_MISMATCH
+                    else:
+                        status = self.JOB_CANCELED if worker['cancel'] else self.JOB_ERROR
+                    return
+
+            status = self.JOB_DONE
+
+        except Exception as e:
+            self.logger.exception('Error during job of drive "%s":' % job['drive'])
+            job['error'] = str(e)
+
+        finally:
+            with self.__lock:
+                job['status'] = status
+                if status==self.JOB_DONE:
+                    job['percent'] = 100
+                worker['flasher'] = None
+                worker['validator'] = None
+                self.__changed.set()
+            self.logger.info('Job of drive "%s" terminated with status "%s"' % (job['drive'], status))
+            self.__status_callback()
+
+    def __start_jobs(self):
+        """
+        Start queued jobs that fit in free slots. Lock must be acquired
+
+        Returns:
+            int: number of running jobs
+        """
+        running = [job for job in self.jobs if job['status'] in (self.JOB_FLASHING, self.JOB_VALIDATING)]
+        for job in self.jobs:
+            if job['status']!=self.JOB_QUEUED or len(running)>=self.max_jobs:
+                continue
+            if job['hub'] is not None and len([item for item in running if item['hub']==job['hub']])>=self.max_jobs_per_hub:
+                continue
+
+            job['status'] = self.JOB_FLASHING
+            running.append(job)
+            gevent.spawn(self.__run_job, job)
+
+        return len(running)
+
+    def run(self):
+        """
+        Run all jobs and wait for their end. This function is blocking
+
+        Returns:
+            bool: True if all jobs succeed
+        """
+        while True:
+            with self.__lock:
+                self.__changed.clear()
+                running = self.__start_jobs()
+                queued = len([job for job in self.jobs if job['status']==self.JOB_QUEUED])
+            if running==0 and queued==0:
+                break
+            self.__changed.wait()
+
+        with self.__lock:
+            succeed = all([job['status']==self.JOB_DONE for job in self.jobs])
+
+        self.logger.info('All jobs terminated: %s' % [(job['drive'], job['status']) for job in self.jobs])
+        return succeed
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import json
+import time
+import uuid
+from threading import Condition
+
+class InstallQueue():
+    """
+    Persisted install job queue. Each install request is a job stored in a json file of config directory,
+    so queued and interrupted installs survive a restart.
+
+    Jobs are processed in order by a single consumer that waits on a condition, so it is woken up as soon
+    as a job is added. Drives may have been replaced while application was stopped, so jobs waiting or
+    interrupted during download are paused at restart: user must confirm them before they are queued
+    again (download is resumed from its journal). A job interrupted during flash is set in error: drive
+    content is inconsistent and user must install it again.
+
+    Wifi configurations are only kept in memory, they are never written to disk. A paused job loses
+    its wifi configuration, it can be specified again when job is resumed.
+    """
+
+    QUEUE_FILENAME = 'installqueue.json'
+    MAX_ENDED_JOBS = 20
+
+    JOB_QUEUED = 'queued'
+    JOB_PAUSED = 'paused'
+    JOB_DOWNLOADING = 'downloading'
+    JOB_FLASHING = 'flashing'
+    JOB_VALIDATING = 'validating'
+    JOB_DONE = 'done'
+    JOB_CANCELED = 'canceled'
+    JOB_ERROR = 'error'
+    JOB_RUNNING = (JOB_DOWNLOADING, JOB_FLASHING, JOB_VALIDATING)
+    JOB_ENDED = (JOB_DONE, JOB_CANCELED, JOB_ERROR)
+
+    def __init__(self, config_dir):
+        """
+        Constructor
+
+        Args:
+            config_dir (string): directory to store queue file in
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.queue_path = os.path.join(config_dir, self.QUEUE_FILENAME)
+        self.jobs = []
+        self.__condition = Condition()
+
+        self.__load()
+
+    def __load(self):
+        """
+        Load queue from disk and recover jobs interrupted by a restart
+        """
+        with self.__condition:
+            if not os.path.exists(self.queue_path):
+                return
+
+            try:
+                with open(self.queue_path, 'r') as f:
+                    self.jobs = json.load(f)['jobs']
+            except:
+                self.logger.exception('Invalid install queue "%s", it is reset' % self.queue_path)
+                self.jobs = []
+
+            for job in self.jobs:
+                job['wifi'] = None
+                if job['status'] in (self.JOB_QUEUED, self.JOB_DOWNLOADING):
+                    self.logger.info('Install job %s was interrupted by application restart, it must be confirmed' % job['id'])
+                    job['status'] = self.JOB_PAUSED
+                elif job['status'] in self.JOB_RUNNING:
+                    self.logger.warning('Install job %s was interrupted during flash, drives must be installed again' % job['id'])
+                    job['status'] = self.JOB_ERROR
+                    job['error'] = 'Install interrupted by application restart'
+
+            self.__save()
+
+    def __save(self):
+        """
+        Save queue to disk. Condition must be acquired
+        """
+        try:
+            #keep only last ended jobs
+            ended = [job for job in self.jobs if job['status'] in self.JOB_ENDED]
+            for job in ended[:-self.MAX_ENDED_JOBS]:
+                self.jobs.remove(job)
+
+            #wifi passwords are never written to disk, queue is private anyway
+            queue_tmp = '%s.tmp' % self.queue_path
+            fd = os.open(queue_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'jobs': [{key: value for key, value in job.items() if key!='wifi'} for job in self.jobs],
+                }, f)
+            os.replace(queue_tmp, self.queue_path)
+        except:
+            self.logger.exception('Unable to save install queue "%s":' % self.queue_path)
+
+    def add(self, url, drives, wifi=None, sha256=None, drives_infos=None):
+        """
+        Add install job at end of queue
+
+        Args:
+            url (string): url of file to install
+            drives (list): drives to install
+            wifi (dict): wifi configuration (see Install.start_install)
+            sha256 (string): file checksum
+            drives_infos (dict): identity of drives when job is added, to check they were not replaced
+                                 before job starts (drive path => {desc, size})
+
+        Returns:
+            dict: added job (see get_jobs)
+        """
+        with self.__condition:
+            job = {
+                'id': str(uuid.uuid4()),
+                'url': url,
+                'drives': list(drives),
+                'wifi': wifi,
+                'haswifi': bool(wifi),
+                'drivesinfos': drives_infos or {},
+                'sha256': sha256,
+                'status': self.JOB_QUEUED,
+                'error': None,
+                'timestamp': int(time.time()),
+                'lastupdate': int(time.time()),
+            }
+            self.jobs.append(job)
+            self.__save()
+            self.logger.debug('Install job added: %s' % job['id'])
+            self.__condition.notify_all()
+
+            return dict(job)
+
+    def get_jobs(self):
+        """
+        Return all jobs (wifi configurations are not returned)
+
+        Returns:
+            list: list of jobs::
+                [
+                    {
+                        id (string): job id
+                        url (string): url of file to install
+                        drives (list): drives to install
+                        haswifi (bool): True if wifi configuration was specified (it is lost if job is paused)
+                        drivesinfos (dict): identity of drives when job was added (drive path => {desc, size})
+                        sha256 (string): file checksum (can be None)
+                        status (string): job status (see JOB_XXX)
+                        error (string): error message (None if no error)
+                        timestamp (int): time job was added
+                        lastupdate (int): time of last job status change
+                    },
+                    ...
+                ]
+        """
+        with self.__condition:
+            return [{key: value for key, value in job.items() if key!='wifi'} for job in self.jobs]
+
+    def get_job(self, job_id):
+        """
+        Return job
+
+        Args:
+            job_id (string): job id
+
+        Returns:
+            dict: job (with wifi configuration) or None if job does not exist
+        """
+        with self.__condition:
+            job = self.__find(job_id)
+            return dict(job) if job else None
+
+    def __find(self, job_id):
+        """
+        Return job. Condition must be acquired
+
+        Args:
+            job_id (string): job id
+
+        Returns:
+            dict: job or None if not found
+        """
+        return next((job for job in self.jobs if job['id']==job_id), None)
+
+    def set_status(self, job_id, status, error=None):
+        """
+        Set job status. Queue is saved only if status changed
+
+        Args:
+            job_id (string): job id
+            status (string): job status (see JOB_XXX)
+            error (string): error message
+        """
+        with self.__condition:
+            job = self.__find(job_id)
+            if job is None or (job['status']==status and job['error']==error):
+                return
+
+            self.logger.debug('Install job %s status: %s' % (job_id, status))
+            job['status'] = status
+            job['error'] = error
+            job['lastupdate'] = int(time.time())
+            if status in self.JOB_ENDED:
+                #wifi config is not needed anymore
+                job['wifi'] = None
+            self.__save()
+            self.__condition.notify_all()
+
+    def resume(self, job_id, wifi=None):
+        """
+        Queue again job paused by application restart
+
+        Args:
+            job_id (string): job id
+            wifi (dict): wifi configuration (see Install.start_install), None to install without wifi
+        """
+        with self.__condition:
+            job = self.__find(job_id)
+            if job is None:
+                raise Exception('Install job "%s" does not exist' % job_id)
+            if job['status']!=self.JOB_PAUSED:
+                raise Exception('Install job "%s" is not paused' % job_id)
+
+            self.logger.debug('Install job %s resumed' % job_id)
+            job['status'] = self.JOB_QUEUED
+            job['wifi'] = wifi
+            job['haswifi'] = bool(wifi)
+            job['lastupdate'] = int(time.time())
+            self.__save()
+            self.__condition.notify_all()
+
+    def remove(self, job_id):
+        """
+        Remove queued, paused or ended job. Running job must be canceled instead
+
+        Args:
+            job_id (string): job id
+        """
+        with self.__condition:
+            job = self.__find(job_id)
+            if job is None:
+                raise Exception('Install job "%s" does not exist' % job_id)
+            if job['status'] in self.JOB_RUNNING:
+                raise Exception('Install job "%s" is running, cancel it instead' % job_id)
+
+            self.jobs.remove(job)
+            self.__save()
+
+    def get_next(self, timeout=None):
+        """
+        Return next queued job, waiting for one to be added. Returned job is set as running (downloading),
+        so it is not reported as queued anymore and it cannot be removed
+
+        Args:
+            timeout (float): maximum time to wait in seconds (None to wait until a job is added or wakeup is called)
+
+        Returns:
+            dict: job (with wifi configuration) or None if no job queued
+        """
+        with self.__condition:
+            job = next((job for job in self.jobs if job['status']==self.JOB_QUEUED), None)
+            if job is None:
+                self.__condition.wait(timeout)
+                job = next((job for job in self.jobs if job['status']==self.JOB_QUEUED), None)
+            if job is None:
+                return None
+
+            job['status'] = self.JOB_DOWNLOADING
+            job['lastupdate'] = int(time.time())
+            self.__save()
+            return dict(job)
+
+    def wakeup(self):
+        """
+        Wake up consumer waiting in get_next (at application stop for example)
+        """
+        with self.__condition:
+            self.__condition.notify_all()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import time
+
+class Progress():
+    """
+    Progress helper. It computes throughput and ETA of a transfer and tells when progress
+    must be reported, to bound the number of status callbacks whatever the transfer speed.
+
+    Instantaneous throughput is smoothed using an exponentially weighted moving average (EWMA)
+    of throughput samples.
+    """
+
+    EWMA_ALPHA = 0.3
+    SAMPLE_INTERVAL = 0.5
+
+    def __init__(self, total=0, report_interval=0.25, report_percent=1):
+        """
+        Constructor
+
+        Args:
+            total (int): total number of bytes to transfer (0 if unknown)
+            report_interval (float): report progress every specified seconds
+            report_percent (int): report progress every specified percent
+        """
+        self.report_interval = report_interval
+        self.report_percent = report_percent
+        self.reset(total)
+
+    def reset(self, total=0, done=0):
+        """
+        Reset progress
+
+        Args:
+            total (int): total number of bytes to transfer (0 if unknown)
+            done (int): number of bytes already transferred (resumed transfer)
+        """
+        now = time.time()
+        self.total = total
+        self.done = done
+        self.start_done = done
+        self.start_time = now
+        self.instant_rate = 0.0
+        self.__sample_time = now
+        self.__sample_done = done
+        self.__report_time = 0.0
+        self.__report_percent = -1
+
+    def get_percent(self):
+        """
+        Return transfer percentage
+
+        Returns:
+            int: percentage (0 if total is unknown)
+        """
+        if not self.total:
+            return 0
+
+        return int(float(self.done) / float(self.total) * 100.0)
+
+    def get_average_rate(self):
+        """
+        Return average throughput since transfer started
+
+        Returns:
+            float: average throughput (bytes/second)
+        """
+        elapsed = time.time() - self.start_time
+        if elapsed<=0:
+            return 0.0
+
+        return float(self.done - self.start_done) / elapsed
+
+    def get_eta(self):
+        """
+        Return estimated remaining time
+
+        Returns:
+            int: remaining seconds or None if it can't be estimated
+        """
+        rate = self.instant_rate or self.get_average_rate()
+        if not self.total or rate<=0:
+            return None
+
+        return int(max(0, self.total - self.done) / rate)
+
+    def update(self, done):
+        """
+        Update progress with number of transferred bytes
+
+        Args:
+            done (int): total number of bytes transferred so far
+
+        Returns:
+            bool: True if progress must be reported
+        """
+        now = time.time()
+        self.done = done
+
+        #sample throughput
+        elapsed = now - self.__sample_time
+        if elapsed>=self.SAMPLE_INTERVAL:
+            rate = float(done - self.__sample_done) / elapsed
+            if self.instant_rate:
+                self.instant_rate = self.EWMA_ALPHA * rate + (1.0 - self.EWMA_ALPHA) * self.instant_rate
+            else:
+                self.instant_rate = rate
+            self.__sample_time = now
+            self.__sample_done = done
+
+        #check if progress must be reported
+        percent = self.get_percent()
+        if now-self.__report_time>=self.report_interval or percent-self.__report_percent>=self.report_percent:
+            self.__report_time = now
+            self.__report_percent = percent
+            return True
+
+        return False
+
+    def get_infos(self):
+        """
+        Return progress infos
+
+        Returns:
+            dict: progress infos::
+                {
+                    done (int): transferred bytes
+                    total (int): total bytes (0 if unknown)
+                    percent (int): percentage
+                    instantrate (int): smoothed instantaneous throughput (bytes/second)
+                    averagerate (int): average throughput (bytes/second)
+                    eta (int): remaining seconds (None if unknown)
+                }
+        """
+        return {
+            'done': self.done,
+            'total': self.total,
+            'percent': self.get_percent(),
+            'instantrate': int(self.instant_rate),
+            'averagerate': int(self.get_average_rate()),
+            'eta': self.get_eta(),
+        }
+
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import time
+from threading import Lock
+
+class RateLimiter():
+    """
+    Token bucket rate limiter. A single instance can be shared by several threads (download segments,
+    concurrent downloads) to cap their overall throughput.
+
+    Tokens are reserved under lock and caller sleeps outside of it until its tokens are available,
+    so waiting threads never block each other. When gevent monkey patching is enabled time.sleep
+    yields to other greenlets, so limiter stays accurate without busy waiting.
+
+    Caller sleeps in short slices and its remaining wait is computed again after each slice, so a
+    rate change applies to threads already waiting and a canceled caller stops waiting quickly.
+    """
+
+    MIN_BURST = 65536
+    BURST_DURATION = 0.25
+    MAX_SLEEP = 0.25
+
+    def __init__(self, rate=0):
+        """
+        Constructor
+
+        Args:
+            rate (int): maximum throughput in bytes/second (0 for unlimited)
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.rate = 0
+        self.burst = self.MIN_BURST
+        self.__tokens = 0.0
+        self.__last = time.monotonic()
+        self.__lock = Lock()
+
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Set maximum throughput. Can be changed while limiter is used
+
+        Args:
+            rate (int): maximum throughput in bytes/second (0 for unlimited)
+        """
+        rate = max(0, int(rate or 0))
+        with self.__lock:
+            if rate==self.rate:
+                return
+            self.logger.debug('Rate limit set to %d bytes/s' % rate)
+            self.rate = rate
+            self.burst = max(self.MIN_BURST, int(rate * self.BURST_DURATION))
+            self.__tokens = min(self.__tokens, self.burst)
+            self.__last = time.monotonic()
+
+    def get_rate(self):
+        """
+        Return maximum throughput
+
+        Returns:
+            int: maximum throughput in bytes/second (0 for unlimited)
+        """
+        return self.rate
+
+    def consume(self, size, canceled=None):
+        """
+        Consume specified number of tokens, waiting until they are available
+
+        Args:
+            size (int): number of bytes transferred
+            canceled (function): function returning True when caller is canceled, to stop waiting
+
+        Returns:
+            float: time waited in seconds
+        """
+        with self.__lock:
+            if not self.rate:
+                return 0.0
+
+            #refill bucket
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+
+            #reserve tokens (bucket can go negative, next callers wait for debt to be paid back)
+            self.__tokens -= size
+            debt = -self.__tokens if self.__tokens<0 else 0.0
+        if debt==0:
+            return 0.0
+
+        #wait until debt is paid back at current rate
+        start = time.monotonic()
+        last = start
+        while debt>0:
+            rate = self.rate
+            if not rate:
+                #limit removed
+                break
+            if canceled and canceled():
+                #give back unused tokens to next callers
+                with self.__lock:
+                    self.__tokens = min(self.burst, self.__tokens + min(debt, size))
+                break
+
+            time.sleep(min(debt / rate, self.MAX_SLEEP))
+            now = time.monotonic()
+            debt -= (now - last) * rate
+            last = now
+
+        return time.monotonic() - start
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import os
+from gevent.socket import wait_write
+from geventwebsocket.handler import WebSocketHandler
+
+class FileRange():
+    """
+    File-like object limited to a byte range of a file. It is used as WSGI response body:
+    it can be sent with sendfile by SendfileHandler, or read by any WSGI server
+    """
+
+    BUFFER_SIZE = 1048576
+
+    def __init__(self, filepath, offset=0, length=None):
+        """
+        Constructor
+
+        Args:
+            filepath (string): file path
+            offset (int): first byte to send
+            length (int): number of bytes to send (None to send until end of file)
+        """
+        self.file = open(filepath, 'rb')
+        self.offset = offset
+        self.length = os.fstat(self.file.fileno()).st_size - offset if length is None else length
+        self.file.seek(offset)
+        self.__remaining = self.length
+
+    def fileno(self):
+        """
+        Return file descriptor
+        """
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        """
+        Read data of range
+
+        Args:
+            size (int): maximum number of bytes to read (-1 to read whole range)
+
+        Returns:
+            bytes: read data
+        """
+        if size<0 or size>self.__remaining:
+            size = self.__remaining
+        data = self.file.read(size)
+        self.__remaining -= len(data)
+
+        return data
+
+    def close(self):
+        """
+        Close file
+        """
+        self.file.close()
+
+class SendfileWrapper():
+    """
+    Implementation of wsgi.file_wrapper (PEP 3333). Iterating it reads file content as usual,
+    but SendfileHandler detects it and sends file content with zero-copy sendfile instead
+    """
+
+    def __init__(self, filelike, block_size=FileRange.BUFFER_SIZE):
+        """
+        Constructor
+
+        Args:
+            filelike (file): file-like object
+            block_size (int): read block size when file is iterated
+        """
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        """
+        Iterate over file content
+        """
+        while True:
+            data = self.filelike.read(self.block_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        """
+        Close file
+        """
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+class SendfileHandler(WebSocketHandler):
+    """
+    Gevent WSGI handler that provides wsgi.file_wrapper to applications and sends wrapped files
+    using os.sendfile (data is copied by kernel from page cache to socket)
+    """
+
+    CHUNK_SIZE = 16777216
+
+    def get_environ(self):
+        """
+        Add wsgi.file_wrapper to request environment
+        """
+        environ = WebSocketHandler.get_environ(self)
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+
+        return environ
+
+    def __can_sendfile(self):
+        """
+        Return True if current result can be sent using sendfile
+
+        Returns:
+            bool: True if sendfile can be used
+        """
+        return isinstance(self.result, SendfileWrapper) \
+            and hasattr(os, 'sendfile') \
+            and hasattr(self.result.filelike, 'fileno') \
+            and not self.response_use_chunked \
+            and not hasattr(self.socket, 'cipher')
+
+    def process_result(self):
+        """
+        Send response body, using sendfile if possible
+        """
+        if not self.__can_sendfile():
+            return WebSocketHandler.process_result(self)
+
+        #send headers
+        self.write(b'')
+
+        #send file content (socket is non blocking, wait for it to be writable when its buffer is full)
+        filelike = self.result.filelike
+        offset = getattr(filelike, 'offset', None)
+        if offset is None:
+            offset = filelike.tell() if hasattr(filelike, 'tell') else 0
+        remaining = getattr(filelike, 'length', None)
+        if remaining is None:
+            remaining = os.fstat(filelike.fileno()).st_size - offset
+        socket_fd = self.socket.fileno()
+        while remaining>0:
+            try:
+                sent = os.sendfile(socket_fd, filelike.fileno(), offset, min(remaining, self.CHUNK_SIZE))
+            except BlockingIOError:
+                wait_write(socket_fd)
+                continue
+            if sent==0:
+                #client closed connection
+                break
+            offset += sent
+            remaining -= sent
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import time
+import re
+from threading import Thread, Lock
+
+class SourceSelector():
+    """
+    Download source selector. It probes an ordered list of candidate urls serving the same file
+    (mirrors, LAN cache, origin) with small range requests, ranks them by measured throughput and
+    latency, and provides another source when current one fails or stalls.
+
+    Content integrity is not checked here: all sources are assumed to serve the same file, downloaded
+    file checksum must be verified by caller.
+    """
+
+    PROBE_SIZE = 65536
+    PROBE_TIMEOUT = 5.0
+
+    def __init__(self, http):
+        """
+        Constructor
+
+        Args:
+            http (PoolManager): urllib3 pool manager used to probe sources
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.http = http
+        self.sources = []
+        self.__lock = Lock()
+
+    def probe(self, urls, size=None):
+        """
+        Probe specified urls concurrently and rank them. Candidates that do not support range requests
+        or that serve a file of different size are discarded.
+
+        Args:
+            urls (list): ordered list of candidate urls (preferred first)
+            size (int): expected file size (None if unknown)
+
+        Returns:
+            list: ranked sources (see get_sources)
+        """
+        sources = [{
+            'url': url,
+            'order': order,
+            'latency': None,
+            'throughput': 0,
+            'size': 0,
+            'failed': False,
+        } for order, url in enumerate(urls)]
+
+        threads = []
+        for source in sources:
+            thread = Thread(target=self.__probe_source, args=(source,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(self.PROBE_TIMEOUT * 2)
+
+        #keep usable sources serving the same file
+        if not size:
+            sizes = [source['size'] for source in sources if source['latency'] is not None]
+            size = sizes[0] if len(sizes)>0 else None
+        usable = []
+        for source in sources:
+            if source['latency'] is None:
+                self.logger.info('Source "%s" is unreachable or does not support range requests' % source['url'])
+            elif size and source['size']!=size:
+                self.logger.warning('Source "%s" serves file of size %d instead of %d, it is dropped' % (source['url'], source['size'], size))
+            else:
+                usable.append(source)
+
+        #fastest first, candidate order breaks ties
+        with self.__lock:
+            self.sources = sorted(usable, key=lambda source: (-source['throughput'], source['order']))
+        self.logger.debug('Ranked sources: %s' % self.sources)
+
+        return self.get_sources()
+
+    def __probe_source(self, source):
+        """
+        Probe specified source requesting first bytes of file. Measures are stored in source
+
+        Args:
+            source (dict): source to probe
+        """
+        try:
+            start = time.time()
+            resp = self.http.request('GET', source['url'], headers={'Range': 'bytes=0-%d' % (self.PROBE_SIZE - 1)}, preload_content=False, timeout=self.PROBE_TIMEOUT, retries=False)
+            latency = time.time() - start
+            if resp.status!=206:
+                #response body (whole file) is not read: close connection and give it back to pool
+                resp.close()
+                resp.release_conn()
+                raise Exception('Range request not honored (status %s)' % resp.status)
+
+            data = resp.read()
+            duration = time.time() - start
+            resp.release_conn()
+
+            #Content-Range: bytes 0-65535/123456
+            match = re.match(r'bytes\s+\d+-\d+/(\d+)', resp.getheader('Content-Range') or '')
+            source['size'] = int(match.group(1)) if match else 0
+            source['throughput'] = int(len(data) / duration) if duration>0 else 0
+            source['latency'] = latency
+
+        except Exception as e:
+            self.logger.debug('Unable to probe source "%s": %s' % (source['url'], str(e)))
+
+    def set_urls(self, urls):
+        """
+        Set sources without probing them (sources are used in specified order)
+
+        Args:
+            urls (list): ordered list of urls
+        """
+        with self.__lock:
+            self.sources = [{
+                'url': url,
+                'order': order,
+                'latency': None,
+                'throughput': 0,
+                'size': 0,
+                'failed': False,
+            } for order, url in enumerate(urls)]
+
+    def add_url(self, url):
+        """
+        Add unprobed source after ranked ones
+
+        Args:
+            url (string): source url
+        """
+        with self.__lock:
+            if url in [source['url'] for source in self.sources]:
+                return
+            self.sources.append({
+                'url': url,
+                'order': len(self.sources),
+                'latency': None,
+                'throughput': 0,
+                'size': 0,
+                'failed': False,
+            })
+
+    def get_sources(self):
+        """
+        Return ranked sources
+
+        Returns:
+            list: list of sources::
+                [
+                    {
+                        url (string): source url
+                        order (int): source order in candidates list
+                        latency (float): time to first byte in seconds
+                        throughput (int): probed throughput in bytes/second
+                        size (int): file size served by source
+                        failed (bool): True if source failed during download
+                    },
+                    ...
+                ]
+        """
+        with self.__lock:
+            return [dict(source) for source in self.sources]
+
+    def get_url(self):
+        """
+        Return url of best source that has not failed
+
+        Returns:
+            string: source url or None if no source available
+        """
+        with self.__lock:
+            for source in self.sources:
+                if not source['failed']:
+                    return source['url']
+
+            return None
+
+    def has_alternative(self, url):
+        """
+        Return True if another source than specified one can be used
+
+        Args:
+            url (string): current source url
+
+        Returns:
+            bool: True if another source has not failed
+        """
+        with self.__lock:
+            return any([not source['failed'] and source['url']!=url for source in self.sources])
+
+    def failover(self, url):
+        """
+        Flag specified source as failed and return next best source. Several download streams can
+        report the same failed source, it is flagged only once.
+
+        Args:
+            url (string): failed source url
+
+        Returns:
+            string: url of next source to use or None if no source available anymore
+        """
+        with self.__lock:
+            for source in self.sources:
+                if source['url']==url and not source['failed']:
+                    self.logger.warning('Source "%s" failed, switch to next source' % url)
+                    source['failed'] = True
+
+        return self.get_url()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import json
+
+class SparseFile():
+    """
+    Sparse file writer. Data is written sequentially and zeroed blocks are not written (file
+    offset is moved forward instead), so filesystem creates holes for them. A block map of
+    non-zero regions is built at the same time, it allows to read or write only populated
+    blocks of file afterwards.
+
+    On filesystems without sparse file support, holes are filled with zeros by the system:
+    file content is the same, only disk usage differs.
+    """
+
+    BLOCK_SIZE = 4096
+    BLOCKMAP_SUFFIX = '.bmap'
+
+    def __init__(self, filepath, block_size=BLOCK_SIZE):
+        """
+        Constructor
+
+        Args:
+            filepath (string): file to write
+            block_size (int): block size
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.filepath = filepath
+        self.block_size = block_size
+        self.size = 0
+        self.ranges = []
+        self.__zero_block = bytes(block_size)
+        self.__pending = b''
+        self.__file = open(filepath, 'wb')
+
+    def write(self, data):
+        """
+        Write data at end of file
+
+        Args:
+            data (bytes): data to write
+        """
+        if self.__pending:
+            data = self.__pending + bytes(data)
+            self.__pending = b''
+        view = memoryview(data)
+
+        #keep incomplete block for next write
+        length = len(view) - len(view) % self.block_size
+        if length<len(view):
+            self.__pending = bytes(view[length:])
+
+        #whole data is zeroed: skip it
+        if length>0 and view[:length]==bytes(length):
+            self.size += length
+            return
+
+        #write populated blocks only
+        for offset in range(0, length, self.block_size):
+            block = view[offset:offset+self.block_size]
+            if block!=self.__zero_block:
+                self.__write_block(block)
+            self.size += self.block_size
+
+    def __write_block(self, block):
+        """
+        Write populated block at current size offset and update block map
+
+        Args:
+            block (memoryview): block data
+        """
+        index = self.size // self.block_size
+        if len(self.ranges)>0 and self.ranges[-1][1]==index-1:
+            self.ranges[-1][1] = index
+        else:
+            self.ranges.append([index, index])
+
+        if self.__file.tell()!=self.size:
+            self.__file.seek(self.size)
+        self.__file.write(block)
+
+    def close(self):
+        """
+        Write last incomplete block and set final file size (trailing zeroed blocks are holes)
+        """
+        if self.__file is None:
+            return
+
+        if self.__pending:
+            pending = self.__pending
+            self.__pending = b''
+            if pending!=bytes(len(pending)):
+                self.__write_block(pending)
+            self.size += len(pending)
+
+        self.__file.truncate(self.size)
+        self.__file.close()
+        self.__file = None
+        blockmap = self.get_blockmap()
+        self.logger.debug('Sparse file "%s" written: %d/%d blocks populated' % (self.filepath, blockmap['mapped'], blockmap['blocks']))
+
+    def get_blockmap(self):
+        """
+        Return block map of populated regions
+
+        Returns:
+            dict: block map::
+                {
+                    blocksize (int): block size
+                    size (int): file size
+                    blocks (int): number of blocks (last one can be incomplete)
+                    mapped (int): number of populated blocks
+                    ranges (list): list of populated block ranges [first block, last block] (inclusive)
+                }
+        """
+        return {
+            'blocksize': self.block_size,
+            'size': self.size,
+            'blocks': (self.size + self.block_size - 1) // self.block_size,
+            'mapped': sum([last - first + 1 for first, last in self.ranges]),
+            'ranges': [list(item) for item in self.ranges],
+        }
+
+    @staticmethod
+    def save_blockmap(blockmap, filepath):
+        """
+        Save block map to json file
+
+        Args:
+            blockmap (dict): block map as returned by get_blockmap
+            filepath (string): block map filepath
+        """
+        filepath_tmp = '%s.tmp' % filepath
+        with open(filepath_tmp, 'w') as f:
+            json.dump(blockmap, f)
+        os.replace(filepath_tmp, filepath)
+
+    @staticmethod
+    def load_blockmap(filepath):
+        """
+        Load block map from json file
+
+        Args:
+            filepath (string): block map filepath
+
+        Returns:
+            dict: block map (see get_blockmap) or None if file does not exist
+        """
+        if not filepath or not os.path.exists(filepath):
+            return None
+
+        with open(filepath, 'r') as f:
+            return json.load(f)
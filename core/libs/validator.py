@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import os
+import mmap
+import errno
+import hashlib
+from collections import deque
+from gevent.threadpool import ThreadPool
+from core.libs.progress import Progress
+
+class Validator():
+    """
+    Flashed drive validator. Chunks written by Flasher are read back from target and their hashes are
+    compared to hashes recorded while flashing (see Flasher.get_hashmap).
+
+    Target is read sequentially with large buffers (with O_DIRECT when supported, so data really comes
+    from drive and not from page cache) and chunks are hashed concurrently while next ones are read.
+    Reads and hashes are executed in a pool of real OS threads (gevent threadpool): hashlib releases
+    GIL on large buffers, so hashes run in parallel and validation does not freeze the application
+    while it is driven from a greenlet. Validation stops at first mismatching chunk.
+    """
+
+    BUFFER_SIZE = 4194304
+    ALIGNMENT = 4096
+
+    STATUS_IDLE = 0
+    STATUS_VALIDATING = 1
+    STATUS_DONE = 2
+    STATUS_ERROR = 3
+    STATUS_CANCELED = 4
+    STATUS_MISMATCH = 5
+
+    def __init__(self, status_callback=None, workers=None):
+        """
+        Constructor
+
+        Args:
+            status_callback (function): status callback. Params: status, checked, percent
+            workers (int): number of hashing threads (None to use number of cpus)
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.status_callback = status_callback
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.status = self.STATUS_IDLE
+        self.progress = Progress()
+        self.checked = 0
+        self.mismatch_offset = None
+        self.error = None
+        self.__cancel = False
+        self.__fd = None
+        self.__direct = False
+
+    def cancel(self):
+        """
+        Cancel validation
+        """
+        self.__cancel = True
+
+    def get_result(self):
+        """
+        Return result of last validation
+
+        Returns:
+            dict: validation result::
+                {
+                    status (int): validator status
+                    checked (int): number of bytes checked
+                    total (int): number of bytes to check
+                    mismatchoffset (int): offset of first mismatching chunk (None if no mismatch)
+                    error (string): error message (None if no error)
+                }
+        """
+        return {
+            'status': self.status,
+            'checked': self.checked,
+            'total': self.progress.total,
+            'mismatchoffset': self.mismatch_offset,
+            'error': self.error,
+        }
+
+    def __status_callback(self):
+        """
+        Call status callback if configured
+        """
+        if self.status_callback:
+            self.status_callback(self.status, self.checked, self.progress.get_percent())
+
+    def __open_target(self, target):
+        """
+        Open target for reading, bypassing page cache if possible
+
+        Args:
+            target (string): block device or file path
+
+        Returns:
+            tuple: (fd, True if opened with O_DIRECT)
+        """
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(target, os.O_RDONLY | os.O_DIRECT), True
+            except OSError as e:
+                if e.errno!=errno.EINVAL:
+                    raise
+
+        #O_DIRECT not supported, drop cached pages of target instead
+        fd = os.open(target, os.O_RDONLY)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        return fd, False
+
+    def __read_chunk(self, target, offset, length, buf):
+        """
+        Read chunk of target. This function is executed in a pool thread, chunks are read one at a time
+
+        Args:
+            target (string): block device or file path
+            offset (int): chunk offset
+            length (int): chunk length
+            buf (mmap): buffer to read chunk into
+
+        Returns:
+            mmap: buffer
+        """
+        #O_DIRECT reads must be aligned, last chunk is read beyond its end
+        size = length + (-length % self.ALIGNMENT) if self.__direct else length
+        view = memoryview(buf)
+        read = 0
+        while read<length:
+            try:
+                count = os.preadv(self.__fd, [view[read:size]], offset + read)
+            except OSError as e:
+                if not self.__direct or e.errno!=errno.EINVAL:
+                    raise
+                #target rejected O_DIRECT read, reopen it
+                os.close(self.__fd)
+                self.__fd = None
+                self.__fd = os.open(target, os.O_RDONLY)
+                self.__direct = False
+                size = length
+                continue
+            if count==0:
+                raise Exception('Unexpected end of target at offset %d' % (offset + read))
+            read += count
+
+        return buf
+
+    def __check_chunk(self, target, chunks, pending, free_buffers):
+        """
+        Wait for hash of oldest pending chunk and compare it to expected one
+
+        Args:
+            target (string): block device or file path
+            chunks (list): chunks to check [offset, length, hash]
+            pending (deque): chunks being hashed (index, buffer, hash result)
+            free_buffers (list): free buffers, chunk buffer is released in it
+
+        Returns:
+            bool: True if chunk is valid
+        """
+        (index, buf, result) = pending.popleft()
+        digest = result.get()
+        free_buffers.append(buf)
+        (offset, length, expected) = chunks[index]
+        if digest!=expected:
+            self.logger.error('Target "%s" content mismatch in chunk at offset %d' % (target, offset))
+            self.mismatch_offset = offset
+            return False
+
+        self.checked += length
+        if self.progress.update(self.checked):
+            self.__status_callback()
+
+        return True
+
+    def __hash_chunk(self, algorithm, buf, length):
+        """
+        Hash chunk data. This function is executed in a pool thread
+
+        Args:
+            algorithm (string): hash algorithm
+            buf (mmap): chunk buffer
+            length (int): chunk length
+
+        Returns:
+            string: chunk hash
+        """
+        with memoryview(buf) as view:
+            return hashlib.new(algorithm, view[:length]).hexdigest()
+
+    def validate(self, target, hashmap):
+        """
+        Validate target content. This function is blocking
+
+        Args:
+            target (string): block device or file path
+            hashmap (dict): hashes of written chunks (see Flasher.get_hashmap)
+
+        Returns:
+            bool: True if target content is valid
+        """
+        self.__cancel = False
+        self.error = None
+        self.checked = 0
+        self.mismatch_offset = None
+        chunks = sorted(hashmap['chunks'], key=lambda chunk: chunk[0])
+        self.progress.reset(sum([chunk[1] for chunk in chunks]))
+        self.logger.info('Validate "%s": %d bytes to check' % (target, self.progress.total))
+
+        self.status = self.STATUS_VALIDATING
+        self.__status_callback()
+
+        #one thread reads chunks while others hash previous ones
+        pool = ThreadPool(self.workers + 1)
+        reading = None
+        pending = deque()
+        try:
+            (self.__fd, self.__direct) = pool.spawn(self.__open_target, target).get()
+            #hashed chunks, chunk being read and next one
+            free_buffers = [mmap.mmap(-1, self.BUFFER_SIZE) for _ in range(self.workers + 2)]
+            if len(chunks)>0:
+                reading = pool.spawn(self.__read_chunk, target, chunks[0][0], chunks[0][1], free_buffers.pop())
+
+            #chunks are hashed concurrently but checked in order, so first mismatch is reported
+            for index in range(len(chunks)):
+                buf = reading.get()
+                reading = None
+                if len(pending)>=self.workers and not self.__check_chunk(target, chunks, pending, free_buffers):
+                    break
+                if self.__cancel:
+                    break
+
+                pending.append((index, buf, pool.spawn(self.__hash_chunk, hashmap['algorithm'], buf, chunks[index][1])))
+                if index+1<len(chunks):
+                    reading = pool.spawn(self.__read_chunk, target, chunks[index+1][0], chunks[index+1][1], free_buffers.pop())
+
+            while len(pending)>0 and not self.__cancel and self.mismatch_offset is None:
+                self.__check_chunk(target, chunks, pending, free_buffers)
+
+        except Exception as e:
+            self.logger.exception('Error validating "%s":' % target)
+            self.error = str(e)
+
+        finally:
+            #pool threads cannot be interrupted, wait for them before closing target
+            for result in [reading] + [item[2] for item in pending]:
+                if result is not None:
+                    result.wait()
+            if self.__fd is not None:
+                os.close(self.__fd)
+                self.__fd = None
+            pool.kill()
+
+        if self.mismatch_offset is not None:
+            self.status = self.STATUS_MISMATCH
+        elif self.error is not None:
+            self.status = self.STATUS_ERROR
+        elif self.__cancel:
+            self.status = self.STATUS_CANCELED
+        elif self.checked<self.progress.total:
+            self.status = self.STATUS_ERROR
+            self.error = 'Target was not fully read'
+        else:
+            self.status = self.STATUS_DONE
+        self.__status_callback()
+        self.logger.info('Validation of "%s" terminated with status %d (%d bytes checked)' % (target, self.status, self.checked))
+
+        return self.status==self.STATUS_DONE
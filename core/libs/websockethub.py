@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import uuid
+from collections import deque, OrderedDict
+from threading import Condition
+
+class WebSocketHub():
+    """
+    Websocket publish/subscribe hub. Each websocket client subscribes to hub and gets its own bounded
+    queue, so every published event reaches every client.
+
+    A slow client must not make memory grow nor delay other clients, so when its queue is full:
+     - a pending event of the same type is replaced for coalesced events (events that carry a full
+       state snapshot, only latest one is useful)
+     - otherwise oldest pending event is dropped
+
+    Latest coalesced events are kept and sent to new subscribers, so a client connecting later gets
+    current state immediately.
+    """
+
+    MAX_QUEUE_SIZE = 256
+
+    def __init__(self, coalesced_events=None, max_queue_size=MAX_QUEUE_SIZE):
+        """
+        Constructor
+
+        Args:
+            coalesced_events (list): names of events that can be coalesced (latest wins)
+            max_queue_size (int): maximum number of pending events per subscriber
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.coalesced_events = set(coalesced_events or [])
+        self.max_queue_size = max_queue_size
+        self.subscribers = {}
+        self.__latest_events = OrderedDict()
+        self.__condition = Condition()
+
+    def subscribe(self):
+        """
+        Add subscriber. Latest coalesced events are queued for it
+
+        Returns:
+            string: subscriber id
+        """
+        with self.__condition:
+            subscriber_id = str(uuid.uuid4())
+            self.subscribers[subscriber_id] = {
+                'queue': deque(self.__latest_events.values()),
+                'dropped': 0,
+                'closed': False,
+            }
+            self.logger.debug('Subscriber %s added (%d subscribers)' % (subscriber_id, len(self.subscribers)))
+
+            return subscriber_id
+
+    def unsubscribe(self, subscriber_id):
+        """
+        Remove subscriber. Its pending get call returns None
+
+        Args:
+            subscriber_id (string): subscriber id
+        """
+        with self.__condition:
+            subscriber = self.subscribers.pop(subscriber_id, None)
+            if subscriber is None:
+                return
+
+            subscriber['closed'] = True
+            subscriber['queue'].clear()
+            self.__condition.notify_all()
+            self.logger.debug('Subscriber %s removed (%d events dropped)' % (subscriber_id, subscriber['dropped']))
+
+    def publish(self, event, data):
+        """
+        Publish event to all subscribers. This function is not blocking
+
+        Args:
+            event (string): event name
+            data (any): event data
+        """
+        message = {
+            'event': event,
+            'data': data,
+        }
+        coalesced = event in self.coalesced_events
+
+        with self.__condition:
+            if coalesced:
+                self.__latest_events.pop(event, None)
+                self.__latest_events[event] = message
+
+            for subscriber in self.subscribers.values():
+                self.__enqueue(subscriber, message, coalesced)
+            self.__condition.notify_all()
+
+    def __enqueue(self, subscriber, message, coalesced):
+        """
+        Queue message for subscriber, making room if its queue is full. Condition must be acquired
+
+        Args:
+            subscriber (dict): subscriber
+            message (dict): message to queue
+            coalesced (bool): True if message can replace a pending message of same event
+        """
+        queue = subscriber['queue']
+        if len(queue)>=self.max_queue_size:
+            subscriber['dropped'] += 1
+            pending = None
+            if coalesced:
+                pending = next((item for item in queue if item['event']==message['event']), None)
+            if pending is not None:
+                queue.remove(pending)
+            else:
+                queue.popleft()
+
+        queue.append(message)
+
+    def get(self, subscriber_id, timeout=None):
+        """
+        Return next event of subscriber, waiting for one to be published
+
+        Args:
+            subscriber_id (string): subscriber id
+            timeout (float): maximum time to wait in seconds (None to wait until an event is published)
+
+        Returns:
+            dict: event ({event (string), data (any)}) or None if timeout expired or subscriber was removed
+        """
+        with self.__condition:
+            subscriber = self.subscribers.get(subscriber_id)
+            if subscriber is None:
+                return None
+
+            if len(subscriber['queue'])==0 and not subscriber['closed']:
+                self.__condition.wait_for(lambda: len(subscriber['queue'])>0 or subscriber['closed'], timeout)
+
+            return subscriber['queue'].popleft() if len(subscriber['queue'])>0 else None
+
+    def get_stats(self):
+        """
+        Return hub statistics
+
+        Returns:
+            dict: statistics::
+                {
+                    subscribers (int): number of subscribers
+                    pending (int): number of pending events of all subscribers
+                    dropped (int): number of events dropped or coalesced for current subscribers
+                }
+        """
+        with self.__condition:
+            return {
+                'subscribers': len(self.subscribers),
+                'pending': sum([len(subscriber['queue']) for subscriber in self.subscribers.values()]),
+                'dropped': sum([subscriber['dropped'] for subscriber in self.subscribers.values()]),
+            }
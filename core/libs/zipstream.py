@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import logging
+import struct
+import zlib
+from core.libs.checksum import Checksum
+
+class ZipStream():
+    """
+    Streaming zip extractor. Archive data is fed sequentially (while it is downloaded) and first
+    file member is inflated on the fly to specified output, so archive never needs to be read again.
+    Checksum of inflated data is computed at the same time.
+
+    Only stored and deflated members are supported. Zip64 local headers and data descriptors are handled.
+    If fed data is not a supported zip archive, extractor becomes invalid and ignores further data.
+    """
+
+    LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+    LOCAL_HEADER_FORMAT = '<4sHHHHHIIIHH'
+    LOCAL_HEADER_SIZE = 30
+    DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+    ZIP64_EXTRA_ID = 0x0001
+    FLAG_ENCRYPTED = 0x0001
+    FLAG_DATA_DESCRIPTOR = 0x0008
+    METHOD_STORED = 0
+    METHOD_DEFLATED = 8
+    MAX_OUTPUT_SIZE = 4194304
+
+    STATE_HEADER = 0
+    STATE_DATA = 1
+    STATE_DESCRIPTOR = 2
+    STATE_DONE = 3
+    STATE_INVALID = 4
+    STATE_SKIP = 5
+
+    def __init__(self, output, algorithms=[Checksum.ALGORITHM_SHA256]):
+        """
+        Constructor
+
+        Args:
+            output (function): function called with inflated data
+            algorithms (list): checksum algorithms computed on inflated data
+        """
+        #logger
+        self.logger = logging.getLogger(self.__class__.__name__)
+        #self.logger.setLevel(logging.DEBUG)
+
+        #members
+        self.output = output
+        self.checksum = Checksum(algorithms)
+        self.state = self.STATE_HEADER
+        self.filename = None
+        self.size = 0
+        self.__buffer = b''
+        self.__header = None
+        self.__remaining = 0
+        self.__crc = 0
+        self.__decompressor = None
+
+    def is_valid(self):
+        """
+        Return True if fed data is a supported zip archive (so far)
+
+        Returns:
+            bool: True if archive is valid
+        """
+        return self.state!=self.STATE_INVALID
+
+    def is_done(self):
+        """
+        Return True if first member was fully inflated
+
+        Returns:
+            bool: True if member inflated
+        """
+        return self.state==self.STATE_DONE
+
+    def __invalidate(self, reason):
+        """
+        Invalidate extractor
+
+        Args:
+            reason (string): invalidation reason
+        """
+        self.logger.info('Archive can not be extracted on the fly: %s' % reason)
+        self.state = self.STATE_INVALID
+        self.__buffer = b''
+        self.__decompressor = None
+
+    def feed(self, data):
+        """
+        Feed extractor with archive data
+
+        Args:
+            data (bytes): archive data (following previously fed data)
+        """
+        if self.state in (self.STATE_DONE, self.STATE_INVALID):
+            return
+
+        try:
+            if self.state==self.STATE_HEADER:
+                self.__buffer += bytes(data)
+                self.__parse_header()
+            elif self.state==self.STATE_DATA:
+                self.__inflate(data)
+            elif self.state==self.STATE_DESCRIPTOR:
+                self.__buffer += bytes(data)
+                self.__parse_descriptor()
+            elif self.state==self.STATE_SKIP:
+                self.__skip(data)
+
+        except zlib.error as e:
+            self.__invalidate('corrupted data (%s)' % str(e))
+
+    def __parse_header(self):
+        """
+        Parse local file header from buffered data and start member inflate when header is complete
+        """
+        if len(self.__buffer)<self.LOCAL_HEADER_SIZE:
+            return
+
+        (signature, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length) = struct.unpack(self.LOCAL_HEADER_FORMAT, self.__buffer[:self.LOCAL_HEADER_SIZE])
+        if signature!=self.LOCAL_HEADER_SIGNATURE:
+            return self.__invalidate('not a zip archive')
+        header_size = self.LOCAL_HEADER_SIZE + name_length + extra_length
+        if len(self.__buffer)<header_size:
+            return
+
+        filename = self.__buffer[self.LOCAL_HEADER_SIZE:self.LOCAL_HEADER_SIZE+name_length].decode('utf-8', 'replace')
+        extra = self.__buffer[self.LOCAL_HEADER_SIZE+name_length:header_size]
+        data = self.__buffer[header_size:]
+        self.__buffer = b''
+
+        #zip64 sizes
+        if compressed_size==0xFFFFFFFF or size==0xFFFFFFFF:
+            (size, compressed_size) = self.__parse_zip64_extra(extra, size, compressed_size)
+
+        if flags & self.FLAG_ENCRYPTED:
+            return self.__invalidate('encrypted member')
+        if (filename.endswith('/') or size==0) and not flags & self.FLAG_DATA_DESCRIPTOR:
+            #directory or empty entry, skip it
+            self.logger.debug('Skip archive member "%s"' % filename)
+            self.__remaining = compressed_size
+            self.state = self.STATE_SKIP
+            return self.__skip(data)
+        if method==self.METHOD_DEFLATED:
+            self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method==self.METHOD_STORED and not flags & self.FLAG_DATA_DESCRIPTOR:
+            self.__remaining = compressed_size
+        else:
+            return self.__invalidate('unsupported compression method %d' % method)
+
+        self.logger.debug('Inflate archive member "%s" (%d bytes)' % (filename, size))
+        self.filename = filename
+        self.__header = {
+            'flags': flags,
+            'crc': crc,
+            'size': size,
+        }
+        self.state = self.STATE_DATA
+        if len(data)>0:
+            self.__inflate(data)
+
+    def __skip(self, data):
+        """
+        Skip member data and parse next member header
+
+        Args:
+            data (bytes): member data
+        """
+        size = min(len(data), self.__remaining)
+        self.__remaining -= size
+        if self.__remaining==0:
+            self.state = self.STATE_HEADER
+            self.feed(data[size:])
+
+    def __parse_zip64_extra(self, extra, size, compressed_size):
+        """
+        Parse zip64 extra field to get real sizes
+
+        Args:
+            extra (bytes): extra field
+            size (int): uncompressed size from header
+            compressed_size (int): compressed size from header
+
+        Returns:
+            tuple: (size, compressed size)
+        """
+        offset = 0
+        while offset+4<=len(extra):
+            (field_id, field_size) = struct.unpack('<HH', extra[offset:offset+4])
+            if field_id==self.ZIP64_EXTRA_ID:
+                field = extra[offset+4:offset+4+field_size]
+                values = [struct.unpack('<Q', field[index:index+8])[0] for index in range(0, len(field) - len(field)%8, 8)]
+                if size==0xFFFFFFFF and len(values)>0:
+                    size = values.pop(0)
+                if compressed_size==0xFFFFFFFF and len(values)>0:
+                    compressed_size = values.pop(0)
+                break
+            offset += 4 + field_size
+
+        return size, compressed_size
+
+    def __write(self, data):
+        """
+        Write inflated data to output
+
+        Args:
+            data (bytes): inflated data
+        """
+        if not data:
+            return
+        self.output(data)
+        self.checksum.update(data)
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.size += len(data)
+
+    def __inflate(self, data):
+        """
+        Inflate member data
+
+        Args:
+            data (bytes): member data
+        """
+        if self.__decompressor is None:
+            #stored member
+            data = data[:self.__remaining]
+            self.__remaining -= len(data)
+            self.__write(data)
+            if self.__remaining==0:
+                self.__end_of_member(b'')
+            return
+
+        #output is bounded to avoid memory explosion on highly compressed data (zeroed blocks)
+        self.__write(self.__decompressor.decompress(data, self.MAX_OUTPUT_SIZE))
+        while self.__decompressor.unconsumed_tail and not self.__decompressor.eof:
+            self.__write(self.__decompressor.decompress(self.__decompressor.unconsumed_tail, self.MAX_OUTPUT_SIZE))
+        if self.__decompressor.eof:
+            self.__end_of_member(self.__decompressor.unused_data)
+
+    def __end_of_member(self, remaining):
+        """
+        Member fully inflated
+
+        Args:
+            remaining (bytes): data following member data
+        """
+        self.__decompressor = None
+        if self.__header['flags'] & self.FLAG_DATA_DESCRIPTOR:
+            self.state = self.STATE_DESCRIPTOR
+            self.__buffer = bytes(remaining)
+            self.__parse_descriptor()
+        else:
+            self.__check_member(self.__header['crc'], self.__header['size'])
+
+    def __parse_descriptor(self):
+        """
+        Parse data descriptor following member data to get member crc
+        """
+        #signature is optional
+        offset = 4 if self.__buffer[:4]==self.DESCRIPTOR_SIGNATURE else 0
+        if len(self.__buffer)<offset+12:
+            return
+
+        crc = struct.unpack('<I', self.__buffer[offset:offset+4])[0]
+        self.__buffer = b''
+        self.__check_member(crc, None)
+
+    def __check_member(self, crc, size):
+        """
+        Check inflated member integrity
+
+        Args:
+            crc (int): expected crc32
+            size (int): expected size (None if unknown)
+        """
+        if crc!=(self.__crc & 0xFFFFFFFF):
+            return self.__invalidate('invalid crc of member "%s"' % self.filename)
+        if size is not None and size!=self.size:
+            return self.__invalidate('invalid size of member "%s"' % self.filename)
+
+        self.logger.debug('Archive member "%s" inflated (%d bytes)' % (self.filename, self.size))
+        self.state = self.STATE_DONE
@@ -2,14 +2,29 @@
 # -*- coding: utf-8 -*
 
 import logging
+import os
 from core.utils import CleepDesktopModule
 from core.libs.download import Download
+from core.libs.cacheindex import CacheIndex
+from core.libs.ratelimiter import RateLimiter
+from core.libs.checksum import Checksum
+from core.libs.zipstream import ZipStream
+from core.libs.sparsefile import SparseFile
 
 class Cache(CleepDesktopModule):
     """
     Cache module. Holds cache functions
     """
 
+    DEFAULT_CACHE_MAX_SIZE = 10240
+    DEFAULT_CACHE_MAX_AGE = 0
+    DEFAULT_CACHE_EVICTION = CacheIndex.POLICY_LRU
+    DEFAULT_DOWNLOAD_RATE_LIMIT = 0
+    DEFAULT_CACHE_SPARSE = True
+    DEFAULT_LAN_SHARING = False
+    DEFAULT_LAN_SHARING_PORT = 5611
+    MAX_SHARED_ENTRIES = 50
+
     def __init__(self, context, debug_enabled):
         """
         Constructor
@@ -20,16 +35,129 @@ class Cache(CleepDesktopModule):
         """
         CleepDesktopModule.__init__(self, context, debug_enabled)
 
+        #members
+        self.cache_index = CacheIndex(self.context.paths.cache)
+        self.rate_limiter = RateLimiter()
+        self.download = Download(self.context.paths.cache, cache_index=self.cache_index)
+
+    def _configure(self):
+        """
+        Configure module: purge files from previous processes and apply download rate limit
+        """
+        self.download.purge_files()
+        self.get_rate_limiter()
+
+    def _custom_stop(self):
+        """
+        Write pending cache index changes
+        """
+        self.cache_index.flush()
+
+    def get_cache_index(self):
+        """
+        Return shared cache index configured with current cache limits
+
+        Returns:
+            CacheIndex: cache index instance
+        """
+        limits = self.get_cache_limits()
+        self.cache_index.configure(limits['maxsize'], limits['maxage'], limits['policy'])
+
+        return self.cache_index
+
+    def get_cache_sparse(self):
+        """
+        Return True if extracted images must be cached as sparse files (with block map)
+
+        Returns:
+            bool: True if sparse cache enabled
+        """
+        sparse = self.context.config.get_config_value('cleep.cachesparse')
+
+        return bool(self.DEFAULT_CACHE_SPARSE if sparse is None else sparse)
+
+    def get_rate_limiter(self):
+        """
+        Return download rate limiter shared by all downloads, configured with current rate limit
+
+        Returns:
+            RateLimiter: rate limiter instance
+        """
+        self.rate_limiter.set_rate(self.get_download_rate_limit() * 1024)
+
+        return self.rate_limiter
+
+    def get_download_rate_limit(self):
+        """
+        Return download rate limit from configuration
+
+        Returns:
+            int: download rate limit in KB/s (0 for unlimited)
+        """
+        rate = self.context.config.get_config_value('cleep.downloadratelimit')
+
+        return max(0, int(self.DEFAULT_DOWNLOAD_RATE_LIMIT if rate is None else rate))
+
+    def set_download_rate_limit(self, rate):
+        """
+        Set download rate limit. New limit is saved in configuration and applied immediately,
+        even on running downloads
+
+        Args:
+            rate (int): download rate limit in KB/s (0 for unlimited)
+
+        Returns:
+            int: download rate limit in KB/s
+        """
+        rate = int(rate)
+        if rate<0:
+            raise Exception('Parameter "rate" must be positive')
+
+        if not self.context.config.set_config_value('cleep.downloadratelimit', rate):
+            self.logger.warning('Download rate limit not saved in configuration')
+        self.rate_limiter.set_rate(rate * 1024)
+
+        return rate
+
+    def get_cache_limits(self):
+        """
+        Return cache limits from configuration
+
+        Returns:
+            dict: cache limits::
+                {
+                    maxsize (int): maximum cache size in bytes (0 for unlimited)
+                    maxage (int): maximum age of cached file in seconds (0 for unlimited)
+                    policy (string): eviction policy (lru|age)
+                }
+        """
+        max_size = self.context.config.get_config_value('cleep.cachemaxsize')
+        max_age = self.context.config.get_config_value('cleep.cachemaxage')
+        policy = self.context.config.get_config_value('cleep.cacheeviction')
+
+        return {
+            'maxsize': int(self.DEFAULT_CACHE_MAX_SIZE if max_size is None else max_size) * 1024 * 1024,
+            'maxage': int(self.DEFAULT_CACHE_MAX_AGE if max_age is None else max_age) * 86400,
+            'policy': policy if policy in CacheIndex.POLICIES else self.DEFAULT_CACHE_EVICTION,
+        }
+
     def get_cached_files(self):
         """
         Returns cached files
 
         Returns:
-            list: list of cached files
+            dict: cached files and cache statistics::
+                {
+                    files (list): list of cached files
+                    stats (dict): cache statistics (hits, misses, evictions, entries, size...)
+                }
         """
-        dl = Download(self.context.paths.cache)
+        self.get_cache_index()
 
-        return dl.get_cached_files()
+        return {
+            'files': self.download.get_cached_files(),
+            'stats': self.download.get_cache_stats(),
+        }
 
     def delete_cached_file(self, filename):
         """
@@ -39,21 +167,159 @@ class Cache(CleepDesktopModule):
             filename (string): file path
 
         Returns:
-            list: list of cached files
+            dict: cached files and cache statistics (see get_cached_files)
         """
-        dl = Download(self.context.paths.cache)
-        dl.delete_cached_file(filename)
+        self.download.delete_cached_file(filename)
+        self.__advertise_cache()
 
-        return dl.get_cached_files()
+        return self.get_cached_files()
 
     def purge_cached_files(self):
         """
         Purge all cached files
 
         Returns:
-            list: list of cached files
+            dict: cached files and cache statistics (see get_cached_files)
+        """
+        self.download.purge_files(force_all=True)
+        self.__advertise_cache()
+
+        return self.get_cached_files()
+
+    def inflate_cached_files(self):
+        """
+        Replace cached zip archives by their extracted image (sparse according to configuration),
+        so next flashes do not need to inflate them
+
+        Returns:
+            dict: cached files and cache statistics (see get_cached_files)
+        """
+        sparse = self.get_cache_sparse()
+        for entry in self.cache_index.get_entries():
+            if not entry.get('sourcesha256'):
+                self.__inflate_cached_file(entry, sparse)
+        self.__advertise_cache()
+
+        return self.get_cached_files()
+
+    def __inflate_cached_file(self, entry, sparse):
+        """
+        Replace cached archive by its extracted image
+
+        Args:
+            entry (dict): cache entry
+            sparse (bool): write extracted image as sparse file
+        """
+        try:
+            with open(entry['filepath'], 'rb') as f:
+                if f.read(len(ZipStream.LOCAL_HEADER_SIGNATURE))!=ZipStream.LOCAL_HEADER_SIGNATURE:
+                    #not an archive
+                    return
+        except:
+            self.logger.exception('Unable to read cached file "%s":' % entry['filepath'])
+            return
+
+        raw = '%s%s' % (entry['filepath'], Download.RAW_FILE_SUFFIX)
+        try:
+            self.logger.info('Inflate cached file "%s"' % entry['filename'])
+            writer = SparseFile(raw) if sparse else open(raw, 'wb')
+            extractor = ZipStream(writer.write)
+            Checksum([]).update_from_file(entry['filepath'], callback=extractor.feed)
+            writer.close()
+            if not extractor.is_done():
+                raise Exception('Archive member was not fully extracted')
+
+            #cache extracted image first, then drop archive
+            blockmap = writer.get_blockmap() if sparse else None
+            sha256 = extractor.checksum.hexdigest(Checksum.ALGORITHM_SHA256)
+            #urls of entries migrated from previous cache format are unknown
+            url = entry['urls'][0] if len(entry['urls'])>0 else None
+            self.cache_index.add(url, entry['filename'], raw, sha256, entry['sha256'], blockmap)
+            for url in entry['urls'][1:]:
+                self.cache_index.add_alias(sha256, url)
+            self.cache_index.remove(entry['sha256'])
+
+        except:
+            self.logger.exception('Unable to inflate cached file "%s":' % entry['filename'])
+            if os.path.exists(raw):
+                os.remove(raw)
+
+    def __advertise_cache(self):
+        """
+        Advertise cache content to other CleepDesktop instances
+        """
+        if 'devices' in self.context.modules:
+            self.context.modules['devices'].advertise_cache()
+
+    def get_lan_sharing(self):
+        """
+        Return LAN sharing configuration. When enabled, cached files are served without authentication
+        to other CleepDesktop instances of local network, so it is disabled unless user enables it
+
+        Returns:
+            dict: LAN sharing configuration::
+                {
+                    enabled (bool): True if LAN sharing is enabled
+                    port (int): port of LAN sharing http endpoint
+                }
+        """
+        enabled = self.context.config.get_config_value('cleep.lansharing')
+        port = self.context.config.get_config_value('cleep.lansharingport')
+
+        return {
+            'enabled': bool(self.DEFAULT_LAN_SHARING if enabled is None else enabled),
+            'port': int(self.DEFAULT_LAN_SHARING_PORT if port is None else port),
+        }
+
+    def get_shared_entries(self):
+        """
+        Return cache entries shared on LAN (most recently used first)
+
+        Returns:
+            list: list of shared entries::
+                [
+                    {
+                        sha256 (string): content checksum
+                        size (int): file size
+                        sourcesha256 (string): checksum of archive content was extracted from (None if not extracted)
+                    },
+                    ...
+                ]
+        """
+        if not self.get_lan_sharing()['enabled']:
+            return []
+
+        entries = sorted(self.cache_index.get_entries(), key=lambda entry: entry['lastaccess'], reverse=True)
+        return [{
+            'sha256': entry['sha256'],
+            'size': entry['size'],
+            'sourcesha256': entry.get('sourcesha256'),
+        } for entry in entries[:self.MAX_SHARED_ENTRIES]]
+
+    def get_cached_filepath(self, sha256):
+        """
+        Return path of cached file
+
+        Args:
+            sha256 (string): content checksum
+
+        Returns:
+            string: cached filepath or None if file is not cached
+        """
+        entry = self.cache_index.find_by_sha256(sha256)
+        return entry['filepath'] if entry else None
+
+    def get_shared_filepath(self, sha256):
+        """
+        Return path of cached file shared on LAN
+
+        Args:
+            sha256 (string): content checksum
+
+        Returns:
+            string: cached filepath or None if file is not cached or LAN sharing is disabled
         """
-        dl = Download(self.context.paths.cache)
-        dl.purge_files(force_all=True)
+        if not self.get_lan_sharing()['enabled']:
+            return None
 
-        return  dl.get_cached_files()
+        return self.get_cached_filepath(sha256)
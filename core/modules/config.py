@@ -86,6 +86,10 @@ class Config(CleepDesktopModule):
             else:
                 self.crash_report.disable()
 
+        #process download rate limit (applied on running downloads too)
+        if old['cleep'].get('downloadratelimit')!=config['cleep'].get('downloadratelimit') and 'cache' in self.context.modules:
+            self.context.modules['cache'].rate_limiter.set_rate(int(config['cleep'].get('downloadratelimit') or 0) * 1024)
+
         return self.app_config.save_config(config)
 
     def get_config_value(self, key):
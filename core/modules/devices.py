@@ -5,9 +5,14 @@ import logging
 import os
 import json
 import time
+import re
+import ipaddress
+from threading import Lock
 from core.version import version as VERSION
 from core.utils import CleepDesktopModule
 from core.libs.externalbus import PyreBus
+from core.libs.devicesstore import DevicesStore
+from core.libs.devicesregistry import DevicesRegistry
 
 class Devices(CleepDesktopModule):
     """
@@ -16,6 +21,11 @@ class Devices(CleepDesktopModule):
 
     CLEEPDESKTOP_HOSTNAME = 'CLEEPDESKTOP'
     CLEEPDESKTOP_PORT = '0'
+    CACHE_UPDATE_EVENT = 'cleepdesktop.cache.update'
+    MAX_PEER_CACHE_ENTRIES = 100
+    SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+    #external bus dispatch already waits for events
+    PROCESS_TIMEOUT = 0
 
     def __init__(self, context, debug_enabled):
         """
@@ -28,7 +38,7 @@ class Devices(CleepDesktopModule):
         CleepDesktopModule.__init__(self, context, debug_enabled)
 
         #members
-        self.devices = {}
+        self.devices = DevicesRegistry()
         self.external_bus = PyreBus(
             self.on_message_received, 
             self.on_peer_connected, 
@@ -37,7 +47,11 @@ class Devices(CleepDesktopModule):
             debug_enabled, 
             self.context.crash_report
         )
-        self.peers_uuids = {}
+        self.cleepdesktops = {}
+        #devices changes sequence number, ui resyncs devices list if it misses a change
+        self.devices_seq = 0
+        self.__devices_lock = Lock()
+        self.store = DevicesStore(self.context.paths.config, self.devices.to_dict)
 
         #load devices
         self.__load_devices()
@@ -52,14 +66,15 @@ class Devices(CleepDesktopModule):
         """
         Bus process
         """
-        #configure bus
+        #configure bus and start its I/O thread
         self.external_bus.configure(self.get_bus_headers())
+        self.external_bus.start()
 
     def _custom_process(self):
         """
-        Custom process for cleep bus: get new message on external bus
+        Custom process for cleep bus: process events received by bus I/O thread (blocks until an event is received or bus is stopped)
         """
-        self.external_bus.run_once()
+        self.external_bus.dispatch()
 
     def _custom_stop(self):
         """
@@ -67,24 +82,30 @@ class Devices(CleepDesktopModule):
         """
         if self.external_bus:
             self.external_bus.stop()
+        #write pending devices changes
+        self.store.stop()
 
     def __load_devices(self):
         """
-        Load devices from configuration
+        Load devices from devices store (devices stored in configuration are migrated)
         """
-        self.devices = self.context.config.get_config_value('devices')
+        legacy_devices = self.context.config.get_config_value('devices')
+        devices = self.store.load(legacy_devices)
+        if legacy_devices:
+            #devices are not stored in configuration anymore
+            self.context.config.set_config_value('devices', {})
         # force device to offline at startup. If devices are discovered
         # event will be triggered to update device status
-        for device in self.devices.values():
+        for device in devices.values():
             device['online'] = False
-        self.logger.debug('Initial devices: %s' % self.devices)
+        self.devices.load(devices)
+        self.logger.debug('Initial devices: %s' % devices)
 
     def __save_devices(self):
         """
-        Save devices states
+        Save devices states. Devices are written to disk later, so bursts of changes are written once
         """
-        if not self.context.config.set_config_value('devices', self.devices):
-            self.logger.error('Unable to save devices in configuration file')
+        self.store.mark_dirty()
 
     def get_bus_headers(self):
         """
@@ -94,6 +115,7 @@ class Devices(CleepDesktopModule):
             dict: dict of headers (only string supported)
         """
         macs = self.external_bus.get_mac_addresses()
+        cache = self.__get_cache_advertisement()
         #TODO handle port and ssl when security implemented
         headers = {
             'version': VERSION,
@@ -103,6 +125,8 @@ class Devices(CleepDesktopModule):
             'ssl': '0',
             'cleepdesktop': '1',
             'apps': '',
+            'cacheport': str(cache['cacheport']),
+            'cache': json.dumps(cache['cache']),
         }
         self.logger.debug('headers: %s' % headers)
 
@@ -126,9 +150,114 @@ class Devices(CleepDesktopModule):
             headers[u'cleepdesktop'] = bool(eval(headers[u'cleepdesktop']))
         if u'macs' in headers.keys():
             headers[u'macs'] = json.loads(headers[u'macs'])
+        #cache headers are only used by other CleepDesktop instances, invalid ones are ignored
+        if u'cacheport' in headers.keys():
+            try:
+                headers[u'cacheport'] = int(headers[u'cacheport'])
+            except:
+                headers[u'cacheport'] = 0
+        if u'cache' in headers.keys():
+            try:
+                headers[u'cache'] = json.loads(headers[u'cache'])
+            except:
+                headers[u'cache'] = []
 
         return headers
 
+    def __get_cache_advertisement(self):
+        """
+        Return cache content shared with other CleepDesktop instances
+
+        Returns:
+            dict: cache advertisement::
+                {
+                    cacheport (int): LAN sharing port (0 if sharing disabled)
+                    cache (list): list of shared entries (sha256, size)
+                }
+        """
+        lan_sharing = self.context.modules['cache'].get_lan_sharing()
+
+        return {
+            'cacheport': lan_sharing['port'] if lan_sharing['enabled'] else 0,
+            'cache': self.context.modules['cache'].get_shared_entries(),
+        }
+
+    def advertise_cache(self):
+        """
+        Advertise cache content to other CleepDesktop instances. Headers are updated for peers that
+        will connect later and connected peers are notified by an event
+        """
+        if not self.external_bus.is_running():
+            #advertisement is sent in bus headers once bus is configured
+            self.logger.debug('Bus is not running, cache advertisement not sent')
+            return
+
+        cache = self.__get_cache_advertisement()
+        self.external_bus.set_header('cacheport', str(cache['cacheport']))
+        self.external_bus.set_header('cache', json.dumps(cache['cache']))
+        try:
+            self.external_bus.broadcast_event(self.CACHE_UPDATE_EVENT, cache, None)
+        except:
+            self.logger.exception('Unable to advertise cache content:')
+
+    def __update_cleepdesktop(self, peer, ip, cacheport, cache):
+        """
+        Update cache content of another CleepDesktop instance. Advertisement comes from an untrusted
+        peer: invalid port and entries are dropped and peer url is built from its bus address only
+
+        Args:
+            peer (string): peer id
+            ip (string): peer ip (from bus endpoint)
+            cacheport (int): peer LAN sharing port (0 if sharing disabled)
+            cache (list): list of shared entries (sha256, size, sourcesha256)
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+            host = '[%s]' % address if address.version==6 else str(address)
+        except:
+            self.logger.warning('CleepDesktop peer %s has invalid ip "%s", its cache is ignored' % (peer, ip))
+            host = None
+        if not isinstance(cacheport, int) or isinstance(cacheport, bool) or not 0<cacheport<=65535:
+            cacheport = 0
+
+        entries = {}
+        for entry in (cache if isinstance(cache, list) else [])[:self.MAX_PEER_CACHE_ENTRIES]:
+            if not isinstance(entry, dict) or not self.SHA256_PATTERN.match(str(entry.get('sha256'))):
+                continue
+            sourcesha256 = entry.get('sourcesha256')
+            entries[entry['sha256']] = {
+                'sha256': entry['sha256'],
+                'size': entry['size'] if isinstance(entry.get('size'), int) else 0,
+                'sourcesha256': sourcesha256 if self.SHA256_PATTERN.match(str(sourcesha256)) else None,
+            }
+
+        self.logger.debug('CleepDesktop @%s shares %d cached files' % (ip, len(entries)))
+        self.cleepdesktops[peer] = {
+            'ip': ip,
+            'host': host,
+            'cacheport': cacheport if host else 0,
+            'cache': entries,
+        }
+
+    def get_cache_sources(self, sha256):
+        """
+        Return urls of other CleepDesktop instances that share specified cached file.
+        Those instances are untrusted mirrors: file downloaded from them must always be verified
+        against specified checksum, that must come from a trusted source (release metadata)
+
+        Args:
+            sha256 (string): trusted content checksum
+
+        Returns:
+            list: list of urls
+        """
+        if not self.SHA256_PATTERN.match(str(sha256)):
+            return []
+
+        return ['http://%s:%d/cache/%s' % (cleepdesktop['host'], cleepdesktop['cacheport'], sha256)
+                for cleepdesktop in list(self.cleepdesktops.values())
+                if cleepdesktop['cacheport'] and sha256 in cleepdesktop['cache']]
+
     def on_message_received(self, message):
         """
         Callback when message is received
@@ -138,6 +267,13 @@ class Devices(CleepDesktopModule):
         """
         self.logger.debug('Received message: %s' % message)
 
+        #cache content update from another CleepDesktop
+        if message.event==self.CACHE_UPDATE_EVENT and message.params:
+            for peer, cleepdesktop in list(self.cleepdesktops.items()):
+                if cleepdesktop['ip']==message.peer_ip:
+                    self.__update_cleepdesktop(peer, message.peer_ip, message.params.get('cacheport'), message.params.get('cache'))
+            return
+
         #convert message to dict and inject current timestamp
         msg = message.to_dict()
         msg['timestamp'] = int(time.time())
@@ -154,20 +290,15 @@ class Devices(CleepDesktopModule):
         """
         self.logger.debug('Peer %s connected: %s' % (peer, infos))
 
-        #drop cleepdesktop connection
+        #cleepdesktop connection is not a device, only keep its shared cache content
         if infos['cleepdesktop']:
-            self.logger.debug('Another CleepDesktop @%s connected. Drop it' % infos['ip'])
+            self.logger.debug('Another CleepDesktop @%s connected' % infos['ip'])
+            self.__update_cleepdesktop(peer, infos['ip'], infos.get('cacheport'), infos.get('cache'))
             return
 
-        #after device restarted, pyre bus assigns new peer uuid, here we can encounter device that 
-        #already exist so we need to purge obsolete device entries
-        obsolete_peers = {peer:device for peer,device in self.peers_uuids.items() if device==infos['uuid']}
-        if len(obsolete_peers)>=1:
-            for obsolete_peer in obsolete_peers:
-                del self.peers_uuids[obsolete_peer]
-
-        #save new mapping (useful for disconnection)
-        self.peers_uuids[peer] = infos['uuid']
+        #save new mapping (useful for disconnection). After device restarted, pyre bus assigns new
+        #peer uuid, registry drops obsolete peer of device
+        self.devices.set_peer(peer, infos['uuid'])
 
         #append extra data
         infos['online'] = True
@@ -177,11 +308,14 @@ class Devices(CleepDesktopModule):
             infos['configured'] = True
 
         #save peer infos
-        self.devices[infos['uuid']] = infos
+        added = self.devices.set_device(infos)
         self.__save_devices()
 
         #update ui
-        self.context.update_ui('devices', self.get_devices())
+        if added:
+            self.__update_ui_devices(added=[infos['uuid']])
+        else:
+            self.__update_ui_devices(updated=[infos['uuid']])
 
     def on_peer_disconnected(self, peer):
         """
@@ -192,36 +326,89 @@ class Devices(CleepDesktopModule):
         """
         self.logger.debug('Peer %s disconnected' % peer)
 
+        #cleepdesktop disconnection
+        if peer in self.cleepdesktops:
+            del self.cleepdesktops[peer]
+            return
+
         #get device uuid
-        device_uuid = self.peers_uuids[peer] if peer in self.peers_uuids.keys() else None
+        device_uuid = self.devices.remove_peer(peer)
 
         #only update online status of disconnected device
-        if device_uuid:
-            self.devices[device_uuid]['online'] = False
+        if device_uuid and self.devices.set_online(device_uuid, False):
             self.__save_devices()
+            self.__update_ui_devices(updated=[device_uuid])
 
-        #always update ui
-        self.context.update_ui('devices', self.get_devices())
+    def __update_ui_devices(self, added=None, updated=None, removed=None):
+        """
+        Send devices changes to ui. Only changed devices are sent, with a sequence number so ui can
+        detect a missed change and resync whole devices list (see get_devices)
 
-    def get_devices(self):
+        Args:
+            added (list): uuids of added devices
+            updated (list): uuids of updated devices
+            removed (list): uuids of removed devices
+        """
+        with self.__devices_lock:
+            self.devices_seq += 1
+            self.context.update_ui('devices', {
+                'seq': self.devices_seq,
+                'added': [self.devices.get_device(device_uuid) for device_uuid in (added or []) if self.devices.get_device(device_uuid)],
+                'updated': [self.devices.get_device(device_uuid) for device_uuid in (updated or []) if self.devices.get_device(device_uuid)],
+                'removed': removed or [],
+                'unconfigured': self.devices.unconfigured,
+                'online': self.devices.online,
+            })
+
+    def get_devices(self, offset=0, limit=None, online=None, configured=None, version=None, hostname=None, subnet=None, sort='hostname', reverse=False):
         """
-        Return known devices (online or not)
+        Return known devices (online or not). Without parameters all devices are returned
+
+        Args:
+            offset (int): index of first device to return
+            limit (int): maximum number of devices to return (None for all devices)
+            online (bool): only online (True) or offline (False) devices
+            configured (bool): only configured (True) or unconfigured (False) devices
+            version (string): only devices with this version
+            hostname (string): only devices whose hostname starts with this prefix
+            subnet (string): only devices whose IP is in this subnet (192.168.1.0/24)
+            sort (string): sort key (hostname, ip, version, connectedat, uuid)
+            reverse (bool): reverse sort order
 
         Returns:
-            dict of devices
+            dict of devices::
+                {
+                    seq (int): sequence number of last devices change
+                    unconfigured (int): number of unconfigured devices
+                    online (int): number of online devices
+                    total (int): number of devices matching filters
+                    offset (int): index of first returned device
+                    devices (list): page of devices
+                }
         """
-        #compute unconfigured devices
-        unconfigured = len([dev for dev in list(self.devices.values()) if not dev['configured']])
-
-        #prepare output
-        out = {
-            'unconfigured': unconfigured,
-            'devices': list(self.devices.values())
-        }
-        self.logger.debug('devices: %s' % out)
+        with self.__devices_lock:
+            result = self.devices.query(offset, limit, online, configured, version, hostname, subnet, sort, reverse)
+            out = {
+                'seq': self.devices_seq,
+                'unconfigured': self.devices.unconfigured,
+                'online': self.devices.online,
+                'total': result['total'],
+                'offset': offset,
+                'devices': result['devices'],
+            }
+        self.logger.debug('%d/%d devices returned' % (len(out['devices']), out['total']))
 
         return out
 
+    def get_bus_metrics(self):
+        """
+        Return external bus I/O metrics
+
+        Returns:
+            dict: bus metrics (see PyreBus.get_metrics)
+        """
+        return self.external_bus.get_metrics()
+
     def delete_device(self, device_uuid):
         """
         Delete devices from internal list
@@ -229,12 +416,13 @@ class Devices(CleepDesktopModule):
         Returns:
             dict of devices like returned in get_devices()
         """
-        if device_uuid not in self.devices:
+        if self.devices.get_device(device_uuid) is None:
             self.logger.error('Device "%s" does not exist in internal devices' % device_uuid)
             raise Exception('Device not found')
 
         #delete device
-        del self.devices[device_uuid]
+        self.devices.remove_device(device_uuid)
         self.__save_devices()
+        self.__update_ui_devices(removed=[device_uuid])
 
         return self.get_devices()
@@ -7,9 +7,16 @@ import os
 import platform
 import re
 import tempfile
+from threading import Lock
+from urllib.parse import urlparse
 from operator import itemgetter
 from core.libs.cleepwificonf import CleepWifiConf
 from core.libs.download import Download
+from core.libs.flasher import Flasher
+from core.libs.flashscheduler import FlashScheduler
+from core.libs.installqueue import InstallQueue
+from core.libs.sparsefile import SparseFile
+from core.libs.zipstream import ZipStream
 from core.utils import CleepDesktopModule
 from core.libs.github import Github
 from core.libs.raspbians import Raspbians
@@ -38,6 +45,7 @@ class Install(CleepDesktopModule):
     """
 
     CACHE_DURATION = 900.0
+    DOWNLOAD_SEGMENTS = 4
 
     TMP_FILE_PREFIX = 'cleep_iso'
 
@@ -54,6 +62,7 @@ class Install(CleepDesktopModule):
     STATUS_ERROR_BADCHECKSUM = 10
     STATUS_ERROR_FLASH = 11
     STATUS_ERROR_NETWORK = 12
+    STATUS_ERROR_VALIDATION = 13
 
     FLASH_LINUX = 'balena-cli/flash.sh'
     FLASH_WINDOWS = 'balena-cli\\flash.bat'
@@ -81,18 +90,29 @@ class Install(CleepDesktopModule):
         #members
         self.env = platform.system().lower()
         self.console = None
+        self.scheduler = None
+        self.queue = InstallQueue(self.context.paths.config)
+        self.job_id = None
+        self.jobs = []
+        self.validation = None
         self.percent = 0
         self.__last_percent = 0
         self.total_percent = 0
         self.eta = 0
+        self.throughput = {
+            'instant': 0,
+            'average': 0,
+        }
         self.status = self.STATUS_IDLE
         self.__last_status = self.STATUS_IDLE
         self.drive = None
+        self.drives = []
         self.iso = None
         self.iso_sha256 = None
         self.isos = []
         self.url = None
         self.cancel = False
+        self.__cancel_lock = Lock()
         self.__etcher_output_pattern = r'.*(Flashing|Validating)\s\[.*\]\s(\d+)%\seta\s(.*)'
         self.__flash_output_error = False
         self.wifi_config = None
@@ -133,11 +153,18 @@ class Install(CleepDesktopModule):
         Stop flash. Called before stopping application
         """
         self.cancel = True
+        if self.scheduler:
+            self.scheduler.cancel()
+        #stop waiting for install jobs
+        self.running = False
+        self.queue.wakeup()
 
     def __update_ui(self):
         """
         Update ui if necessary
         """
+        if self.__last_status!=self.status and self.job_id:
+            self.__update_job_status()
         if self.__last_percent!=self.percent or self.__last_status!=self.status:
             self.context.update_ui('install', self.get_status())
             self.__last_percent = self.percent
@@ -145,7 +172,7 @@ class Install(CleepDesktopModule):
 
     def run(self):
         """
-        Start install background task. Does nothing until start_install is called
+        Start install background task. Install jobs queued by start_install are processed in order
         """
         self.logger.debug('Flashdrive thread started')
         
@@ -153,8 +180,19 @@ class Install(CleepDesktopModule):
         self.get_wifi_networks()
 
         while self.running:
-            #check if process requested
-            if self.url and self.drive:
+            #wait for next install job
+            job = self.queue.get_next()
+            if job is not None and self.running:
+                #drives may have been replaced since job was queued
+                error = self.__check_job_drives(job)
+                if error:
+                    self.logger.warning('Install job %s not started: %s' % (job['id'], error))
+                    self.queue.set_status(job['id'], InstallQueue.JOB_ERROR, error)
+                    self.__reset_cancel()
+                    self.__update_ui_queue()
+                    continue
+
+                self.__start_job(job)
                 self.logger.info('Install process started')
 
                 if self.__download_file():
@@ -165,18 +203,20 @@ class Install(CleepDesktopModule):
 
                     #file downloaded successfully, launch flash+validation
                     self.__flash_drive()
-                    #wait until end of flash (or if user cancel it)
-                    while self.console is not None:
-                        if self.cancel:
-                            break
-                        time.sleep(0.25)
+                    #wait until end of flash (or if user cancel it). Module is woken up by end callback or cancel
+                    while self.console is not None and not self.cancel and self.running:
+                        self._wait()
                         
                     #end of process
                     if self.cancel:
                         #process canceled
-                        self.console.kill()
+                        if self.console is not None:
+                            self.console.kill()
                         self.status = self.STATUS_CANCELED
-                    if self.__flash_output_error:
+                    elif self.__flash_output_error and self.validation and self.validation['mismatchoffset'] is not None:
+                        #written data is corrupted
+                        self.status = self.STATUS_ERROR_VALIDATION
+                    elif self.__flash_output_error:
                         #error occured during flash
                         self.status = self.STATUS_ERROR_FLASH
                     else:
@@ -199,12 +239,18 @@ class Install(CleepDesktopModule):
                 self.total_percent = 100
                 if self.iso and os.path.exists(self.iso):
                     self.logger.debug('Purge downloaded file')
-                    dl = Download(self.context.paths.cache)
+                    dl = Download(self.context.paths.cache, cache_index=self.context.modules['cache'].get_cache_index())
                     dl.purge_files()
+                self.__update_job_status()
+                job = self.queue.get_job(self.job_id)
+                if job and job['status'] not in InstallQueue.JOB_ENDED:
+                    self.queue.set_status(self.job_id, InstallQueue.JOB_ERROR, 'Install terminated unexpectedly')
                 self.iso = None
                 self.drive = None
+                self.drives = []
                 self.url = None
-                self.cancel = False
+                self.job_id = None
+                self.__reset_cancel()
                 self.console = None
                 try:
                     #remove temp wifi config file
@@ -221,12 +267,101 @@ class Install(CleepDesktopModule):
                 #update ui
                 self.__update_ui()
 
-            else:
-                #no process, release cpu
-                time.sleep(0.25)
-
         self.logger.debug('Flashdrive thread stopped')
 
+    def __reset_cancel(self):
+        """
+        Reset cancel flag once current job is ended, so a cancel requested for it is not applied to next job
+        """
+        with self.__cancel_lock:
+            self.cancel = False
+
+    def __start_job(self, job):
+        """
+        Prepare install of specified job
+
+        Args:
+            job (dict): install job (see InstallQueue.get_job)
+        """
+        self.job_id = job['id']
+        self.url = job['url']
+        self.drives = job['drives']
+        self.drive = self.drives[0]
+        self.iso_sha256 = job['sha256']
+        self.jobs = []
+        self.validation = None
+        self.percent = 0
+        self.total_percent = 0
+        self.__flash_output_error = False
+
+        #generate wifi config file is needed
+        self.wifi_config = None
+        wifi = job['wifi']
+        if wifi and wifi.get('network'):
+            self.logger.debug('Start install: wifi infos available')
+            try:
+                #prepare content
+                cleepwificonf = CleepWifiConf()
+                conf = cleepwificonf.create_content(wifi['network'], wifi['password'], wifi['encryption'], wifi['hidden'])
+                self.logger.debug('Generated wifi config file: %s' % conf)
+
+                #write content
+                wifi_config_file = tempfile.NamedTemporaryFile(mode='w+', delete=False)
+                self.wifi_config = wifi_config_file.name
+                wifi_config_file.write(conf)
+                wifi_config_file.close()
+
+            except:
+                self.logger.exception('Unable to store wifi config:')
+                self.wifi_config = None
+        else:
+            self.logger.debug('Start install: no wifi info specified')
+
+        self.logger.debug('Start install job %s with values: %s %s %s' % (self.job_id, self.url, self.drives, self.wifi_config))
+
+    def __check_job_drives(self, job):
+        """
+        Check drives of job are the same physical drives (description and size) than when job was queued
+
+        Args:
+            job (dict): install job (see InstallQueue.get_job)
+
+        Returns:
+            string: error message or None if drives were not replaced
+        """
+        if not job.get('drivesinfos'):
+            return None
+
+        drives = {drive['path']: drive for drive in self.get_flashable_drives()}
+        for path in job['drives']:
+            expected = job['drivesinfos'].get(path)
+            if expected is None:
+                continue
+            drive = drives.get(path)
+            if drive is None:
+                return 'Drive %s is not plugged anymore' % path
+            if drive['desc']!=expected['desc'] or drive['size']!=expected['size']:
+                return 'Drive %s was replaced since install was queued' % path
+
+        return None
+
+    def __update_job_status(self):
+        """
+        Save current install status in install queue
+        """
+        if self.status in (self.STATUS_DOWNLOADING, self.STATUS_DOWNLOADING_NOSIZE):
+            self.queue.set_status(self.job_id, InstallQueue.JOB_DOWNLOADING)
+        elif self.status in (self.STATUS_REQUEST_WRITE_PERMISSIONS, self.STATUS_FLASHING):
+            self.queue.set_status(self.job_id, InstallQueue.JOB_FLASHING)
+        elif self.status==self.STATUS_VALIDATING:
+            self.queue.set_status(self.job_id, InstallQueue.JOB_VALIDATING)
+        elif self.status==self.STATUS_DONE:
+            self.queue.set_status(self.job_id, InstallQueue.JOB_DONE)
+        elif self.status==self.STATUS_CANCELED:
+            self.queue.set_status(self.job_id, InstallQueue.JOB_CANCELED)
+        elif self.status>=self.STATUS_ERROR:
+            self.queue.set_status(self.job_id, InstallQueue.JOB_ERROR, 'Install failed with status %d' % self.status)
+
     def get_latest_raspbians(self):
         """
         Return latest raspbians releases
@@ -295,7 +430,7 @@ class Install(CleepDesktopModule):
         if not release:
             #no release found, surely rate limit reached on github api
             #fallback to cached releases
-            download = Download(self.context.paths.cache)
+            download = Download(self.context.paths.cache, cache_index=self.context.modules['cache'].get_cache_index())
             cached_releases = download.get_cached_files()
             self.logger.debug('Cached releases: %s' % cached_releases)
 
@@ -322,13 +457,14 @@ class Install(CleepDesktopModule):
         else:
             return self.github.get_release_assets_infos(release), release['name']
 
-    def start_install(self, url, drive, wifi):
+    def start_install(self, url, drive, wifi, drives=None):
         """
-        Set install data before launching process
+        Queue install. Several installs can be queued, they are processed in order
 
         Args:
             url (string): url of file to use during install
             drive (string): drive to install
+            drives (list): other drives to install at the same time (requires native flasher)
             wifi (dict): wifi configuration::
             
                 {
@@ -338,70 +474,136 @@ class Install(CleepDesktopModule):
                     hidden (bool): hidden network
                 }
 
+        Returns:
+            string: install job id
         """
         if url is None or len(url)==0:
             raise Exception('Invalid Url "%s"' % url)
         if drive is None or len(drive)==0:
             raise Exception('Invalid drive "%s"' % url)
-        if self.url is not None or self.drive is not None:
-            raise Exception('Installation is already running')
         if wifi and 'network' in wifi and (not 'password' in wifi or not 'encryption' in wifi):
             raise Exception('Missing wifi password or encryption value')
+        drives = [drive] + [item for item in set(drives or []) if item and item!=drive]
+        if len(drives)>1 and (not self.__is_native_flash_enabled() or (wifi and wifi.get('network'))):
+            raise Exception('Installation on several drives requires native flasher and wired connection')
+
+        for item in drives:
+            if self.env!='windows' and not os.path.exists(item):
+                raise Exception('Drive "%s" does not exist' % item)
 
         #get checksum
+        sha256 = None
         for iso in self.isos_cached['isos']:
             if iso['url']==url:
                 self.logger.debug('Found sha256 "%s" for iso "%s"' % (iso['sha256'], url))
-                self.iso_sha256 = iso['sha256']
+                sha256 = iso['sha256']
                 break
 
-        #generate wifi config file is needed
-        wifi_config = None
-        if wifi and wifi['network']:
-            self.logger.debug('Start install: wifi infos available')
-            try:
-                #prepare content
-                cleepwificonf = CleepWifiConf()
-                conf = cleepwificonf.create_content(wifi['network'], wifi['password'], wifi['encryption'], wifi['hidden'])
-                self.logger.debug('Generated wifi config file: %s' % conf)
+        #remember drives identity, they are checked again when job starts
+        drives_infos = {drive['path']: {'desc': drive['desc'], 'size': drive['size']} for drive in self.get_flashable_drives() if drive['path'] in drives}
 
-                #write content
-                wifi_config_file = tempfile.NamedTemporaryFile(mode='w+', delete=False)
-                wifi_config = wifi_config_file.name
-                wifi_config_file.write(conf)
-                wifi_config_file.close()
+        #queue install (run method processes queued jobs in order)
+        job = self.queue.add(url, drives, wifi if wifi and wifi.get('network') else None, sha256, drives_infos)
+        self.logger.debug('Start install: job %s queued with values: %s %s' % (job['id'], url, drives))
+        self.__update_ui_queue()
 
-            except:
-                self.logger.exception('Unable to store wifi config:')
-                wifi_config = None
-        else:
-            self.logger.debug('Start install: no wifi info specified')
+        return job['id']
+
+    def __update_ui_queue(self):
+        """
+        Send install status to ui (install queue changed)
+        """
+        self.context.update_ui('install', self.get_status())
+
+    def get_install_queue(self):
+        """
+        Return install jobs
+
+        Returns:
+            list: install jobs (see InstallQueue.get_jobs)
+        """
+        return self.queue.get_jobs()
+
+    def resume_install_job(self, job_id, wifi=None):
+        """
+        Confirm install job paused by application restart, so it is queued again. Drives are checked
+        again when job starts
+
+        Args:
+            job_id (string): job id
+            wifi (dict): wifi configuration (see start_install). Wifi configuration is not kept across restarts
+        """
+        if wifi and 'network' in wifi and (not 'password' in wifi or not 'encryption' in wifi):
+            raise Exception('Missing wifi password or encryption value')
+
+        self.queue.resume(job_id, wifi if wifi and wifi.get('network') else None)
+        self.__update_ui_queue()
 
-        #store data (setting self.url and self.drive will trigger install in run method)
-        self.url = url
-        self.drive = drive
-        self.wifi_config = wifi_config
-        self.logger.debug('Start install: install will start with values: %s %s %s' % (self.url, self.drive, self.wifi_config))
+    def remove_install_job(self, job_id):
+        """
+        Remove queued, paused or terminated install job. Running install must be canceled with cancel_install
+
+        Args:
+            job_id (string): job id
+        """
+        self.queue.remove(job_id)
+        self.__update_ui_queue()
 
     def cancel_install(self):
         """
-        Cancel current process
+        Cancel current process. Flag is set only if a job was dequeued and is not ended yet, so it is
+        reset when this job ends (see __reset_cancel) and never applied to next job
         """
-        self.logger.debug('Install canceled')
-        self.cancel = True
+        with self.__cancel_lock:
+            if not any([job['status'] in InstallQueue.JOB_RUNNING for job in self.queue.get_jobs()]):
+                self.logger.debug('No install running, nothing to cancel')
+                return
+            self.logger.debug('Install canceled')
+            self.cancel = True
+        if self.scheduler:
+            self.scheduler.cancel()
+        self.wakeup()
+
+    def cancel_drive_install(self, drive):
+        """
+        Cancel install of specified drive only (other drives installed at the same time keep on)
+
+        Args:
+            drive (string): drive path
+        """
+        if self.scheduler is None:
+            raise Exception('No drive install is running')
+        self.logger.debug('Install canceled on drive "%s"' % drive)
+        self.scheduler.cancel(drive)
 
     def get_status(self):
         """
         Return current install process percent
 
         Returns:
-            int: install process percent
+            dict: install status::
+                {
+                    percent (int): current step percent
+                    total_percent (int): install process percent
+                    status (int): install status
+                    eta (string): remaining time of current step
+                    throughput (dict): download throughput in bytes/second (instant, average)
+                    validation (dict): first native flash validation failure (drive, mismatchoffset, error) or None
+                    drives (list): status of each drive flashed with native flasher (see FlashScheduler.get_jobs)
+                    job (string): id of running install job (None if no install running)
+                    queue (list): install jobs (see InstallQueue.get_jobs)
+                }
         """
         return {
             'percent': self.percent,
             'total_percent': self.total_percent,
             'status': self.status,
-            'eta': self.eta
+            'eta': self.eta,
+            'throughput': self.throughput,
+            'validation': self.validation,
+            'drives': self.jobs,
+            'job': self.job_id,
+            'queue': self.queue.get_jobs(),
         }
 
     def get_flashable_drives(self):
@@ -707,8 +909,17 @@ class Install(CleepDesktopModule):
         self.percent = percent
         self.total_percent = int(self.percent / 3)
 
-        #save eta
-        self.eta = '%.1fMo' % (float(filesize)/1000000.0)
+        #save eta and throughput
+        infos = self.dl.progress.get_infos() if self.dl else None
+        if infos and infos['eta'] is not None and status==Download.STATUS_DOWNLOADING:
+            self.eta = '%dm%02ds' % (infos['eta'] // 60, infos['eta'] % 60)
+        else:
+            self.eta = '%.1fMo' % (float(filesize)/1000000.0)
+        if infos:
+            self.throughput = {
+                'instant': infos['instantrate'],
+                'average': infos['averagerate'],
+            }
 
         if self.cancel:
             #cancel download
@@ -723,7 +934,7 @@ class Install(CleepDesktopModule):
         Download file task
         """
         #check values
-        if self.url is None or self.drive is None:
+        if self.url is None or len(self.drives)==0:
             self.logger.debug('No drive or url specified, install process stopped')
             return False
 
@@ -738,16 +949,57 @@ class Install(CleepDesktopModule):
             return True
 
         #init download helper
-        self.dl = Download(self.context.paths.cache, self.__download_callback)
+        self.dl = Download(self.context.paths.cache, self.__download_callback, self.context.modules['cache'].get_cache_index(), self.context.modules['cache'].get_rate_limiter())
 
-        #start download
-        self.iso = self.dl.download_from_url(self.url, check_sha256=self.iso_sha256, cache=True)
+        #get image already extracted by other CleepDesktop instances. Extracted image checksum must be
+        #trusted: it is only known if archive was already extracted locally (cached image was evicted)
+        self.iso = None
+        cache_index = self.context.modules['cache'].get_cache_index()
+        extracted_sha256 = cache_index.get_extracted_sha256(self.iso_sha256) if self.iso_sha256 else None
+        if extracted_sha256 and not cache_index.find_by_sha256(self.iso_sha256) and not cache_index.find_by_source_sha256(self.iso_sha256):
+            urls = self.context.modules['devices'].get_cache_sources(extracted_sha256)
+            if len(urls)>0:
+                self.logger.info('Download image extracted by other CleepDesktop instances')
+                self.iso = self.dl.download_from_url(urls[0], check_sha256=extracted_sha256, cache=True, segments=self.DOWNLOAD_SEGMENTS, sources=urls[1:])
+                if self.iso:
+                    cache_index.add_alias(extracted_sha256, self.url, self.iso_sha256)
+
+        #start download (archive is extracted on the fly)
+        if not self.iso and not self.cancel:
+            self.iso = self.dl.download_from_url(self.url, check_sha256=self.iso_sha256, cache=True, segments=self.DOWNLOAD_SEGMENTS, sources=self.__get_download_sources(self.url), extract=True, sparse=self.context.modules['cache'].get_cache_sparse())
         self.dl = None
 
         if self.iso is None:
             return False
+
+        #share new cached file with other CleepDesktop instances
+        self.context.modules['devices'].advertise_cache()
+
         return True
 
+    def __get_download_sources(self, url):
+        """
+        Return alternative sources of specified url: other CleepDesktop instances of local network that
+        cached the same file (only if file checksum is known), then configured mirrors. A mirror is a base
+        url serving files with the same name as origin ones
+
+        Args:
+            url (string): origin url
+
+        Returns:
+            list: ordered list of alternative urls
+        """
+        sources = []
+        if self.iso_sha256:
+            sources += self.context.modules['devices'].get_cache_sources(self.iso_sha256)
+
+        mirrors = self.context.config.get_config_value('cleep.mirrors') or []
+        filename = os.path.basename(urlparse(url).path)
+        if filename:
+            sources += ['%s/%s' % (mirror.rstrip('/'), filename) for mirror in mirrors if mirror]
+
+        return sources
+
     def __install_callback(self, stdout, stderr):
         """
         Install process callback
@@ -820,8 +1072,144 @@ class Install(CleepDesktopModule):
         #update ui
         self.__update_ui()
         
-        #reset console
+        #reset console and wake up install process
         self.console = None
+        self.wakeup()
+
+    def __is_native_flash_enabled(self):
+        """
+        Return True if native flasher is enabled and supported
+
+        Returns:
+            bool: True if native flasher is enabled
+        """
+        return self.env=='linux' and bool(self.context.config.get_config_value('cleep.nativeflash')) and Flasher.is_supported()
+
+    def __can_flash_native(self):
+        """
+        Return True if drives can be flashed with native flasher instead of flash script
+
+        Returns:
+            bool: True if native flasher can be used
+        """
+        if not self.__is_native_flash_enabled():
+            return False
+        if self.wifi_config:
+            #wifi config is copied to drive partition by flash script
+            return False
+        for drive in self.drives:
+            if not os.access(drive, os.W_OK):
+                self.logger.info('No write access to drive "%s", use flash script' % drive)
+                return False
+
+        #drive partitions must not be mounted
+        try:
+            with open('/proc/mounts', 'r') as f:
+                for line in f.readlines():
+                    for drive in self.drives:
+                        if line.startswith(drive):
+                            self.logger.info('Drive "%s" is mounted, use flash script' % drive)
+                            return False
+        except:
+            self.logger.exception('Unable to check mounted partitions:')
+            return False
+
+        #native flasher writes raw images only
+        with open(self.iso, 'rb') as f:
+            if f.read(len(ZipStream.LOCAL_HEADER_SIGNATURE))==ZipStream.LOCAL_HEADER_SIGNATURE:
+                return False
+
+        return True
+
+    def __get_iso_blockmap(self):
+        """
+        Return block map of iso if it is cached as sparse file
+
+        Returns:
+            dict: block map (see SparseFile.get_blockmap) or None if iso has no block map
+        """
+        for entry in self.context.modules['cache'].get_cache_index().get_entries():
+            if entry['filepath']==self.iso and entry.get('blockmap'):
+                try:
+                    return SparseFile.load_blockmap(entry['blockmap'])
+                except:
+                    self.logger.exception('Unable to load block map of "%s":' % self.iso)
+
+        return None
+
+    def __scheduler_callback(self, jobs):
+        """
+        Flash scheduler status callback. Overall progress is computed from all drives jobs
+
+        Args:
+            jobs (list): jobs status (see FlashScheduler.get_jobs)
+        """
+        self.jobs = jobs
+
+        #flash is first half of job and validation second one
+        percents = []
+        etas = []
+        throughput = 0
+        for job in jobs:
+            if job['status'] in FlashScheduler.JOB_ENDED:
+                percents.append(100)
+                continue
+            if job['status']==FlashScheduler.JOB_VALIDATING:
+                percents.append(50 + int(job['percent']/2))
+            else:
+                percents.append(int(job['percent']/2))
+            if job['eta'] is not None:
+                etas.append(job['eta'])
+            throughput += job['throughput']
+
+        #install is validating only once all drives left to install are validating (queued drives are not flashed yet)
+        validating = all([job['status']==FlashScheduler.JOB_VALIDATING for job in jobs if job['status'] not in FlashScheduler.JOB_ENDED])
+        self.status = self.STATUS_VALIDATING if validating else self.STATUS_FLASHING
+        self.percent = int(sum(percents) / len(percents)) if len(percents)>0 else 0
+        self.total_percent = 33 + int(self.percent*2/3)
+        if len(etas)>0:
+            self.eta = '%dm%02ds' % (max(etas) // 60, max(etas) % 60)
+        self.throughput = {
+            'instant': throughput,
+            'average': throughput,
+        }
+
+        #drives status is not part of __update_ui change detection
+        self.context.update_ui('install', self.get_status())
+
+    def __flash_drive_native(self):
+        """
+        Flash and validate drives with native flasher. Drives are flashed in parallel. This function is blocking
+        """
+        self.status = self.STATUS_FLASHING
+        self.__flash_output_error = False
+        try:
+            blockmap = self.__get_iso_blockmap()
+            self.scheduler = FlashScheduler(self.__scheduler_callback)
+            for drive in self.drives:
+                self.scheduler.add_job(drive, self.iso, blockmap)
+            if self.cancel:
+                self.scheduler.cancel()
+            if not self.scheduler.run() and not self.cancel:
+                self.logger.error('Native flash failed: %s' % self.scheduler.get_jobs())
+                self.__flash_output_error = True
+
+            self.jobs = self.scheduler.get_jobs()
+            for job in self.jobs:
+                if job['status']==FlashScheduler.JOB_MISMATCH:
+                    self.validation = {
+                        'drive': job['drive'],
+                        'mismatchoffset': job['mismatchoffset'],
+                        'error': job['error'],
+                    }
+                    break
+
+        except:
+            self.logger.exception('Exception occured during native drive flashing:')
+            self.__flash_output_error = True
+
+        finally:
+            self.scheduler = None
 
     def __flash_drive(self):
         """
@@ -830,6 +1218,14 @@ class Install(CleepDesktopModule):
         if self.console is not None:
             raise Exception(u'Flashing operation is already running')
 
+        if self.__can_flash_native():
+            self.logger.info('Flash drives %s with native flasher' % self.drives)
+            return self.__flash_drive_native()
+        if len(self.drives)>1:
+            self.logger.error('Drives %s can not be flashed at the same time without native flasher' % self.drives)
+            self.__flash_output_error = True
+            return
+
         self.status = self.STATUS_FLASHING
         try:
             #fix wifi config value, must be string
@@ -145,7 +145,7 @@ class Updates(CleepDesktopModule):
 
     def run(self):
         """
-        Start update process. Does nothing until check_updates is called and trigger update if necessary
+        Start update process. Waits until check_updates is called and trigger update if necessary
         """
         self.logger.debug('Updates thread started')
 
@@ -202,8 +202,8 @@ class Updates(CleepDesktopModule):
                     #end of etcher update process, reset variables
                     self.__download_etcher = None
 
-            #release CPU
-            time.sleep(1.0)
+            #wait for an update to download
+            self._wait()
 
         self.logger.debug('Updates thread stopped')
 
@@ -358,8 +358,9 @@ class Updates(CleepDesktopModule):
         infos = self.__check_etcher_updates(config['config']['etcher']['version'])
         self.logger.debug('Check balena-cli version: %s' % infos)
         if infos.update_available and not infos.error:
-            #set member to trigger download in run function
+            #set member and wake up module to trigger download in run function
             self.__download_etcher = infos
+            self.wakeup()
 
         #prepare output
         update_available = False
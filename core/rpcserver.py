@@ -7,8 +7,9 @@ Rpcserver implements:
  - authentication (login, password)
  - HTTP and HTTPS support
  - file upload and download
+ - cached files serving (zero-copy)
  - websocket requests
- - command requests
+ - command requests (synchronous or asynchronous)
  - module configs requests
  - devices list requests
 """
@@ -25,6 +26,7 @@ from contextlib import contextmanager
 from threading import Lock
 import time
 import uuid
+import gevent
 from gevent import __version__ as gevent_version
 from gevent import queue
 from gevent import monkey; monkey.patch_all()
@@ -32,13 +34,11 @@ from gevent import pywsgi
 from gevent.pywsgi import LoggingLogAdapter
 from geventwebsocket import get_version as geventwebsocket_version
 from geventwebsocket import WebSocketError
-from geventwebsocket.handler import WebSocketHandler
 import bottle
 from bottle import auth_basic, response
 from passlib import __version__ as passlib_version
 from passlib.hash import sha256_crypt
 from requests import __version__ as requests_version
-from queue import Queue, Empty
 
 from core.libs.appconfig import AppConfig
 from core.utils import MessageResponse, AppContext
@@ -50,6 +50,10 @@ from core.modules.cache import Cache
 from core.libs.crashreport import CrashReport
 from core.libs.download import Download
 from core.libs.cleepdesktoplogs import CleepDesktopLogs
+from core.libs.sendfile import SendfileHandler, FileRange
+from core.libs.commandexecutor import CommandExecutor
+from core.libs.websockethub import WebSocketHub
+from core.libs.eventcoalescer import EventCoalescer
 from core.exceptions import CommandError
 
 __all__ = ['app']
@@ -62,8 +66,13 @@ ETCHER_DIR = 'etcher-cli'
 #globals
 context = AppContext()
 app = bottle.app()
+lan_app = bottle.Bottle()
 modules = {}
-ws_updates = Queue()
+#events carrying a full state snapshot can be coalesced for slow websocket clients
+ws_hub = WebSocketHub(coalesced_events=['install', 'updates'])
+#high frequency events are published at most every 100ms
+event_coalescer = EventCoalescer(ws_hub.publish, {'install': 0.1, 'updates': 0.1})
+command_executor = None
 
 class CleepWebSocketMessage():
     def __init__(self):
@@ -84,19 +93,15 @@ class CleepWebSocketMessage():
 def update_ui(event, data):
     """
     Update ui callback.
-    Data will be processed in websocket background task
+    Data is published to all websocket clients (high frequency events are coalesced)
 
     Args:
         event (string): event name
         data (any): event data
     """
-    global  ws_updates
+    global event_coalescer
 
-    #push data to queue
-    ws_updates.put_nowait({
-        'event': event,
-        'data': data,
-    })
+    event_coalescer.push(event, data)
 
 def configure_app(app_path, cache_path, config_path, config_filename, debug, is_dev):
     """
@@ -113,7 +118,7 @@ def configure_app(app_path, cache_path, config_path, config_filename, debug, is_
     Returns:
         AppContext: application context (that contains crash_report, logger...)
     """
-    global app, context
+    global app, context, command_executor
 
     #fill context
     context.paths.app = '.' if len(app_path)==0 else app_path 
@@ -208,6 +213,9 @@ def configure_app(app_path, cache_path, config_path, config_filename, debug, is_
     context.modules['updates'] = Updates(context, debug)
     context.modules['updates'].start()
 
+    #async commands results are sent through websocket
+    command_executor = CommandExecutor(context.modules, lambda result: update_ui('command', result))
+
     return context
 
 def start(host='127.0.0.1', port=80, key=None, cert=None):
@@ -228,19 +236,22 @@ def start(host='127.0.0.1', port=80, key=None, cert=None):
     context.modules['devices'].get_devices()
     context.modules['updates'].get_status()
 
+    #start LAN sharing server
+    lan_server = start_lan_server()
+
     try:
         if key is not None and len(key)>0 and cert is not None and len(cert)>0:
             #start HTTPS server
             context.main_logger.info('Starting HTTPS server on %s:%d' % (host, port))
             server_logger = LoggingLogAdapter(context.main_logger, logging.INFO)
-            server = pywsgi.WSGIServer((host, port), app, keyfile=key, certfile=cert, log=server_logger, handler_class=WebSocketHandler)
+            server = pywsgi.WSGIServer((host, port), app, keyfile=key, certfile=cert, log=server_logger, handler_class=SendfileHandler)
             server.serve_forever()
 
         else:
             #start HTTP server
             context.main_logger.info('Starting HTTP server on %s:%d' % (host, port))
             server_logger = LoggingLogAdapter(context.main_logger, logging.INFO)
-            server = pywsgi.WSGIServer((host, port), app, log=server_logger, handler_class=WebSocketHandler)
+            server = pywsgi.WSGIServer((host, port), app, log=server_logger, handler_class=SendfileHandler)
             server.serve_forever()
 
     except KeyboardInterrupt:
@@ -264,12 +275,44 @@ def start(host='127.0.0.1', port=80, key=None, cert=None):
         #close server properly
         if server and not server.closed:
             server.close()
+        if lan_server and not lan_server.closed:
+            lan_server.close()
+
+def start_lan_server():
+    """
+    Start LAN sharing server (non blocking). It serves cached files to other CleepDesktop
+    instances of local network, so it listens on all interfaces
+
+    Returns:
+        WSGIServer: LAN server instance or None if LAN sharing is disabled
+    """
+    global lan_app, context
+
+    lan_sharing = context.modules['cache'].get_lan_sharing()
+    if not lan_sharing['enabled']:
+        context.main_logger.info('LAN sharing disabled')
+        return None
+
+    try:
+        context.main_logger.info('Starting LAN sharing server on port %d' % lan_sharing['port'])
+        server_logger = LoggingLogAdapter(context.main_logger, logging.INFO)
+        server = pywsgi.WSGIServer(('0.0.0.0', lan_sharing['port']), lan_app, log=server_logger, handler_class=SendfileHandler)
+        server.start()
+        return server
+
+    except:
+        context.main_logger.exception('LAN sharing server failed to start:')
+        return None
 
 def stop():
     """
     Stop all running processes
     """
-    global context
+    global context, command_executor, event_coalescer
+
+    if command_executor:
+        command_executor.stop()
+    event_coalescer.stop()
 
     for _, module in context.modules.items():
         module.stop()
@@ -287,8 +330,13 @@ def enable_cors():
 def command():
     """
     Communication between javascript and python
+
+    If "async" is set in request, command is executed in background and its job id is returned
+    immediately ({jobid: string}). Command result is sent later through websocket ("command" event).
+    Optional "timeout" (seconds) drops command result if it lasts too long. Only commands listed in
+    CommandExecutor.ASYNC_COMMANDS can be executed in background.
     """
-    global context
+    global context, command_executor
 
     #context.main_logger.debug('Command (method=%s)' % bottle.request.method)
     if bottle.request.method=='OPTIONS':
@@ -308,7 +356,12 @@ def command():
             #context.main_logger.debug('Execute command %s with params %s' % (command, params))
             if not to in context.modules:
                 raise CommandError('Module "%s" does not exist' % to)
-            resp.data = context.modules[to].execute_command(command, params)
+            if data.get('async', False):
+                resp.data = {
+                    'jobid': command_executor.submit(to, command, params, data.get('timeout', None)),
+                }
+            else:
+                resp.data = context.modules[to].execute_command(command, params)
 
         except Exception as e:
             context.main_logger.exception('Error occured during command execution:')
@@ -319,12 +372,106 @@ def command():
         #send response
         return json.dumps(resp.to_dict())
 
+@app.route('/command/cancel', method=['OPTIONS', 'POST'])
+def cancel_command():
+    """
+    Cancel asynchronous command. A pending command is never executed, a running command is not
+    interrupted but its result is dropped (see CommandExecutor)
+    """
+    global context, command_executor
+
+    if bottle.request.method=='OPTIONS':
+        return {}
+    else:
+        resp = MessageResponse()
+        try:
+            data = bottle.request.json
+            # pylint: disable=E1136, E1135
+            job_id = data['jobid'] if 'jobid' in data else None
+            # pylint: enable=E1136, E1135
+            resp.data = command_executor.cancel(job_id)
+
+        except Exception as e:
+            context.main_logger.exception('Error occured during command cancelation:')
+            resp.error = True
+            resp.message = str(e)
+
+        #send response
+        return json.dumps(resp.to_dict())
+
+def serve_cached_file(filepath, sha256):
+    """
+    Serve cached file. Cache is content addressed so file checksum is used as strong ETag.
+    Single range requests are supported. File content is sent with sendfile by SendfileHandler
+
+    Args:
+        filepath (string): cached file path
+        sha256 (string): cached file checksum
+
+    Returns:
+        FileRange: response body
+    """
+    if not filepath or not os.path.exists(filepath):
+        bottle.abort(404, 'File not found')
+
+    size = os.path.getsize(filepath)
+    etag = '"%s"' % sha256
+    response.set_header('ETag', etag)
+    response.set_header('Accept-Ranges', 'bytes')
+    response.content_type = 'application/octet-stream'
+
+    #content is not modified
+    if_none_match = bottle.request.get_header('If-None-Match')
+    if if_none_match and (if_none_match.strip()=='*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+        response.status = 304
+        return ''
+
+    #range request (ignored if If-Range does not match)
+    offset = 0
+    length = size
+    range_header = bottle.request.get_header('Range')
+    if_range = bottle.request.get_header('If-Range')
+    if range_header and (not if_range or if_range.strip()==etag):
+        ranges = list(bottle.parse_range_header(range_header, size))
+        if len(ranges)==0:
+            response.status = 416
+            response.set_header('Content-Range', 'bytes */%d' % size)
+            return ''
+        offset, end = ranges[0]
+        length = end - offset
+        response.status = 206
+        response.set_header('Content-Range', 'bytes %d-%d/%d' % (offset, end - 1, size))
+    response.set_header('Content-Length', str(length))
+
+    if bottle.request.method=='HEAD':
+        return ''
+
+    return FileRange(filepath, offset, length)
+
+@app.route('/cache/<sha256:re:[0-9a-f]{64}>', method=['GET', 'HEAD'])
+def cache(sha256):
+    """
+    Serve cached file to local tools
+    """
+    global context
+
+    return serve_cached_file(context.modules['cache'].get_cached_filepath(sha256), sha256)
+
+@lan_app.route('/cache/<sha256:re:[0-9a-f]{64}>', method=['GET', 'HEAD'])
+def lan_cache(sha256):
+    """
+    Serve cached file to other CleepDesktop instances
+    """
+    global context
+
+    return serve_cached_file(context.modules['cache'].get_shared_filepath(sha256), sha256)
+
 @app.route('/cleepws')
 def handle_cleepwebsocket():
     """
     Devices websocket. Communication between python and javascript
     """
-    global context, ws_updates
+    global context, ws_hub
 
     #init websocket
     wsock = bottle.request.environ.get('wsgi.websocket')
@@ -332,26 +479,42 @@ def handle_cleepwebsocket():
         context.main_logger.error('Expected WebSocket request')
         bottle.abort(400, 'Expected WebSocket request')
 
-    #now wait for data to send
-    while True:
+    #each client has its own events queue
+    subscriber_id = ws_hub.subscribe()
 
+    def watch_close():
+        #client does not send anything, receive returns None when websocket is closed
         try:
-            event = ws_updates.get(block=True, timeout=0.25)
-
-            #send data to socket
-            send = CleepWebSocketMessage()
-            send.event = event['event']
-            send.data = event['data']
-            wsock.send(send.to_json())
-
-        except Empty:
-            # no event on FIFO
+            while wsock.receive() is not None:
+                pass
+        except:
             pass
+        ws_hub.unsubscribe(subscriber_id)
+    watcher = gevent.spawn(watch_close)
 
-        except WebSocketError:
-            # stop statement, websocket will restart
-            break
+    #now wait for data to send
+    try:
+        while True:
+            event = ws_hub.get(subscriber_id)
+            if event is None:
+                #client disconnected
+                break
+
+            try:
+                #send data to socket
+                send = CleepWebSocketMessage()
+                send.event = event['event']
+                send.data = event['data']
+                wsock.send(send.to_json())
+
+            except WebSocketError:
+                # stop statement, websocket will restart
+                break
+
+            except:
+                context.main_logger.exception('Exception occured in WebSocket handler:')
+                context.crash_report.report_exception()
 
-        except:
-            context.main_logger.exception('Exception occured in WebSocket handler:')
-            context.crash_report.report_exception()
+    finally:
+        ws_hub.unsubscribe(subscriber_id)
+        watcher.kill(block=False)
@@ -3,9 +3,10 @@
 
 __all__ = ['MessageResponse', 'MessageRequest', 'CleepDesktopModule', 'AppContext', 'AppPaths']
 
-from threading import Thread
+from threading import Thread, Event
 import logging
-import time
+import gevent
+from gevent import monkey
 from core.exceptions import CommandError, InvalidMessage
 
 class AppPaths():
@@ -32,7 +33,15 @@ class AppContext():
 class CleepDesktopModule(Thread):
     """
     CleepDesktopModule handles default behavior for CleepDesktop module
+
+    Module thread does not poll: between two _custom_process calls it waits until it is woken up
+    (command executed, wakeup called, module stopped) or PROCESS_TIMEOUT expires, so idle modules
+    don't use cpu.
     """
+
+    #seconds between two _custom_process calls when module is not woken up (None to wait for wakeup only)
+    PROCESS_TIMEOUT = None
+
     def __init__(self, context, debug_enabled):
         """
         Constructor
@@ -54,6 +63,11 @@ class CleepDesktopModule(Thread):
         self.context = context
         self.crash_report = context.crash_report
         self.running = True
+        self.__wakeup_event = Event()
+        self.__hub = gevent.get_hub()
+        #native thread id, greenlet id is returned by threading.get_ident when monkey patching is enabled
+        self.__get_ident = monkey.get_original('threading', 'get_ident')
+        self.__thread_id = self.__get_ident()
 
     def __del__(self):
         """
@@ -92,6 +106,33 @@ class CleepDesktopModule(Thread):
         """
         self._custom_stop()
         self.running = False
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        Wake up module thread waiting in _wait. This function can be called from any thread (async
+        commands run in pool threads): module is woken up from application (hub) thread
+        """
+        if self.__get_ident()!=self.__thread_id:
+            self.__hub.loop.run_callback_threadsafe(self.__wakeup_event.set)
+            return
+
+        self.__wakeup_event.set()
+
+    def _wait(self, timeout=None):
+        """
+        Wait until module is woken up or timeout expires
+
+        Args:
+            timeout (float): maximum time to wait in seconds (None to wait until wakeup)
+
+        Returns:
+            bool: True if module was woken up, False if timeout expired
+        """
+        woken_up = self.__wakeup_event.wait(timeout)
+        self.__wakeup_event.clear()
+
+        return woken_up
 
     def _configure(self):
         """
@@ -123,7 +164,11 @@ class CleepDesktopModule(Thread):
             raise CommandError('Command "%s" not found in "%s"' % (command, self.__class__.__name__))
 
         module_function = getattr(self, command)
-        return module_function(**params)
+        try:
+            return module_function(**params)
+        finally:
+            #command may have queued some work for module thread
+            self.wakeup()
 
     def run(self):
         """
@@ -135,7 +180,8 @@ class CleepDesktopModule(Thread):
 
         while self.running:
             self._custom_process()
-            time.sleep(0.10)
+            if self.PROCESS_TIMEOUT!=0:
+                self._wait(self.PROCESS_TIMEOUT)
 
         self.logger.debug('%s thread stopped' % self.__class__.__name__)
     
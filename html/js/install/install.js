@@ -46,6 +46,25 @@ var installController = function($rootScope, toast, confirm, logger, updateServi
             });
     };
 
+    //open drive dialog to add another drive to install at the same time
+    self.openOtherDriveDialog = function() {
+        self.modal.open('driveController', 'js/install/drive-dialog.html')
+            .then(function(res) {
+                var config = self.installService.installConfig;
+                if( res.path===config.drive.path || config.drives.some(function(drive) { return drive.path===res.path; }) ) {
+                    toast.error('Drive already selected');
+                    return;
+                }
+                config.drives.push(res);
+            });
+    };
+
+    //remove other drive
+    self.removeOtherDrive = function(drive) {
+        var drives = self.installService.installConfig.drives;
+        drives.splice(drives.indexOf(drive), 1);
+    };
+
     //open wifi dialog
     self.openWifiDialog = function() {
         self.modal.open('wifiController', 'js/install/wifi-dialog.html', {
@@ -61,6 +80,7 @@ var installController = function($rootScope, toast, confirm, logger, updateServi
     {
         logger.debug('Reset fields');
         self.installService.installConfig.drive = null;
+        self.installService.installConfig.drives = [];
         self.installService.installConfig.iso = null;
         self.installService.installConfig.wifiChoice = 0;
         self.installService.installConfig.wifi = null;
@@ -72,6 +92,12 @@ var installController = function($rootScope, toast, confirm, logger, updateServi
         return updateService.isEtcherAvailable();
     }
 
+    //return native flasher availability (needed to install several drives at the same time)
+    self.isNativeFlashEnabled = function()
+    {
+        return settings.get('cleep.nativeflash');
+    };
+
     //start install process
     self.startInstall = function()
     {
@@ -101,6 +127,7 @@ var installController = function($rootScope, toast, confirm, logger, updateServi
                 var data = {
                     url: self.installService.installConfig.iso.url,
                     drive: self.installService.installConfig.drive.path,
+                    drives: self.installService.installConfig.drives.map(function(drive) { return drive.path; }),
                     wifi: self.installService.installConfig.wifi
                 };
                 logger.debug('Flash data:', data);
@@ -162,6 +189,53 @@ var installController = function($rootScope, toast, confirm, logger, updateServi
         }
     };
 
+    //return queued install jobs (and jobs paused by application restart)
+    self.getQueuedJobs = function()
+    {
+        return (self.installService.status.queue || []).filter(function(job) {
+            return job.status==='queued' || job.status==='paused';
+        });
+    };
+
+    //return install job label
+    self.getJobLabel = function(job)
+    {
+        for( var i=0; i<self.installService.isos.isos.length; i++ ) {
+            if( self.installService.isos.isos[i].url===job.url ) {
+                return self.installService.isos.isos[i].label;
+            }
+        }
+        return job.url.split('/').pop();
+    };
+
+    //remove queued install job
+    self.removeInstallJob = function(jobId)
+    {
+        installService.removeInstallJob(jobId);
+    };
+
+    //confirm install job paused by application restart
+    self.resumeInstallJob = function(job)
+    {
+        var message = 'Make sure drives ' + job.drives.join(', ') + ' are still the ones to install.';
+        if( job.haswifi ) {
+            message += ' Wifi configuration is not kept after a restart, device will be installed without wifi.';
+        }
+        confirm.open('Resume installation?', message, 'Yes, resume', 'No')
+            .then(function() {
+                installService.resumeInstallJob(job.id);
+            });
+    };
+
+    //cancel install on a single drive
+    self.cancelDriveInstall = function(drive)
+    {
+        confirm.open('Cancel installation on ' + drive + '?', 'Canceling installation during this step of process will put your removable media in inconsistant state.', 'Yes, cancel', 'No, continue')
+            .then(function() {
+                installService.cancelDriveInstall(drive);
+            });
+    };
+
     //download iso file
     self.downloadIso = function()
     {
@@ -14,6 +14,7 @@ var preferencesController = function($rootScope, $scope, cleepService, debounce,
     self.logs = '';
     self.cacheDir = '';
     self.cacheds = [];
+    self.cacheStats = {};
     self.closeModal = closeModal;
 
     //automatic settings saving when config value changed
@@ -62,7 +63,8 @@ var preferencesController = function($rootScope, $scope, cleepService, debounce,
 
         cleepService.sendCommand('get_cached_files', 'cache')
             .then(function(resp) {
-                self.cacheds = resp.data;
+                self.cacheds = resp.data.files;
+                self.cacheStats = resp.data.stats;
             });
     };
 
@@ -109,7 +111,8 @@ var preferencesController = function($rootScope, $scope, cleepService, debounce,
     self.purgeCacheFile = function(filename) {
         cleepService.sendCommand('delete_cached_file', 'cache', {filename:filename})
             .then(function(resp) {
-                self.cacheds = resp.data;
+                self.cacheds = resp.data.files;
+                self.cacheStats = resp.data.stats;
             });
     };
 
@@ -117,7 +120,17 @@ var preferencesController = function($rootScope, $scope, cleepService, debounce,
     self.purgeCachedFiles = function() {
         cleepService.sendCommand('purge_cached_files', 'cache')
             .then(function(resp) {
-                self.cacheds = resp.data;
+                self.cacheds = resp.data.files;
+                self.cacheStats = resp.data.stats;
+            });
+    };
+
+    // Extract cached archives
+    self.inflateCachedFiles = function() {
+        cleepService.sendCommand('inflate_cached_files', 'cache')
+            .then(function(resp) {
+                self.cacheds = resp.data.files;
+                self.cacheStats = resp.data.stats;
             });
     };
 
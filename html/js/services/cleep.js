@@ -5,6 +5,7 @@
  * Message received on websocket is broadcasted to angular rootScope
  *
  * It implements command sending with response (send() function)
+ * Long commands can be sent asynchronously (sendCommandAsync() function): command result is received on websocket
  * Some commands shortcuts are also available (getConfig, setConfig...)
  */
 var cleepService = function($http, $q, $rootScope, toast, $websocket, logger, settings) {
@@ -15,6 +16,11 @@ var cleepService = function($http, $q, $rootScope, toast, $websocket, logger, se
     self.__ws = null;
     self.port = settings.get('remote.rpcport');
     self.urlCommand = 'http://localhost:' + self.port + '/command';
+    self.urlCancelCommand = 'http://localhost:' + self.port + '/command/cancel';
+    //async commands waiting for result (jobid => defer)
+    self.__asyncCommands = {};
+    //async commands results received before job id (jobid => result)
+    self.__asyncResults = {};
 
     /**
      * Connect websocket to python server
@@ -48,14 +54,44 @@ var cleepService = function($http, $q, $rootScope, toast, $websocket, logger, se
         if( event && event.data && typeof(event.data)==='string' ) {
             //broadcast received data
             var data = JSON.parse(event.data);
-            $rootScope.$broadcast(data.event, data.data);
+            if( data.event==='command' ) {
+                self.__asyncCommandResult(data.data);
+            } else {
+                $rootScope.$broadcast(data.event, data.data);
+            }
+        }
+    };
+
+    /**
+     * Handle async command result received on websocket
+     */
+    self.__asyncCommandResult = function(result) {
+        var d = self.__asyncCommands[result.jobid];
+        if( !d ) {
+            //result received before command response
+            self.__asyncResults[result.jobid] = result;
+            return;
+        }
+
+        delete self.__asyncCommands[result.jobid];
+        if( result.error ) {
+            if( result.status!=='canceled' ) {
+                toast.error(result.message);
+            }
+            d.reject(result.message);
+        } else {
+            d.resolve({
+                error: result.error,
+                message: result.message,
+                data: result.data
+            });
         }
     };
 
     /**
      * Base function to send data to rpcserver
      */
-    self.send = function(url, command, to, params, method)
+    self.send = function(url, command, to, params, method, extra)
     {
         var d = $q.defer();
 
@@ -73,6 +109,9 @@ var cleepService = function($http, $q, $rootScope, toast, $websocket, logger, se
             to: to,
             params: params,
         };
+        if( extra ) {
+            angular.extend(data, extra);
+        }
 
 		$http({
             method: method,
@@ -103,6 +142,43 @@ var cleepService = function($http, $q, $rootScope, toast, $websocket, logger, se
         return self.send(self.urlCommand, command, to, params, 'POST');
     };
 
+    /**
+     * Send command to rpcserver and execute it in background
+     * Returned promise is resolved when command result is received on websocket
+     *
+     * @param timeout: command timeout in seconds (optional)
+     */
+    self.sendCommandAsync = function(command, to, params, timeout) {
+        var d = $q.defer();
+
+        self.send(self.urlCommand, command, to, params, 'POST', {async:true, timeout:timeout})
+            .then(function(resp) {
+                var jobid = resp.data.jobid;
+                self.__asyncCommands[jobid] = d;
+                if( self.__asyncResults[jobid] ) {
+                    var result = self.__asyncResults[jobid];
+                    delete self.__asyncResults[jobid];
+                    self.__asyncCommandResult(result);
+                }
+            }, function(err) {
+                d.reject(err);
+            });
+
+        return d.promise;
+    };
+
+    /**
+     * Cancel async command
+     */
+    self.cancelCommand = function(jobid) {
+        return $http({
+            method: 'POST',
+            url: self.urlCancelCommand,
+            data: {jobid: jobid},
+            responseType:'json'
+        });
+    };
+
     /**
      * Get CleepDesktop config
      */
@@ -8,9 +8,11 @@ var devicesService = function($rootScope, cleepService)
     self.devices = [];
     self.unconfigured = 0;
     self.configured = 0;
+    //sequence number of last devices change applied (-1 until devices list is loaded)
+    self.seq = -1;
 
     //Smart devices sync, it updates existing devices, adds new ones and removes deleted ones
-    self.__syncDevices = function(devices, removedDevice) {
+    self.__syncDevices = function(devices, removedUuids) {
         if( devices ) {
             //add and update devices
             var found = false;
@@ -42,26 +44,31 @@ var devicesService = function($rootScope, cleepService)
             }
         }
 
-        //remove device
-        if( removedDevice ) {
-            var indexToDelete = -1;
-            for( var i=0; i<self.devices.length; i++ ) {
-                if( self.devices[i].uuid===removedDevice.uuid ) {
-                    indexToDelete = i;
-                    break;
+        //remove devices
+        if( removedUuids ) {
+            for( var k=0; k<removedUuids.length; k++ ) {
+                var indexToDelete = -1;
+                for( var i=0; i<self.devices.length; i++ ) {
+                    if( self.devices[i].uuid===removedUuids[k] ) {
+                        indexToDelete = i;
+                        break;
+                    }
                 }
-            }
 
-            if( indexToDelete>=0 ) {
-                self.devices.splice(i, 1);
+                if( indexToDelete>=0 ) {
+                    self.devices.splice(indexToDelete, 1);
+                }
             }
         }
     };
 
     //update devices list
-    self.__updateDevices = function(responseData, removedDevice) {
+    self.__updateDevices = function(responseData, removedUuids) {
         //sync devices
-        self.__syncDevices(responseData.devices, removedDevice);
+        self.__syncDevices(responseData.devices, removedUuids);
+        if( responseData.seq!==undefined && responseData.seq>self.seq ) {
+            self.seq = responseData.seq;
+        }
 
         //sort devices list
         self.devices.sort((a, b) => {
@@ -92,11 +99,36 @@ var devicesService = function($rootScope, cleepService)
         }
     };
 
+    //apply devices changes received from core
+    self.__applyDevicesDelta = function(delta) {
+        if( self.seq<0 || delta.seq<=self.seq ) {
+            //devices list not loaded yet or change already applied
+            return;
+        }
+        if( delta.seq!==self.seq+1 ) {
+            //changes were missed, resync whole devices list
+            self.getDevices();
+            return;
+        }
+
+        self.__updateDevices({
+            seq: delta.seq,
+            devices: delta.added.concat(delta.updated),
+            unconfigured: delta.unconfigured,
+        }, delta.removed);
+    };
+
     //get devices
     self.getDevices = function() {
         return cleepService.sendCommand('get_devices', 'devices')
             .then((resp) => {
-                self.__updateDevices(resp.data);
+                //remove devices unknown by core
+                var uuids = resp.data.devices.map((device) => device.uuid);
+                var removedUuids = self.devices.filter((device) => uuids.indexOf(device.uuid)<0).map((device) => device.uuid);
+
+                //full list replaces any previous state
+                self.seq = -1;
+                self.__updateDevices(resp.data, removedUuids);
             });
     };
 
@@ -106,13 +138,13 @@ var devicesService = function($rootScope, cleepService)
             'device_uuid': device.uuid,
         })
             .then((resp) => {
-                self.__updateDevices(resp.data, device);
+                self.__updateDevices(resp.data, [device.uuid]);
             });
     };
 
     //watch for devices event to refresh devices list
     $rootScope.$on('devices', function(_event, data) {
-        self.__updateDevices(data);
+        self.__applyDevicesDelta(data);
     });
 }
 
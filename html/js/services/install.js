@@ -1,7 +1,7 @@
 /**
  * Install service handles data useful to install module
  */
-var installService = function($rootScope, $state, logger, cleepService, tasksPanelService)
+var installService = function($rootScope, $state, logger, cleepService, tasksPanelService, toast)
 {
     var self = this;
     self.installing = false;
@@ -19,12 +19,15 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
         ERROR_BADCHECKSUM: 10,
         ERROR_FLASH: 11,
         ERROR_NETWORK: 12,
+        ERROR_VALIDATION: 13,
     };
     self.status = {
         percent: 0,
         total_percent: 0,
         status: 0,
-        eta: ''
+        eta: '',
+        drives: [],
+        queue: []
     };
     self.isos = {
         isos: [],
@@ -41,6 +44,7 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
     // save install config in service for data persistence
     self.installConfig = {
         drive: null,
+        drives: [],
         iso: null,
         wifiChoice: 0,
         wifi: null
@@ -72,7 +76,7 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
      * Refresh available wifi networks
      */
     self.refreshWifiNetworks = function() {
-        return cleepService.sendCommand('get_wifi_networks', 'install')
+        return cleepService.sendCommandAsync('get_wifi_networks', 'install')
             .then(function(resp) {
                 self.wifi.networks = resp.data.networks;
             });
@@ -98,7 +102,7 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
      * Refresh isos list
      */
     self.refreshIsos = function() {
-        return cleepService.sendCommand('get_isos', 'install')
+        return cleepService.sendCommandAsync('get_isos', 'install')
             .then(function(resp) {
                 self.isos.isos = resp.data.isos;
                 self.isos.cleepisos = resp.data.cleepisos;
@@ -128,6 +132,33 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
             });
     };
 
+    /**
+     * Remove queued install
+     * @param jobId: install job id
+     */
+    self.removeInstallJob = function(jobId) {
+        return cleepService.sendCommand('remove_install_job', 'install', {job_id: jobId});
+    };
+
+    /**
+     * Confirm install paused by application restart
+     * @param jobId: install job id
+     */
+    self.resumeInstallJob = function(jobId) {
+        return cleepService.sendCommand('resume_install_job', 'install', {job_id: jobId});
+    };
+
+    /**
+     * Cancel install of specified drive only
+     * @param drive: drive path
+     */
+    self.cancelDriveInstall = function(drive) {
+        return cleepService.sendCommand('cancel_drive_install', 'install', {drive: drive})
+            .then(function() {
+                toast.info('Installation canceled on drive ' + drive);
+            });
+    };
+
     /**
      * Init service values
      */
@@ -165,8 +196,9 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
         //save status
         self.status = data;
 
-        //detect install process
-        if( self.status.status===self.STATUS.IDLE || self.status.status>=self.STATUS.DONE ) {
+        //detect install process (queued installs will start soon)
+        var queued = (self.status.queue || []).some(function(job) { return job.status==='queued'; });
+        if( (self.status.status===self.STATUS.IDLE || self.status.status>=self.STATUS.DONE) && !queued ) {
             self.installing = false;
 
         } else {
@@ -211,4 +243,4 @@ var installService = function($rootScope, $state, logger, cleepService, tasksPan
 };
 
 var Cleep = angular.module('Cleep');
-Cleep.service('installService', ['$rootScope', '$state', 'logger', 'cleepService', 'tasksPanelService', installService]);
+Cleep.service('installService', ['$rootScope', '$state', 'logger', 'cleepService', 'tasksPanelService', 'toastService', installService]);
@@ -250,7 +250,7 @@ var updateService = function($rootScope, logger, appUpdater, $timeout, tasksPane
         var lastCheck = null;
         var etcherUpdateAvailable = true;
         var cleepdesktopUpdateAvailable = false;
-        cleepService.sendCommand('check_updates', 'updates')
+        cleepService.sendCommandAsync('check_updates', 'updates')
             .then(function(resp) {
                 //save resp
                 lastCheck = resp.data.lastcheck;
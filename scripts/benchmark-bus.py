@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+External bus benchmark. Starts several local Pyre nodes: sender nodes broadcast messages as fast as
+possible (or at specified rate) to a receiver node that measures throughput and latency.
+
+Usage (from repository root):
+    python3 scripts/benchmark-bus.py --senders 4 --messages 2000
+    python3 scripts/benchmark-bus.py --senders 4 --messages 2000 --drain-budget 20
+"""
+
+from gevent import monkey; monkey.patch_all()
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import gevent
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from core.libs.externalbus import PyreBus
+
+BENCHMARK_EVENT = 'benchmark.message'
+
+class Receiver():
+    """
+    Receiver node: counts received messages and computes their latency
+    """
+
+    def __init__(self, drain_budget):
+        self.peers = set()
+        self.latencies = []
+        self.first_received = None
+        self.last_received = None
+        self.bus = PyreBus(self.on_message_received, self.on_peer_connected, self.on_peer_disconnected, decode_headers, False, None, drain_budget)
+
+    def on_message_received(self, message):
+        if message.event!=BENCHMARK_EVENT:
+            return
+        now = time.time()
+        if self.first_received is None:
+            self.first_received = now
+        self.last_received = now
+        self.latencies.append(now - message.params['timestamp'])
+
+    def on_peer_connected(self, peer, infos):
+        self.peers.add(peer)
+
+    def on_peer_disconnected(self, peer):
+        self.peers.discard(peer)
+
+def decode_headers(headers):
+    """
+    Decode bus headers (only needed fields)
+    """
+    headers['macs'] = json.loads(headers.get('macs', '[]'))
+    return headers
+
+def get_headers(name):
+    """
+    Return bus headers of benchmark node
+    """
+    return {
+        'version': '0.0.0',
+        'hostname': name,
+        'port': '0',
+        'macs': json.dumps([]),
+        'ssl': '0',
+        'cleepdesktop': '0',
+        'apps': '',
+    }
+
+def dispatch_forever(bus):
+    """
+    Dispatch bus events (as Devices module does)
+    """
+    while True:
+        bus.dispatch(timeout=0.5)
+
+def send_messages(bus, index, count, rate):
+    """
+    Broadcast benchmark messages
+    """
+    delay = 1.0 / rate if rate else 0
+    for seq in range(count):
+        bus.broadcast_event(BENCHMARK_EVENT, {'timestamp': time.time(), 'sender': index, 'seq': seq}, None)
+        if delay:
+            gevent.sleep(delay)
+        elif seq % 100==0:
+            #let other greenlets run
+            gevent.sleep(0)
+
+def percentile(values, percent):
+    """
+    Return percentile of sorted values
+    """
+    if len(values)==0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def main():
+    parser = argparse.ArgumentParser(description='External bus throughput and latency benchmark')
+    parser.add_argument('--senders', type=int, default=4, help='number of sender nodes')
+    parser.add_argument('--messages', type=int, default=1000, help='number of messages sent by each sender')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second of each sender (0 for unlimited)')
+    parser.add_argument('--drain-budget', type=int, default=PyreBus.DRAIN_BUDGET, help='messages read from a socket per bus iteration')
+    parser.add_argument('--timeout', type=float, default=30.0, help='maximum time to wait for peers and messages')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    #start nodes
+    receiver = Receiver(args.drain_budget)
+    receiver.bus.configure(get_headers('receiver'))
+    receiver.bus.start()
+    greenlets = [gevent.spawn(dispatch_forever, receiver.bus)]
+    senders = []
+    for index in range(args.senders):
+        bus = PyreBus(lambda message: None, lambda peer, infos: None, lambda peer: None, decode_headers, False, None, args.drain_budget)
+        bus.configure(get_headers('sender%d' % index))
+        bus.start()
+        senders.append(bus)
+        greenlets.append(gevent.spawn(dispatch_forever, bus))
+
+    #wait for peers discovery
+    start = time.time()
+    while len(receiver.peers)<args.senders and time.time()-start<args.timeout:
+        gevent.sleep(0.1)
+    print('%d/%d senders connected in %.2fs' % (len(receiver.peers), args.senders, time.time() - start))
+
+    #send messages
+    expected = args.senders * args.messages
+    sent_at = time.time()
+    gevent.joinall([gevent.spawn(send_messages, bus, index, args.messages, args.rate) for index, bus in enumerate(senders)])
+    while len(receiver.latencies)<expected and time.time()-sent_at<args.timeout:
+        gevent.sleep(0.1)
+
+    #report
+    received = len(receiver.latencies)
+    duration = (receiver.last_received or sent_at) - sent_at
+    latencies = sorted(receiver.latencies)
+    print('Messages received: %d/%d (%d dropped by receiver queue)' % (received, expected, receiver.bus.dropped_messages))
+    print('Throughput: %.0f messages/s' % (received / duration if duration>0 else 0))
+    print('Latency: p50=%.2fms p95=%.2fms p99=%.2fms max=%.2fms' % (
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000,
+        (latencies[-1] if latencies else 0) * 1000,
+    ))
+
+    print('Receiver bus metrics: %s' % receiver.bus.get_metrics())
+
+    #stop nodes
+    for bus in [receiver.bus] + senders:
+        bus.stop()
+    gevent.killall(greenlets)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import os
+import json
+import time
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+from core.libs.cacheindex import CacheIndex
+
+class CacheIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _create_file(self, filename, content):
+        filepath = os.path.join(self.work_dir, filename)
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        return filepath, hashlib.sha256(content).hexdigest()
+
+    def _read_index(self):
+        with open(os.path.join(self.cache_dir, CacheIndex.INDEX_FILENAME), 'r') as f:
+            return json.load(f)
+
+    def test_migrate_previous_cache_format(self):
+        content = b'previous cache format'
+        old_filepath = os.path.join(self.cache_dir, 'cleep_cached_%s' % base64.b16encode(b'image.zip').decode('utf-8'))
+        with open(old_filepath, 'wb') as f:
+            f.write(content)
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        index = CacheIndex(self.cache_dir)
+
+        entry = index.find_by_sha256(sha256)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry['filename'], 'image.zip')
+        self.assertEqual(entry['urls'], [])
+        self.assertEqual(entry['size'], len(content))
+        self.assertEqual(entry['filepath'], index.get_filepath(sha256))
+        self.assertTrue(os.path.exists(entry['filepath']))
+        self.assertFalse(os.path.exists(old_filepath))
+        self.assertIn(sha256, self._read_index()['entries'])
+
+    def test_migrate_deduplicates_same_content(self):
+        for name in (b'first.zip', b'second.zip'):
+            with open(os.path.join(self.cache_dir, 'cleep_cached_%s' % base64.b16encode(name).decode('utf-8')), 'wb') as f:
+                f.write(b'same content')
+
+        index = CacheIndex(self.cache_dir)
+
+        self.assertEqual(len(index.get_entries()), 1)
+        cached_files = [filename for filename in os.listdir(self.cache_dir) if filename.startswith('cleep_cached_')]
+        self.assertEqual(len(cached_files), 1)
+
+    def test_add_deduplicates_content_and_keeps_urls(self):
+        index = CacheIndex(self.cache_dir)
+        filepath1, sha256 = self._create_file('file1', b'content')
+        filepath2, _ = self._create_file('file2', b'content')
+
+        index.add('http://host1/file', 'file', filepath1, sha256)
+        entry = index.add('http://host2/file', 'file', filepath2, sha256)
+
+        self.assertEqual(entry['urls'], ['http://host1/file', 'http://host2/file'])
+        self.assertFalse(os.path.exists(filepath2))
+        self.assertEqual(len(index.get_entries()), 1)
+
+    def test_evict_lru_when_max_size_exceeded(self):
+        index = CacheIndex(self.cache_dir, max_size=25)
+        filepath1, sha1 = self._create_file('file1', b'a' * 10)
+        filepath2, sha2 = self._create_file('file2', b'b' * 10)
+        filepath3, sha3 = self._create_file('file3', b'c' * 10)
+
+        index.add('http://host/file1', 'file1', filepath1, sha1)
+        index.add('http://host/file2', 'file2', filepath2, sha2)
+        #file1 is used more recently than file2
+        index.entries[sha1]['lastaccess'] = int(time.time()) + 10
+        index.add('http://host/file3', 'file3', filepath3, sha3)
+
+        self.assertIsNotNone(index.find_by_sha256(sha1))
+        self.assertIsNone(index.find_by_sha256(sha2))
+        self.assertIsNotNone(index.find_by_sha256(sha3))
+        self.assertFalse(os.path.exists(index.get_filepath(sha2)))
+        self.assertEqual(index.get_stats()['evictions'], 1)
+
+    def test_evict_expired_entries(self):
+        index = CacheIndex(self.cache_dir, max_age=60)
+        filepath, sha256 = self._create_file('file', b'content')
+        index.add('http://host/file', 'file', filepath, sha256)
+        index.entries[sha256]['timestamp'] -= 120
+
+        index.evict()
+
+        self.assertIsNone(index.find_by_sha256(sha256))
+        self.assertEqual(index.get_stats()['evictions'], 1)
+
+    def test_find_by_sha256_is_exact(self):
+        index = CacheIndex(self.cache_dir)
+        filepath, sha256 = self._create_file('file.img', b'extracted')
+        archive_sha256 = hashlib.sha256(b'archive').hexdigest()
+        index.add(None, 'file.img', filepath, sha256, sourcesha256=archive_sha256)
+
+        self.assertIsNone(index.find_by_sha256(archive_sha256))
+        self.assertEqual(index.find_by_sha256(sha256)['sha256'], sha256)
+        self.assertEqual(index.find_by_source_sha256(archive_sha256)['sha256'], sha256)
+
+    def test_extracted_sha256_is_kept_after_eviction(self):
+        index = CacheIndex(self.cache_dir)
+        filepath, sha256 = self._create_file('file.img', b'extracted')
+        archive_sha256 = hashlib.sha256(b'archive').hexdigest()
+        index.add(None, 'file.img', filepath, sha256, sourcesha256=archive_sha256)
+
+        index.remove(sha256)
+
+        self.assertIsNone(index.find_by_source_sha256(archive_sha256))
+        self.assertEqual(index.get_extracted_sha256(archive_sha256), sha256)
+        self.assertEqual(CacheIndex(self.cache_dir).get_extracted_sha256(archive_sha256), sha256)
+
+    def test_alias_does_not_record_extraction(self):
+        index = CacheIndex(self.cache_dir)
+        filepath, sha256 = self._create_file('file.img', b'extracted')
+        archive_sha256 = hashlib.sha256(b'archive').hexdigest()
+        index.add('http://host/file.img', 'file.img', filepath, sha256)
+
+        self.assertTrue(index.add_alias(sha256, 'http://host/archive.zip', archive_sha256))
+
+        self.assertEqual(index.find_by_url('http://host/archive.zip')['sha256'], sha256)
+        self.assertEqual(index.find_by_source_sha256(archive_sha256)['sha256'], sha256)
+        self.assertIsNone(index.get_extracted_sha256(archive_sha256))
+        self.assertFalse(index.add_alias('unknown', 'http://host/other'))
+
+    def test_lookup_is_flushed_after_delay(self):
+        index = CacheIndex(self.cache_dir, flush_delay=0.2)
+        filepath, sha256 = self._create_file('file', b'content')
+        index.add('http://host/file', 'file', filepath, sha256)
+
+        self.assertIsNotNone(index.find_by_url('http://host/file'))
+
+        self.assertTrue(index.dirty)
+        self.assertEqual(self._read_index()['entries'][sha256]['hits'], 0)
+        time.sleep(0.5)
+        self.assertFalse(index.dirty)
+        self.assertEqual(self._read_index()['entries'][sha256]['hits'], 1)
+        self.assertEqual(self._read_index()['stats']['hits'], 1)
+
+    def test_flush_writes_pending_lookups(self):
+        index = CacheIndex(self.cache_dir, flush_delay=60)
+        index.find_by_url('http://host/unknown')
+
+        index.flush()
+
+        self.assertFalse(index.dirty)
+        self.assertEqual(self._read_index()['stats']['misses'], 1)
+
+    def test_load_drops_entries_without_file(self):
+        index = CacheIndex(self.cache_dir)
+        filepath, sha256 = self._create_file('file', b'content')
+        entry = index.add('http://host/file', 'file', filepath, sha256)
+        os.remove(entry['filepath'])
+
+        self.assertIsNone(CacheIndex(self.cache_dir).find_by_sha256(sha256))
+
+if __name__ == '__main__':
+    unittest.main()
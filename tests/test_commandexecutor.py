@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import unittest
+import gevent
+from core.libs.commandexecutor import CommandExecutor
+from core.exceptions import CommandError
+
+class DummyModule():
+
+    def execute_command(self, command, params):
+        return {'command': command, 'params': params}
+
+class CommandExecutorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+        self.executor = CommandExecutor({'install': DummyModule()}, self.results.append)
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def test_async_command_result_is_delivered(self):
+        job_id = self.executor.submit('install', 'get_isos', {'force_refresh': True})
+        gevent.sleep(0.2)
+
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0]['jobid'], job_id)
+        self.assertEqual(self.results[0]['status'], CommandExecutor.JOB_DONE)
+        self.assertEqual(self.results[0]['data'], {'command': 'get_isos', 'params': {'force_refresh': True}})
+
+    def test_command_not_allowed_async(self):
+        with self.assertRaises(CommandError):
+            self.executor.submit('install', 'start_install')
+        with self.assertRaises(CommandError):
+            self.executor.submit('unknown', 'get_isos')
+
+        self.assertEqual(self.executor.get_jobs(), [])
+
+    def test_custom_async_commands(self):
+        executor = CommandExecutor({'install': DummyModule()}, self.results.append, async_commands={'install': ('start_install',)})
+        try:
+            executor.submit('install', 'start_install')
+            with self.assertRaises(CommandError):
+                executor.submit('install', 'get_isos')
+            gevent.sleep(0.2)
+
+            self.assertEqual([result['command'] for result in self.results], ['start_install'])
+        finally:
+            executor.stop()
+
+if __name__ == '__main__':
+    unittest.main()
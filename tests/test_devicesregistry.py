@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import unittest
+from core.libs.devicesregistry import DevicesRegistry
+from core.exceptions import InvalidParameter
+
+def make_device(device_uuid, hostname, ip=None, version='0.0.20', online=True, configured=True, macs=None):
+    return {
+        'uuid': device_uuid,
+        'hostname': hostname,
+        'ip': ip,
+        'version': version,
+        'online': online,
+        'configured': configured,
+        'macs': macs or [],
+    }
+
+class DevicesRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DevicesRegistry({
+            'uuid1': make_device('uuid1', 'kitchen', '192.168.1.20', '0.0.20', macs=['AA:BB:CC:DD:EE:01']),
+            'uuid2': make_device('uuid2', 'Kids-room', '192.168.1.3', '0.0.19', online=False),
+            'uuid3': make_device('uuid3', 'cleep', '192.168.2.5', '0.0.20', configured=False),
+            'uuid4': make_device('uuid4', 'cleep', None, '0.0.9', online=False, configured=False),
+            'uuid5': make_device('uuid5', 'garage', '10.0.0.1', '0.0.20'),
+        })
+
+    def _uuids(self, result):
+        return [device['uuid'] for device in result['devices']]
+
+    def test_lookups(self):
+        self.assertEqual(self.registry.get_device_by_mac('aa:bb:cc:dd:ee:01')['uuid'], 'uuid1')
+        self.assertIsNone(self.registry.get_device_by_mac('aa:bb:cc:dd:ee:02'))
+        self.assertEqual([device['uuid'] for device in self.registry.get_devices_by_ip('192.168.1.3')], ['uuid2'])
+        self.assertEqual(sorted([device['uuid'] for device in self.registry.get_devices_by_hostname('CLEEP')]), ['uuid3', 'uuid4'])
+        self.assertEqual(self.registry.get_counters(), {'total': 5, 'online': 3, 'unconfigured': 2})
+
+    def test_peers(self):
+        self.registry.set_peer('peer1', 'uuid1')
+        self.assertEqual(self.registry.get_device_by_peer('peer1')['uuid'], 'uuid1')
+
+        #device restarted with a new peer id
+        self.registry.set_peer('peer2', 'uuid1')
+        self.assertIsNone(self.registry.get_device_by_peer('peer1'))
+        self.assertIsNone(self.registry.remove_peer('peer1'))
+        self.assertEqual(self.registry.remove_peer('peer2'), 'uuid1')
+        self.assertIsNone(self.registry.get_device_by_peer('peer2'))
+
+    def test_update_device_reindexes_it(self):
+        self.assertFalse(self.registry.set_device(make_device('uuid1', 'dining', '192.168.1.21', '0.0.21', configured=False)))
+
+        self.assertEqual(self.registry.get_devices_by_ip('192.168.1.20'), [])
+        self.assertEqual(self.registry.get_devices_by_hostname('kitchen'), [])
+        self.assertIsNone(self.registry.get_device_by_mac('aa:bb:cc:dd:ee:01'))
+        self.assertEqual(self._uuids(self.registry.query(hostname='din')), ['uuid1'])
+        self.assertEqual(self._uuids(self.registry.query(version='0.0.21')), ['uuid1'])
+        self.assertEqual(self.registry.unconfigured, 3)
+
+    def test_remove_device(self):
+        self.registry.set_peer('peer1', 'uuid1')
+
+        self.assertEqual(self.registry.remove_device('uuid1')['uuid'], 'uuid1')
+
+        self.assertIsNone(self.registry.get_device('uuid1'))
+        self.assertIsNone(self.registry.get_device_by_peer('peer1'))
+        self.assertEqual(self.registry.query(hostname='kitchen')['total'], 0)
+        self.assertEqual(self.registry.online, 2)
+        self.assertIsNone(self.registry.remove_device('uuid1'))
+
+    def test_set_online(self):
+        self.assertTrue(self.registry.set_online('uuid2', True))
+        self.assertFalse(self.registry.set_online('unknown', True))
+
+        self.assertEqual(self.registry.online, 4)
+        self.assertIn('uuid2', self._uuids(self.registry.query(online=True)))
+
+    def test_query_sorted_by_hostname(self):
+        result = self.registry.query()
+
+        self.assertEqual(result['total'], 5)
+        self.assertEqual(self._uuids(result)[:2], ['uuid3', 'uuid4'])
+        self.assertEqual(self._uuids(result)[2:], ['uuid5', 'uuid2', 'uuid1'])
+        self.assertEqual(self._uuids(self.registry.query(reverse=True))[0], 'uuid1')
+
+    def test_query_pagination(self):
+        all_uuids = self._uuids(self.registry.query())
+
+        page1 = self.registry.query(offset=0, limit=2)
+        page2 = self.registry.query(offset=2, limit=2)
+        page3 = self.registry.query(offset=4, limit=2)
+
+        self.assertEqual(page1['total'], 5)
+        self.assertEqual(self._uuids(page1) + self._uuids(page2) + self._uuids(page3), all_uuids)
+        self.assertEqual(self.registry.query(offset=10, limit=2)['devices'], [])
+
+    def test_query_filters(self):
+        self.assertEqual(sorted(self._uuids(self.registry.query(online=True))), ['uuid1', 'uuid3', 'uuid5'])
+        self.assertEqual(sorted(self._uuids(self.registry.query(online=False))), ['uuid2', 'uuid4'])
+        self.assertEqual(sorted(self._uuids(self.registry.query(configured=False))), ['uuid3', 'uuid4'])
+        self.assertEqual(sorted(self._uuids(self.registry.query(version='0.0.20'))), ['uuid1', 'uuid3', 'uuid5'])
+        self.assertEqual(sorted(self._uuids(self.registry.query(hostname='KI'))), ['uuid1', 'uuid2'])
+        self.assertEqual(sorted(self._uuids(self.registry.query(subnet='192.168.1.0/24'))), ['uuid1', 'uuid2'])
+        self.assertEqual(self._uuids(self.registry.query(online=True, configured=True, subnet='192.168.0.0/16')), ['uuid1'])
+        self.assertEqual(self.registry.query(version='1.0.0')['total'], 0)
+
+    def test_query_sorted_by_other_keys(self):
+        #devices without ip are sorted last, ips are compared numerically
+        self.assertEqual(self._uuids(self.registry.query(sort='ip')), ['uuid5', 'uuid2', 'uuid1', 'uuid3', 'uuid4'])
+        #versions are compared numerically
+        self.assertEqual(self._uuids(self.registry.query(sort='version'))[:2], ['uuid4', 'uuid2'])
+        self.assertEqual(self._uuids(self.registry.query(sort='uuid', reverse=True, limit=1)), ['uuid5'])
+
+    def test_query_invalid_parameters(self):
+        with self.assertRaises(InvalidParameter):
+            self.registry.query(sort='invalid')
+        with self.assertRaises(InvalidParameter):
+            self.registry.query(limit=-1)
+        with self.assertRaises(InvalidParameter):
+            self.registry.query(subnet='invalid')
+
+    def test_to_dict_is_a_copy(self):
+        devices = self.registry.to_dict()
+        devices.pop('uuid1')
+
+        self.assertIsNotNone(self.registry.get_device('uuid1'))
+        self.assertEqual(len(DevicesRegistry(self.registry.to_dict()).get_devices()), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import os
+import re
+import json
+import hashlib
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from core.libs.download import Download
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler supporting range requests. Ranges starting after server failing_offset fail
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+
+        size = os.path.getsize(path)
+        self.remaining = None
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            self.server.ranges.append((start, end))
+            if self.server.failing_offset is not None and start>=self.server.failing_offset:
+                self.send_error(500)
+                return None
+            f = open(path, 'rb')
+            f.seek(start)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            self.remaining = end - start + 1
+            return f
+
+        f = open(path, 'rb')
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        while self.remaining is None or self.remaining>0:
+            buf = source.read(65536 if self.remaining is None else min(65536, self.remaining))
+            if not buf:
+                break
+            outputfile.write(buf)
+            if self.remaining is not None:
+                self.remaining -= len(buf)
+
+class NoRangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler that does not support range requests
+    """
+
+    def log_message(self, *args):
+        pass
+
+class SmallChunksDownload(Download):
+    CHUNK_SIZE = 65536
+    SEGMENTED_MIN_SIZE = 0
+    HASH_SLICE_SIZE = 65536
+
+class DownloadTests(unittest.TestCase):
+
+    FILE_SIZE = 1048576 + 1234
+
+    def setUp(self):
+        self.www_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.content = os.urandom(self.FILE_SIZE)
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        with open(os.path.join(self.www_dir, 'file.bin'), 'wb') as f:
+            f.write(self.content)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=self.www_dir))
+        self.server.daemon_threads = True
+        self.server.ranges = []
+        self.server.failing_offset = None
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/file.bin' % self.server.server_address[1]
+        self.downloads = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for download in self.downloads:
+            if download and os.path.exists(download):
+                os.remove(download)
+        shutil.rmtree(self.www_dir, ignore_errors=True)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _download(self, **kwargs):
+        download = SmallChunksDownload(self.cache_dir)
+        filepath = download.download_from_url(self.url, **kwargs)
+        self.downloads.append(filepath)
+        return download, filepath
+
+    def _read(self, filepath):
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    def test_download_ranges(self):
+        download, filepath = self._download(check_sha256=self.sha256, segments=4)
+
+        self.assertEqual(download.status, Download.STATUS_DONE)
+        self.assertEqual(self._read(filepath), self.content)
+        self.assertEqual(len(self.server.ranges), -(-self.FILE_SIZE // SmallChunksDownload.CHUNK_SIZE))
+        self.assertFalse(os.path.exists(download.journal))
+
+    def test_download_ranges_cached(self):
+        download, filepath = self._download(check_sha256=self.sha256, cache=True, segments=4)
+
+        self.assertEqual(filepath, download.cache_index.get_filepath(self.sha256))
+        self.assertEqual(self._read(filepath), self.content)
+        self.server.ranges = []
+        _, cached_filepath = self._download(cache=True)
+        self.assertEqual(cached_filepath, filepath)
+        self.assertEqual(self.server.ranges, [])
+
+    def test_resume_interrupted_download(self):
+        failing_offset = self.FILE_SIZE // 2
+        self.server.failing_offset = failing_offset
+        download, filepath = self._download(check_sha256=self.sha256, segments=4)
+
+        self.assertIsNone(filepath)
+        self.assertEqual(download.status, Download.STATUS_ERROR_NETWORK)
+        self.assertTrue(os.path.exists(download.download))
+        with open(download.journal, 'r') as f:
+            journal = json.load(f)
+        self.assertEqual(journal['url'], self.url)
+        self.assertEqual(journal['size'], self.FILE_SIZE)
+        for segment in journal['segments']:
+            if segment['start']<failing_offset:
+                self.assertEqual(segment['downloaded'], segment['end'] - segment['start'] + 1)
+            else:
+                self.assertEqual(segment['downloaded'], 0)
+
+        #only missing chunks are downloaded again
+        self.server.failing_offset = None
+        self.server.ranges = []
+        download, filepath = self._download(check_sha256=self.sha256, segments=4)
+
+        self.assertEqual(download.status, Download.STATUS_DONE)
+        self.assertEqual(self._read(filepath), self.content)
+        self.assertTrue(len(self.server.ranges)>0)
+        self.assertTrue(all([start>=failing_offset for start, _ in self.server.ranges]))
+        self.assertFalse(os.path.exists(download.journal))
+
+    def test_journal_of_other_file_is_ignored(self):
+        self.server.failing_offset = self.FILE_SIZE // 2
+        self._download(check_sha256=self.sha256, segments=4)
+
+        #remote file changed
+        self.content = os.urandom(self.FILE_SIZE + 10)
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        with open(os.path.join(self.www_dir, 'file.bin'), 'wb') as f:
+            f.write(self.content)
+        self.server.failing_offset = None
+        self.server.ranges = []
+        download, filepath = self._download(check_sha256=self.sha256, segments=4)
+
+        self.assertEqual(download.status, Download.STATUS_DONE)
+        self.assertEqual(self._read(filepath), self.content)
+        self.assertIn((0, SmallChunksDownload.CHUNK_SIZE - 1), self.server.ranges)
+
+    def test_origin_without_ranges_is_fallback_of_failed_sources(self):
+        origin = ThreadingHTTPServer(('127.0.0.1', 0), partial(NoRangeRequestHandler, directory=self.www_dir))
+        origin.daemon_threads = True
+        Thread(target=origin.serve_forever, daemon=True).start()
+        try:
+            #alternative source fails after first chunk
+            self.server.failing_offset = 1
+            download = SmallChunksDownload(self.cache_dir)
+            filepath = download.download_from_url('http://127.0.0.1:%d/file.bin' % origin.server_address[1], check_sha256=self.sha256, segments=4, sources=[self.url])
+            self.downloads.append(filepath)
+
+            self.assertIsNotNone(filepath)
+            self.assertEqual(download.status, Download.STATUS_DONE)
+            self.assertEqual(self._read(filepath), self.content)
+            self.assertFalse(os.path.exists(download.journal))
+        finally:
+            origin.shutdown()
+            origin.server_close()
+
+    def test_bad_checksum_drops_partial(self):
+        download, filepath = self._download(check_sha256='0' * 64, segments=4)
+
+        self.assertIsNone(filepath)
+        self.assertEqual(download.status, Download.STATUS_ERROR_BADCHECKSUM)
+        self.assertFalse(os.path.exists(download.download))
+        self.assertFalse(os.path.exists(download.journal))
+
+    def test_concurrent_downloads_of_same_url(self):
+        results = []
+        def run():
+            download = SmallChunksDownload(self.cache_dir)
+            results.append((download, download.download_from_url(self.url, check_sha256=self.sha256, segments=4)))
+        threads = [Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        self.assertEqual(len(results), 3)
+        for download, filepath in results:
+            self.downloads.append(filepath)
+            self.assertEqual(download.status, Download.STATUS_DONE)
+            self.assertEqual(self._read(filepath), self.content)
+
+if __name__ == '__main__':
+    unittest.main()
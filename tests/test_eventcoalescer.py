@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import unittest
+from threading import Lock, Thread
+import gevent
+from gevent.threadpool import ThreadPool
+from core.libs.eventcoalescer import EventCoalescer
+
+class EventCoalescerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.published = []
+        self.lock = Lock()
+        self.coalescer = EventCoalescer(self.publish, {'install.status': 0.2})
+
+    def tearDown(self):
+        self.coalescer.stop()
+
+    def publish(self, event, data):
+        with self.lock:
+            self.published.append((event, data))
+
+    def test_event_without_window_is_published_immediately(self):
+        for percent in range(3):
+            self.coalescer.push('devices.update', percent)
+
+        self.assertEqual(self.published, [('devices.update', 0), ('devices.update', 1), ('devices.update', 2)])
+
+    def test_first_event_is_published_immediately(self):
+        self.coalescer.push('install.status', 0)
+
+        self.assertEqual(self.published, [('install.status', 0)])
+
+    def test_latest_event_of_window_wins(self):
+        for percent in range(10):
+            self.coalescer.push('install.status', percent)
+        self.assertEqual(self.published, [('install.status', 0)])
+
+        gevent.sleep(0.4)
+
+        self.assertEqual(self.published, [('install.status', 0), ('install.status', 9)])
+
+    def test_event_after_window_is_published_immediately(self):
+        self.coalescer.push('install.status', 0)
+        gevent.sleep(0.3)
+
+        self.coalescer.push('install.status', 1)
+
+        self.assertEqual(self.published, [('install.status', 0), ('install.status', 1)])
+
+    def test_windows_are_independent(self):
+        coalescer = EventCoalescer(self.publish, {'install.status': 0.2, 'download.status': 0.2})
+        coalescer.push('install.status', 0)
+        coalescer.push('download.status', 0)
+        coalescer.push('install.status', 1)
+
+        self.assertEqual(self.published, [('install.status', 0), ('download.status', 0)])
+        gevent.sleep(0.4)
+        self.assertEqual(self.published[-1], ('install.status', 1))
+        coalescer.stop()
+
+    def test_stop_cancels_pending_events(self):
+        self.coalescer.push('install.status', 0)
+        self.coalescer.push('install.status', 1)
+
+        self.coalescer.stop()
+        gevent.sleep(0.3)
+
+        self.assertEqual(self.published, [('install.status', 0)])
+
+    def test_publish_error_does_not_break_coalescer(self):
+        def publish(event, data):
+            self.published.append((event, data))
+            if data==1:
+                raise Exception('Test exception')
+        coalescer = EventCoalescer(publish, {'install.status': 0.1})
+        coalescer.push('install.status', 0)
+        coalescer.push('install.status', 1)
+        gevent.sleep(0.2)
+
+        coalescer.push('install.status', 2)
+        gevent.sleep(0.2)
+
+        self.assertEqual(self.published, [('install.status', 0), ('install.status', 1), ('install.status', 2)])
+        coalescer.stop()
+
+    def test_push_from_pool_thread(self):
+        pool = ThreadPool(1)
+        def push():
+            for percent in range(10):
+                self.coalescer.push('install.status', percent)
+            self.coalescer.push('devices.update', 'done')
+        pool.spawn(push).get()
+        gevent.sleep(0.5)
+        pool.kill()
+
+        #first event published at once, latest one at end of window
+        self.assertEqual(self.published, [('install.status', 0), ('devices.update', 'done'), ('install.status', 9)])
+
+        #coalescer keeps working after events pushed from another thread
+        self.coalescer.push('install.status', 10)
+        self.assertEqual(self.published[-1], ('install.status', 10))
+
+    def test_push_from_native_thread(self):
+        thread = Thread(target=lambda: [self.coalescer.push('install.status', percent) for percent in range(5)])
+        thread.start()
+        thread.join()
+        self.assertEqual(self.published, [])
+
+        gevent.sleep(0.4)
+
+        self.assertEqual(self.published, [('install.status', 0), ('install.status', 4)])
+
+if __name__ == '__main__':
+    unittest.main()
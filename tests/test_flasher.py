@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+from core.libs.sparsefile import SparseFile
+from core.libs.flasher import Flasher
+from core.libs.validator import Validator
+from core.libs.flashscheduler import FlashScheduler
+
+class SmallBuffersFlasher(Flasher):
+    BUFFER_SIZE = 65536
+
+#application runtime: flash and validation are driven by greenlets while a ticker greenlet measures how long
+#hub is blocked. Each write (and each read during validation) blocks its OS thread for 50ms
+PATCHED_RUNTIME_SCRIPT = '''
+from gevent import monkey; monkey.patch_all()
+import os, sys, json, time
+import gevent
+from core.libs.sparsefile import SparseFile
+from core.libs.flasher import Flasher
+from core.libs.validator import Validator
+from core.libs.flashscheduler import FlashScheduler
+
+get_ident = monkey.get_original('threading', 'get_ident')
+native_sleep = monkey.get_original('time', 'sleep')
+main_ident = get_ident()
+phase = 'flash'
+io_idents = {'flash': set(), 'validate': set(), 'schedule': set()}
+gaps = {'flash': [], 'validate': [], 'schedule': []}
+flight_lock = monkey.get_original('threading', 'Lock')()
+flight = {'current': 0, 'max': 0}
+original_pwrite = os.pwrite
+original_preadv = os.preadv
+def pwrite(*args):
+    io_idents[phase].add(get_ident())
+    with flight_lock:
+        flight['current'] += 1
+        flight['max'] = max(flight['max'], flight['current'])
+    try:
+        native_sleep(0.05)
+        return original_pwrite(*args)
+    finally:
+        with flight_lock:
+            flight['current'] -= 1
+def preadv(*args):
+    io_idents[phase].add(get_ident())
+    if phase=='validate':
+        native_sleep(0.05)
+    return original_preadv(*args)
+os.pwrite = pwrite
+os.preadv = preadv
+
+(work_dir, image, target) = sys.argv[1:4]
+content = os.urandom(8 * 65536) + bytes(2 * 65536) + os.urandom(65536)
+sparse = SparseFile(image)
+sparse.write(content)
+sparse.close()
+
+def ticker():
+    last = time.time()
+    while True:
+        gevent.sleep(0.005)
+        gaps[phase].append(time.time() - last)
+        last = time.time()
+tick = gevent.spawn(ticker)
+
+class SmallBuffersFlasher(Flasher):
+    BUFFER_SIZE = 65536
+flasher = SmallBuffersFlasher()
+flashed = gevent.spawn(flasher.flash, image, target, sparse.get_blockmap()).get()
+phase = 'validate'
+validated = gevent.spawn(Validator(workers=2).validate, target, flasher.get_hashmap()).get()
+with open(target, 'rb') as f:
+    same = f.read()==content
+
+#two drives flashed by scheduler: their writes must overlap
+phase = 'schedule'
+flight['max'] = 0
+callback_idents = set()
+scheduler = FlashScheduler(lambda jobs: callback_idents.add(get_ident()))
+targets = [os.path.join(work_dir, 'drive%d.img' % index) for index in range(2)]
+for drive in targets:
+    scheduler.add_job(drive, image, sparse.get_blockmap())
+scheduled = gevent.spawn(scheduler.run).get()
+tick.kill()
+for drive in targets:
+    with open(drive, 'rb') as f:
+        same = same and f.read()==content
+
+print(json.dumps({
+    'flashed': flashed,
+    'validated': validated,
+    'same': same,
+    'scheduled': scheduled,
+    'maxwrites': flight['max'],
+    'callbackthreads': [ident==main_ident for ident in callback_idents],
+    'mainthreadio': dict([(key, main_ident in idents) for key, idents in io_idents.items()]),
+    'ticks': dict([(key, len(values)) for key, values in gaps.items()]),
+    'maxgap': dict([(key, max(values) if values else None) for key, values in gaps.items()]),
+}))
+'''
+
+class SparseFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.work_dir, 'image.img')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_blockmap(self):
+        sparse = SparseFile(self.filepath)
+        sparse.write(b'\x01' * 4096)
+        sparse.write(bytes(3 * 4096))
+        #unaligned writes are buffered until block is complete
+        sparse.write(b'\x02' * 100)
+        sparse.write(b'\x02' * (2 * 4096 - 100))
+        sparse.write(bytes(4096))
+        sparse.close()
+
+        blockmap = sparse.get_blockmap()
+        self.assertEqual(blockmap['size'], 7 * 4096)
+        self.assertEqual(blockmap['blocks'], 7)
+        self.assertEqual(blockmap['mapped'], 3)
+        self.assertEqual(blockmap['ranges'], [[0, 0], [4, 5]])
+        with open(self.filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'\x01' * 4096 + bytes(3 * 4096) + b'\x02' * (2 * 4096) + bytes(4096))
+
+    def test_incomplete_last_block(self):
+        sparse = SparseFile(self.filepath)
+        sparse.write(bytes(4096) + b'\x03' * 10)
+        sparse.close()
+
+        blockmap = sparse.get_blockmap()
+        self.assertEqual(blockmap['size'], 4106)
+        self.assertEqual(blockmap['blocks'], 2)
+        self.assertEqual(blockmap['ranges'], [[1, 1]])
+        self.assertEqual(os.path.getsize(self.filepath), 4106)
+
+    def test_save_and_load_blockmap(self):
+        sparse = SparseFile(self.filepath)
+        sparse.write(b'\x01' * 4096)
+        sparse.close()
+        blockmap_path = '%s%s' % (self.filepath, SparseFile.BLOCKMAP_SUFFIX)
+
+        SparseFile.save_blockmap(sparse.get_blockmap(), blockmap_path)
+
+        self.assertEqual(SparseFile.load_blockmap(blockmap_path), sparse.get_blockmap())
+        self.assertIsNone(SparseFile.load_blockmap(os.path.join(self.work_dir, 'unknown')))
+
+@unittest.skipUnless(Flasher.is_supported(), 'Native flasher not supported on this system')
+class FlasherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.work_dir, 'image.img')
+        self.target = os.path.join(self.work_dir, 'target.img')
+
+        #populated chunk, zeroed chunks, populated chunk and unaligned populated tail
+        self.content = os.urandom(65536) + bytes(3 * 65536) + os.urandom(65536) + bytes(8192) + os.urandom(1000)
+        sparse = SparseFile(self.image)
+        sparse.write(self.content)
+        sparse.close()
+        self.blockmap = sparse.get_blockmap()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _read(self, filepath):
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    def _validate(self, hashmap):
+        validator = Validator(workers=2)
+        self.assertTrue(validator.validate(self.target, hashmap), validator.get_result())
+
+    def test_get_chunks(self):
+        flasher = SmallBuffersFlasher()
+        size = len(self.content)
+
+        populated = flasher.get_chunks(size, self.blockmap)
+        with_holes = flasher.get_chunks(size, self.blockmap, holes=True)
+
+        self.assertTrue(all([chunk[2] for chunk in populated]))
+        self.assertEqual(sum([chunk[1] for chunk in with_holes]), size)
+        self.assertEqual([chunk for chunk in with_holes if chunk[2]], populated)
+        self.assertEqual([chunk[:2] for chunk in with_holes if not chunk[2]], [(65536, 65536), (131072, 65536), (196608, 65536), (327680, 8192)])
+
+    def test_flash_file_without_blockmap(self):
+        flasher = SmallBuffersFlasher()
+
+        self.assertTrue(flasher.flash(self.image, self.target))
+
+        self.assertEqual(self._read(self.target), self.content)
+        self.assertEqual(flasher.written, len(self.content))
+        self._validate(flasher.get_hashmap())
+
+    def test_flash_file_with_blockmap(self):
+        with open(self.target, 'wb') as f:
+            f.write(b'\xff' * (2 * len(self.content)))
+        flasher = SmallBuffersFlasher()
+
+        self.assertTrue(flasher.flash(self.image, self.target, self.blockmap))
+
+        #file target is truncated, skipped blocks are holes
+        self.assertEqual(self._read(self.target), self.content)
+        self.assertEqual(flasher.written, self.blockmap['mapped'] * self.blockmap['blocksize'] - (4096 - 1000))
+        self._validate(flasher.get_hashmap())
+
+    def test_flash_device_with_blockmap_zeroes_skipped_blocks(self):
+        #a plain file prefilled with previous content simulates a device (BLKZEROOUT fails on it)
+        with open(self.target, 'wb') as f:
+            f.write(b'\xff' * (2 * len(self.content)))
+        flasher = SmallBuffersFlasher()
+
+        with mock.patch.object(Flasher, '_Flasher__is_device', return_value=True):
+            self.assertTrue(flasher.flash(self.image, self.target, self.blockmap))
+
+        target_content = self._read(self.target)
+        self.assertEqual(target_content[:len(self.content)], self.content)
+        self.assertEqual(target_content[len(self.content):], b'\xff' * len(self.content))
+        self.assertEqual(flasher.written, len(self.content))
+        self._validate(flasher.get_hashmap())
+
+    def test_invalid_blockmap_is_ignored(self):
+        blockmap = dict(self.blockmap)
+        blockmap['size'] += 1
+        flasher = SmallBuffersFlasher()
+
+        self.assertTrue(flasher.flash(self.image, self.target, blockmap))
+
+        self.assertEqual(self._read(self.target), self.content)
+        self.assertEqual(flasher.written, len(self.content))
+
+    def test_flash_in_patched_runtime_does_not_block_hub(self):
+        root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.run([sys.executable, '-c', PATCHED_RUNTIME_SCRIPT, self.work_dir, self.image, self.target], cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode('utf-8'))
+        result = json.loads(proc.stdout.decode('utf-8').strip().splitlines()[-1])
+
+        self.assertTrue(result['flashed'])
+        self.assertTrue(result['validated'])
+        self.assertTrue(result['same'])
+        #reads and writes are executed in OS threads, hub keeps running during 50ms reads and writes
+        self.assertFalse(result['mainthreadio']['flash'])
+        self.assertGreater(result['ticks']['flash'], 20)
+        self.assertLess(result['maxgap']['flash'], 0.04)
+        self.assertFalse(result['mainthreadio']['validate'])
+        self.assertGreater(result['ticks']['validate'], 20)
+        self.assertLess(result['maxgap']['validate'], 0.04)
+        #drives are flashed in parallel, status is reported in hub thread
+        self.assertTrue(result['scheduled'])
+        self.assertEqual(result['maxwrites'], 2)
+        self.assertEqual(result['callbackthreads'], [True])
+        self.assertFalse(result['mainthreadio']['schedule'])
+        self.assertLess(result['maxgap']['schedule'], 0.04)
+
+    def test_validator_detects_mismatch(self):
+        flasher = SmallBuffersFlasher()
+        self.assertTrue(flasher.flash(self.image, self.target, self.blockmap))
+        with open(self.target, 'r+b') as f:
+            f.seek(262144)
+            f.write(b'\x00')
+
+        validator = Validator(workers=2)
+        self.assertFalse(validator.validate(self.target, flasher.get_hashmap()))
+        self.assertEqual(validator.get_result()['mismatchoffset'], 262144)
+
+    def test_validator_workers(self):
+        flasher = SmallBuffersFlasher()
+        self.assertTrue(flasher.flash(self.image, self.target))
+
+        for workers in (1, 4):
+            validator = Validator(workers=workers)
+            self.assertTrue(validator.validate(self.target, flasher.get_hashmap()), validator.get_result())
+            self.assertEqual(validator.get_result()['checked'], len(self.content))
+        self.assertTrue(Validator().validate(self.target, {'algorithm': 'sha256', 'chunks': []}))
+
+    def test_scheduler_flashes_all_drives(self):
+        targets = [os.path.join(self.work_dir, 'drive%d.img' % index) for index in range(3)]
+        statuses = []
+        scheduler = FlashScheduler(statuses.append, max_jobs=2)
+        for drive in targets:
+            scheduler.add_job(drive, self.image, self.blockmap)
+        with self.assertRaises(Exception):
+            scheduler.add_job(targets[0], self.image)
+
+        self.assertTrue(scheduler.run())
+
+        for drive in targets:
+            self.assertEqual(self._read(drive), self.content)
+        self.assertEqual([job['status'] for job in scheduler.get_jobs()], [FlashScheduler.JOB_DONE] * 3)
+        self.assertEqual([job['percent'] for job in statuses[-1]], [100] * 3)
+
+    def test_scheduler_cancel_queued_drive(self):
+        targets = [os.path.join(self.work_dir, 'drive%d.img' % index) for index in range(2)]
+        scheduler = FlashScheduler(max_jobs=1)
+        for drive in targets:
+            scheduler.add_job(drive, self.image, self.blockmap)
+        scheduler.cancel(targets[1])
+
+        self.assertFalse(scheduler.run())
+
+        jobs = scheduler.get_jobs()
+        self.assertEqual(jobs[0]['status'], FlashScheduler.JOB_DONE)
+        self.assertEqual(jobs[1]['status'], FlashScheduler.JOB_CANCELED)
+        self.assertFalse(os.path.exists(targets[1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import os
+import json
+import stat
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+from core.libs.installqueue import InstallQueue
+
+WIFI = {
+    'network': 'mynetwork',
+    'password': 'secret',
+    'encryption': 'wpa2',
+    'hidden': False,
+}
+
+class InstallQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.queue_path = os.path.join(self.config_dir, InstallQueue.QUEUE_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir, ignore_errors=True)
+
+    def _read_queue(self):
+        with open(self.queue_path, 'r') as f:
+            return f.read()
+
+    def test_wifi_is_never_written_to_disk(self):
+        queue = InstallQueue(self.config_dir)
+        job = queue.add('http://host/image.zip', ['/dev/sdb'], WIFI)
+
+        self.assertNotIn('secret', self._read_queue())
+        self.assertEqual(queue.get_job(job['id'])['wifi'], WIFI)
+        self.assertTrue(queue.get_jobs()[0]['haswifi'])
+        self.assertNotIn('wifi', queue.get_jobs()[0])
+        self.assertEqual(stat.S_IMODE(os.stat(self.queue_path).st_mode), 0o600)
+
+    def test_load_pauses_waiting_and_downloading_jobs(self):
+        queue = InstallQueue(self.config_dir)
+        queued = queue.add('http://host/image1.zip', ['/dev/sdb'], WIFI)
+        downloading = queue.add('http://host/image2.zip', ['/dev/sdc'])
+        queue.set_status(downloading['id'], InstallQueue.JOB_DOWNLOADING)
+
+        queue = InstallQueue(self.config_dir)
+
+        self.assertEqual(queue.get_job(queued['id'])['status'], InstallQueue.JOB_PAUSED)
+        self.assertIsNone(queue.get_job(queued['id'])['wifi'])
+        self.assertEqual(queue.get_job(downloading['id'])['status'], InstallQueue.JOB_PAUSED)
+        self.assertIsNone(queue.get_next(timeout=0))
+
+    def test_load_sets_interrupted_flash_in_error(self):
+        queue = InstallQueue(self.config_dir)
+        flashing = queue.add('http://host/image.zip', ['/dev/sdb'])
+        queue.set_status(flashing['id'], InstallQueue.JOB_FLASHING)
+        validating = queue.add('http://host/image.zip', ['/dev/sdc'])
+        queue.set_status(validating['id'], InstallQueue.JOB_VALIDATING)
+        done = queue.add('http://host/image.zip', ['/dev/sdd'])
+        queue.set_status(done['id'], InstallQueue.JOB_DONE)
+
+        queue = InstallQueue(self.config_dir)
+
+        for job_id in (flashing['id'], validating['id']):
+            self.assertEqual(queue.get_job(job_id)['status'], InstallQueue.JOB_ERROR)
+            self.assertIsNotNone(queue.get_job(job_id)['error'])
+        self.assertEqual(queue.get_job(done['id'])['status'], InstallQueue.JOB_DONE)
+
+    def test_load_invalid_queue_file(self):
+        with open(self.queue_path, 'w') as f:
+            f.write('invalid')
+
+        queue = InstallQueue(self.config_dir)
+
+        self.assertEqual(queue.get_jobs(), [])
+        self.assertEqual(json.loads(self._read_queue()), {'jobs': []})
+
+    def test_resume_paused_job(self):
+        queue = InstallQueue(self.config_dir)
+        job = queue.add('http://host/image.zip', ['/dev/sdb'], WIFI)
+        queue = InstallQueue(self.config_dir)
+        #ui warns user that wifi configuration was lost
+        self.assertTrue(queue.get_job(job['id'])['haswifi'])
+        self.assertIsNone(queue.get_job(job['id'])['wifi'])
+
+        queue.resume(job['id'], WIFI)
+
+        next_job = queue.get_next(timeout=0)
+        self.assertEqual(next_job['id'], job['id'])
+        self.assertEqual(next_job['wifi'], WIFI)
+        self.assertNotIn('secret', self._read_queue())
+        with self.assertRaises(Exception):
+            queue.resume(job['id'])
+        with self.assertRaises(Exception):
+            queue.resume('unknown')
+
+    def test_get_next_starts_job(self):
+        queue = InstallQueue(self.config_dir)
+        job1 = queue.add('http://host/image1.zip', ['/dev/sdb'])
+        job2 = queue.add('http://host/image2.zip', ['/dev/sdc'])
+
+        self.assertEqual(queue.get_next(timeout=0)['id'], job1['id'])
+        self.assertEqual(queue.get_job(job1['id'])['status'], InstallQueue.JOB_DOWNLOADING)
+        with self.assertRaises(Exception):
+            queue.remove(job1['id'])
+        self.assertEqual(queue.get_next(timeout=0)['id'], job2['id'])
+        self.assertIsNone(queue.get_next(timeout=0))
+
+    def test_get_next_is_woken_up_by_added_job(self):
+        queue = InstallQueue(self.config_dir)
+        results = []
+        consumer = Thread(target=lambda: results.append(queue.get_next(timeout=10)))
+        consumer.start()
+
+        job = queue.add('http://host/image.zip', ['/dev/sdb'])
+        consumer.join(10)
+
+        self.assertEqual(results[0]['id'], job['id'])
+
+    def test_ended_jobs_are_pruned(self):
+        queue = InstallQueue(self.config_dir)
+        for _ in range(InstallQueue.MAX_ENDED_JOBS + 5):
+            job = queue.add('http://host/image.zip', ['/dev/sdb'])
+            queue.set_status(job['id'], InstallQueue.JOB_DONE)
+
+        self.assertEqual(len(queue.get_jobs()), InstallQueue.MAX_ENDED_JOBS)
+        self.assertEqual(queue.get_jobs()[-1]['id'], job['id'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+import time
+import unittest
+from threading import Thread
+from core.libs.ratelimiter import RateLimiter
+
+class RateLimiterTests(unittest.TestCase):
+
+    def test_unlimited_does_not_wait(self):
+        limiter = RateLimiter()
+
+        self.assertEqual(limiter.consume(10485760), 0.0)
+
+    def test_consume_waits_for_debt(self):
+        limiter = RateLimiter(65536)
+        limiter.consume(65536)
+
+        waited = limiter.consume(32768)
+
+        self.assertAlmostEqual(waited, 0.5, delta=0.15)
+
+    def test_rate_change_applies_to_waiting_caller(self):
+        limiter = RateLimiter(65536)
+        limiter.consume(65536)
+        Thread(target=lambda: (time.sleep(0.3), limiter.set_rate(0)), daemon=True).start()
+
+        waited = limiter.consume(655360)
+
+        self.assertLess(waited, 1.0)
+
+    def test_canceled_caller_stops_waiting(self):
+        limiter = RateLimiter(65536)
+        limiter.consume(65536)
+        start = time.time()
+
+        waited = limiter.consume(655360, lambda: time.time()-start>=0.3)
+
+        self.assertLess(waited, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()